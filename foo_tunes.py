@@ -1,139 +1,479 @@
 #!/usr/bin/python3
 
 import argparse
+import hashlib
+import heapq
+import hmac
 import json
 import glob
+import math
 import platform
 import queue
+import random
 import re
+import socket
+import socketserver
 import subprocess
+import tempfile
 import threading
 import time
 import traceback
 import os
 
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from functools import partial
+from functools import lru_cache, partial
 from pathlib import Path, PureWindowsPath
-from shutil import move, rmtree, which
-from typing import Any, Dict, List, Optional, Text
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-
+from shutil import (copyfile, copyfileobj, copymode, disk_usage, move, rmtree,
+                    which)
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Set, Text)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description='Foobar2000 -> iTunes utilities')
+
+    # Playlist / .m3u8 Management
+
+    parser.add_argument(
+        '-m3u_i',
+        '--m3u_input_dir',
+        help='Directory containing playlists/.m3u8 files to convert fron.')
+
+    parser.add_argument(
+        '-m3u_o',
+        '--m3u_output_dir',
+        default=None,
+        help='Directory containing converted playlists/.m3u8 files.')
+
+    parser.add_argument(
+        '--m3u_flac_to_alac',
+        default=False,
+        action='store_true',
+        help='Change .flac extension to .m4a in playlists.')
+
+    parser.add_argument(
+        '--m3u_windows_to_posix',
+        default=False,
+        action='store_true',
+        help='Convert music paths in playlist to posix format.')
+
+    parser.add_argument('--m3u_from_str',
+                        help='String in playlist line to replace.')
+
+    parser.add_argument('--m3u_to_str',
+                        help='String in playlist line to replace to.')
+
+    parser.add_argument(
+        '--m3u_library_dir', default=None,
+        help='If set, only rewrite playlist entries to .m4a when that file'
+        ' exists in this music library directory, and report entries that'
+        ' don\'t exist.')
+
+    parser.add_argument(
+        '--m3u_library_root', default=None,
+        help='How --m3u_library_dir is written in the playlists, e.g.'
+        ' X:\\music. Defaults to --m3u_library_dir.')
+
+    parser.add_argument(
+        '--m3u_library_index', default=None,
+        help='JSON file caching the paths in --m3u_library_dir. Loaded if it'
+        ' exists and only directories that changed since are listed again,'
+        ' otherwise the library is scanned. Saved here when it changes.')
+
+    parser.add_argument(
+        '--m3u_only_if_changed', default=False, action='store_true',
+        help='If set, skip writing playlists whose contents haven\'t changed'
+        ' and atomically replace the ones that have, so unchanged playlists'
+        ' keep their modification time.')
+
+    parser.add_argument(
+        '--m3u_watch',
+        default=False,
+        action='store_true',
+        help='If set, watch input directory for playlist changes and'
+        ' automatically convert playlists in that directory using the related'
+        ' -m3u flags.')
+
+    # FLAC Conversion
+
+    parser.add_argument(
+        '--flac_dir',
+        help='If set, convert .flac files in this directory to .m4a.')
+
+    parser.add_argument(
+        '--flac_overwrite_output', default=False, action='store_true',
+        help='If set, always write/overwrite output files'
+        ' when converting.')
+
+    parser.add_argument(
+        '--flac_delete_original', default=False, action='store_true',
+        help='If set, delete .flac version after converting to alac.')
+
+    parser.add_argument(
+        '--flac_verify', default=False, action='store_true',
+        help='If set, check the decoded .m4a against the MD5 stored in the'
+        ' .flac before deleting the original. Needs ffmpeg.')
+
+    parser.add_argument(
+        '--flac_priority', default='',
+        help='Comma separated order to convert flacs in, out of '
+        f'{",".join(PRIORITY_POLICIES)}. playlist converts tracks in'
+        ' --m3u_input_dir playlists first. oldest converts flacs by creation'
+        ' time, or on Linux by ctime, which a chmod or rename also changes.'
+        ' Defaults to discovery order.')
+
+    parser.add_argument(
+        '--flac_cache_dir', default=None,
+        help='If set, keep converted ALACs here and reuse them for flacs with'
+        ' the same audio and tags instead of converting again, e.g. the same'
+        ' album synced from two places.')
+
+    parser.add_argument(
+        '--flac_cache_size_gb', default=20, type=float,
+        help='Size --flac_cache_dir is kept under, least recently used ALACs'
+        ' are removed first. Default = 20.')
+
+    parser.add_argument(
+        '--flac_cache_hardlink', default=False, action='store_true',
+        help='If set, hardlink to and from --flac_cache_dir when it can\'t'
+        ' reflink instead of copying. Tags edited in place then also change'
+        ' the cached ALAC.')
+
+    parser.add_argument('--flac_threads', default=4, type=int,
+                        help='Number of threads to use when converting.')
+
+    parser.add_argument(
+        '--flac_loudness', default=False, action='store_true',
+        help='If set, measure EBU R128 loudness from the decode feeding the'
+        ' ALAC encoder and tag ReplayGain track and album gain once every'
+        ' track of an album is done. Needs ffmpeg.')
+
+    parser.add_argument(
+        '--flac_profile', default=None, action='append',
+        help='codec:bitrate:directory of an extra copy encoded from the same'
+        ' decode as the ALAC, e.g. aac:256k:/music/mobile. Codecs are'
+        f' {",".join(OutputProfile.CODECS)}. Can be given more than once.'
+        ' Needs ffmpeg.')
+
+    parser.add_argument(
+        '--flac_batch_size', default=1, type=int,
+        help='Up to this many flacs of the same album are converted by one'
+        ' ffmpeg run, so singles and short tracks don\'t pay for starting'
+        ' ffmpeg every time. Default = 1 (a run per flac).')
+
+    parser.add_argument(
+        '--flac_stall_timeout', default=120, type=float,
+        help='Kill an encoder once its output hasn\'t grown for this many'
+        ' seconds, e.g. hung on a corrupt file or a stalled network read.'
+        ' 0 waits forever. Default = 120.')
+
+    parser.add_argument(
+        '--flac_max_attempts', default=3, type=int,
+        help='Times a flac is encoded before giving up on it. Default = 3.')
+
+    parser.add_argument(
+        '--flac_retry_backoff', default=5, type=float,
+        help='Seconds before encoding a failed flac again, doubled after'
+        ' each attempt. Default = 5.')
+
+    parser.add_argument(
+        '--flac_quarantine_file', default=None,
+        help='If set, flacs that failed every attempt are listed in this'
+        ' JSON file and skipped until they change.')
+
+    parser.add_argument(
+        '--flac_prefetch', default=0, type=int,
+        help='Read this many queued flacs ahead of the workers, so ffmpeg'
+        ' doesn\'t start by waiting on a slow disk or network volume.'
+        ' Default = 0 (off).')
+
+    parser.add_argument(
+        '--flac_prefetch_mb', default=256, type=int,
+        help='At most this many MB of flacs are read ahead at once.'
+        ' Default = 256.')
+
+    parser.add_argument(
+        '--flac_watch',
+        default=False,
+        action='store_true',
+        help='If set, watch input directory for flac changes and automatically'
+        ' convert flacs in that directory using the related -flac flags.')
+
+    parser.add_argument(
+        '--flac_change_genres', default=False, action='store_true',
+        help='If set, tweak genre tags to a common set of tags after'
+        ' converting encoding music files. Genres tagged will be the list of'
+        ' music files in --flac_dir, even if the file isn\' a FLAC file.')
+
+    # Conversion Farm
+
+    parser.add_argument(
+        '--farm_coordinator', default=None,
+        help='host:port to serve --flac_dir conversions on instead of'
+        ' converting locally, e.g. 0.0.0.0:8765 to serve the LAN. Run'
+        ' --farm_worker on each machine that should convert. Originals are'
+        ' only deleted once the ALAC verifies, so this needs ffmpeg.')
+
+    parser.add_argument(
+        '--farm_worker', default=None,
+        help='host:port of a --farm_coordinator to convert flacs for. This'
+        ' is the only thing this utility does when set.')
+
+    parser.add_argument(
+        '--farm_secret', default=os.environ.get('FOO_TUNES_FARM_SECRET'),
+        help='Shared secret every farm message is signed with, the same on'
+        ' the coordinator and the workers. Required. Defaults to the'
+        ' FOO_TUNES_FARM_SECRET environment variable, which unlike a flag'
+        ' doesn\'t show up in ps.')
+
+    parser.add_argument(
+        '--farm_worker_dir', default=None,
+        help='With --farm_shared_paths, the directory (e.g. the mount) a'
+        ' worker reads and writes jobs in. Jobs outside of it are refused.')
+
+    parser.add_argument(
+        '--farm_shared_paths', default=False, action='store_true',
+        help='If set, workers read and write --flac_dir paths directly (e.g.'
+        ' a mount at the same path) instead of receiving the flac and'
+        ' sending the ALAC back over the connection.')
+
+    parser.add_argument(
+        '--farm_lease_timeout', default=600, type=float,
+        help='Seconds a worker can go without renewing a job before it is'
+        ' handed to another worker.')
+
+    parser.add_argument(
+        '--farm_max_attempts', default=3, type=int,
+        help='Times a job is handed out before it is reported as failed.')
+
+    # Resource Governor
+
+    parser.add_argument(
+        '--governor_nice', default=0, type=int,
+        help='Niceness to run ffmpeg/xld with, e.g. 10. Default = 0.')
+
+    parser.add_argument(
+        '--governor_idle_io', default=False, action='store_true',
+        help='If set, run ffmpeg/xld with idle I/O priority (ionice on'
+        ' Linux, taskpolicy on OSX).')
+
+    parser.add_argument(
+        '--governor_bandwidth_mb', default=0, type=float,
+        help='Average MB/s of conversions let in, counting twice each'
+        ' flac\'s size for reading it and writing its ALAC. Conversions wait'
+        ' to start until it allows, running ones aren\'t slowed down. 0 is'
+        ' unlimited.')
+
+    parser.add_argument(
+        '--governor_max_load', default=0, type=float,
+        help='Shrink the conversion workers to --governor_min_workers while'
+        ' the 1 minute load average per CPU is above this. 0 disables.')
+
+    parser.add_argument(
+        '--governor_max_iowait', default=0, type=float,
+        help='Shrink the conversion workers while the percent of CPU time'
+        ' waiting on I/O is above this (Linux). 0 disables.')
+
+    parser.add_argument(
+        '--governor_min_workers', default=1, type=int,
+        help='Workers that keep converting while overloaded, 0 pauses all.')
+
+    # Changing Metadata / Tags
+
+    parser.add_argument(
+        '--change_genres', default=False, action='store_true',
+        help='If set, tweak genre tags to a common set of tags in --flac_dir.'
+        ' If this is set, changing tags is the only thing this utility does.')
+
+    parser.add_argument(
+        '--genre_rules', default=None,
+        help='JSON file mapping genre regex patterns to genres, e.g.'
+        ' {"(kpop|korean)": "K-Pop"}. Rules are tried in file order.'
+        ' Defaults to the built in rules.')
+
+    # Watching for Changes
+
+    parser.add_argument(
+        '--watch_sleep_time', default=30, type=int,
+        help='Number of seconds to sleep for when watching directory changes.')
+
+    parser.add_argument(
+        '--watch_playlist_delay', default=20, type=int,
+        help='Number of seconds to wait before managing playlists upon'
+        ' directory changes.')
+
+    parser.add_argument(
+        '--watch_settle_time', default=10, type=float,
+        help='Number of seconds an album\'s files have to stay the same size'
+        ' before it is converted. Albums with Resilio partial downloads are'
+        ' never converted.')
+
+    parser.add_argument(
+        '--watch_polling', default=False, action='store_true',
+        help='If set, poll for changes instead of waiting for filesystem'
+        ' events, which often never arrive on SMB/NFS mounts. Only'
+        ' directories whose mtime changed are listed again.')
+
+    parser.add_argument(
+        '--watch_poll_interval', default=10, type=float,
+        help='Number of seconds between polls with --watch_polling.'
+        ' Default = 10.')
+
+    # Album Pipeline (--jojo)
+
+    parser.add_argument(
+        '--pipeline_convert_albums', default=1, type=int,
+        help='Albums converted at the same time, each with --flac_threads'
+        ' workers, so up to this times --flac_threads encoders run at once.'
+        ' Default = 1.')
+
+    parser.add_argument(
+        '--pipeline_tag_albums', default=2, type=int,
+        help='Albums having their genres fixed at the same time.'
+        ' Default = 2.')
+
+    parser.add_argument(
+        '--pipeline_move_albums', default=1, type=int,
+        help='Albums moved to _TO_PROCESS at the same time. Default = 1.')
+
+    parser.add_argument(
+        '--scratch_dir', default=None,
+        help='Local (or tmpfs) directory ALACs are encoded, verified and'
+        ' tagged in before each finished album is copied to _TO_PROCESS in'
+        ' one go, instead of writing them next to the flacs on the NAS.'
+        ' Albums that don\'t fit are converted in place.')
+
+    # Backends
+
+    parser.add_argument(
+        '--backend', default='command', choices=BACKENDS,
+        help='command runs xld/ffmpeg/mp4tags/metaflac. simulate only sleeps'
+        ' and writes placeholder files, for load testing the queueing and'
+        ' watching with fake flacs. Default = command.')
+
+    parser.add_argument(
+        '--simulate_latency', default=0.5, type=float,
+        help='Seconds each simulated encode/tag takes. Default = 0.5.')
+
+    parser.add_argument(
+        '--simulate_jitter', default=0, type=float,
+        help='Up to this many seconds are added to each simulated call.')
+
+    parser.add_argument(
+        '--simulate_failure_rate', default=0, type=float,
+        help='Fraction of simulated calls that fail, e.g. 0.01.')
+
+    parser.add_argument(
+        '--simulate_seed', default=None, type=int,
+        help='Random seed for the simulated jitter and failures.')
+
+    # Utility
+
+    parser.add_argument(
+        '--stats',
+        help='If set, print track counts, sizes, genres, pending genre changes'
+        ' and unconverted flacs for this directory, then exit.')
 
-parser = argparse.ArgumentParser(description='Foobar2000 -> iTunes utilities')
-
-# Playlist / .m3u8 Management
+    parser.add_argument(
+        '--stats_cache', default=None,
+        help='JSON file caching the genres read for --stats, only files whose'
+        ' size or modification time changed are read again. Defaults to'
+        ' .foo_tunes_tags.json in the --stats directory.')
+
+    parser.add_argument(
+        '--clean_up',
+        help='If set, clean up this directory of extraneous files.'
+        'This is of the form --clean_up=/some/directory')
+
+    parser.add_argument(
+        '--clean_up_report', default=False, action='store_true',
+        help='If set, --clean_up only lists the files it would delete.')
+
+    parser.add_argument(
+        '--discovery_threads', default=8, type=int,
+        help='Directories listed at the same time when looking for music'
+        ' files. Listing is latency bound on SMB/NFS mounts, so this speeds'
+        ' it up about as many times. Default = 8.')
+
+    parser.add_argument(
+        '--discovery_queue_size', default=256, type=int,
+        help='Files found ahead of the workers converting or tagging them.'
+        ' Workers start on the first file found, and a huge library doesn\'t'
+        ' take more memory. Default = 256.')
+
+    parser.add_argument('--dry', default=False, action='store_true',
+                        help='If set, don\'t write any new changes.')
+
+    parser.add_argument('--jojo', default=False, action='store_true',
+                        help='If set, manage music.')
 
-parser.add_argument(
-    '-m3u_i',
-    '--m3u_input_dir',
-    help='Directory containing playlists/.m3u8 files to convert fron.')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true',
+                        help='Verbose logging.')
 
-parser.add_argument(
-    '-m3u_o',
-    '--m3u_output_dir',
-    default=None,
-    help='Directory containing converted playlists/.m3u8 files.')
+    return parser
 
-parser.add_argument(
-    '--m3u_flac_to_alac',
-    default=False,
-    action='store_true',
-    help='Change .flac extension to .m4a in playlists.')
 
-parser.add_argument(
-    '--m3u_windows_to_posix',
-    default=False,
-    action='store_true',
-    help='Convert music paths in playlist to posix format.')
+class Options:
+    """Runtime settings shared by the library classes.
 
-parser.add_argument('--m3u_from_str',
-                    help='String in playlist line to replace.')
+    External tools are looked up the first time they're needed, so creating
+    Options (or importing this module) doesn't touch the filesystem.
+    """
 
-parser.add_argument('--m3u_to_str',
-                    help='String in playlist line to replace to.')
-
-parser.add_argument(
-    '--m3u_watch',
-    default=False,
-    action='store_true',
-    help='If set, watch input directory for playlist changes and automatically'
-    ' convert playlists in that directory using the related -m3u flags.')
-
-# FLAC Conversion
-
-parser.add_argument(
-    '--flac_dir',
-    help='If set, convert .flac files in this directory to .m4a.')
-
-parser.add_argument(
-    '--flac_overwrite_output', default=False, action='store_true',
-    help='If set, always write/overwrite output files'
-    ' when converting.')
-
-parser.add_argument(
-    '--flac_delete_original', default=False, action='store_true',
-    help='If set, delete .flac version after converting to alac.')
-
-parser.add_argument('--flac_threads', default=4, type=int,
-                    help='Number of threads to use when converting.')
-
-parser.add_argument(
-    '--flac_watch',
-    default=False,
-    action='store_true',
-    help='If set, watch input directory for flac changes and automatically '
-    'convert flacs in that directory using the related -flac flags.')
-
-parser.add_argument('--flac_change_genres', default=False, action='store_true',
-                    help='If set, tweak genre tags to a common set of tags'
-                    ' after converting encoding music files. Genres tagged '
-                    ' will be the list of music files in --flac_dir, even'
-                    ' if the file isn\' a FLAC file.')
-
-# Changing Metadata / Tags
-
-parser.add_argument('--change_genres', default=False, action='store_true',
-                    help='If set, tweak genre tags to a common set of tags'
-                    ' in --flac_dir. If this is set, changing tags is the '
-                    ' only thing this utility does.')
-
-# Watching for Changes
-
-parser.add_argument(
-    '--watch_sleep_time', default=30, type=int,
-    help='Number of seconds to sleep for when watching directory changes.')
-
-parser.add_argument(
-    '--watch_playlist_delay', default=20, type=int,
-    help='Number of seconds to wait before managing playlists upon directory'
-    ' changes.')
-
-parser.add_argument(
-    '--watch_convert_delay', default=120, type=int,
-    help='Number of seconds to wait before converting flacs upon directory'
-    ' changes.')
-
-# Utility
-
-parser.add_argument('--clean_up',
-                    help='If set, clean up this directory of extraneous files.'
-                    'This is of the form --clean_up=/some/directory')
-
-parser.add_argument('--dry', default=False, action='store_true',
-                    help='If set, don\'t write any new changes.')
-
-parser.add_argument('--jojo', default=False, action='store_true',
-                    help='If set, manage music.')
-
-parser.add_argument('-v', '--verbose', default=False, action='store_true',
-                    help='Verbose logging.')
-
-
-def print_if(str: str) -> None:
-    """Print statement only if VERBOSE or DRY is set."""
-    if VERBOSE or DRY:
+    def __init__(self,
+                 verbose: bool = False,
+                 dry: bool = False,
+                 tools: Optional[Dict[str, Optional[str]]] = None,
+                 discovery_threads: int = 8,
+                 discovery_queue_size: int = 256):
+        self.verbose = verbose
+        self.dry = dry
+        # Directories scan_files lists at the same time.
+        self.discovery_threads = discovery_threads
+        # Files found but not yet taken by a worker, discovery waits for
+        # the workers when there are this many.
+        self.discovery_queue_size = discovery_queue_size
+        # Tool name -> path to the tool, or None if it isn't installed.
+        self.tools: Dict[str, Optional[str]] = dict(tools or {})
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> 'Options':
+        return cls(verbose=args.verbose or args.jojo, dry=args.dry,
+                   discovery_threads=args.discovery_threads,
+                   discovery_queue_size=args.discovery_queue_size)
+
+    def tool(self, name: str) -> Optional[str]:
+        if name not in self.tools:
+            self.tools[name] = which(name)
+        return self.tools[name]
+
+    @property
+    def xld_available(self) -> bool:
+        return bool(self.tool('xld'))  # OSX Only
+
+    @property
+    def ffmpeg_available(self) -> bool:
+        return bool(self.tool('ffmpeg'))
+
+    @property
+    def mp4tags_available(self) -> bool:
+        return bool(self.tool('mp4tags'))
+
+    @property
+    def metaflac_available(self) -> bool:
+        return bool(self.tool('metaflac'))
+
+
+DEFAULT_OPTIONS = Options()
+
+
+def print_if(str: str, options: Optional[Options] = None) -> None:
+    """Print statement only if verbose or dry is set."""
+    options = options or DEFAULT_OPTIONS
+    if options.verbose or options.dry:
         print(str)
 
 
@@ -149,6 +489,11 @@ def flac_extension_to_alac(song: str) -> str:
     return pattern.sub('.m4a', song)
 
 
+def flac_path_to_alac(song: str) -> str:
+    """Like flac_extension_to_alac but only touches the file extension."""
+    return re.sub(r'\.flac$', '.m4a', song, flags=re.IGNORECASE)
+
+
 def windows_path_to_posix(song: str) -> str:
     return str(PureWindowsPath(song).as_posix())
 
@@ -173,6 +518,70 @@ def from_str_to_str(song: str, from_str: str, to_str: str) -> str:
     return song.replace(from_str, to_str)
 
 
+def has_free_space(directory: str, num_bytes: int,
+                   reserve: int = 1024 ** 3) -> bool:
+    """Returns whether num_bytes fit in directory, keeping reserve free."""
+    try:
+        return disk_usage(directory).free - num_bytes >= reserve
+    except OSError:
+        return False
+
+
+def commit_staged_album(staged_dir: str,
+                        album_dir: str,
+                        to_dir: str,
+                        finished: Iterable[str],
+                        options: Optional[Options] = None) -> None:
+    """Moves album_dir to to_dir and copies the files of staged_dir in.
+
+    staged_dir mirrors album_dir, e.g. ALACs encoded on local scratch. They
+    are copied over one after the other and only then are the finished
+    flacs (paths in album_dir whose ALACs were converted and verified)
+    deleted. If anything fails the copies are removed, the album is moved
+    back and the error is raised, so nothing is lost and the album can be
+    converted again.
+    """
+    entries = scan_files(staged_dir, stat=True, options=options)
+    staged = [entry.path for entry in entries]
+    finished = [os.path.relpath(true_path(path), true_path(album_dir))
+                for path in finished]
+    needed = sum(entry.stat().st_size for entry in entries)
+    if not has_free_space(os.path.dirname(to_dir), needed):
+        raise OSError(f'Not enough space in {to_dir} for {needed} bytes.')
+
+    move(album_dir, to_dir)
+    # Files that weren't in the album before, removed if the copy fails.
+    created: List[str] = []
+    copied: List[str] = []
+    try:
+        for path in staged:
+            target = os.path.join(to_dir, os.path.relpath(path, staged_dir))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if not os.path.exists(target):
+                created.append(target)
+            # A partial copy never has the final name.
+            partial_target = target + '.part'
+            created.append(partial_target)
+            copyfile(path, partial_target)
+            os.replace(partial_target, target)
+            copied.append(target)
+    except BaseException:
+        for path in created:
+            if os.path.exists(path):
+                os.remove(path)
+        move(to_dir, album_dir)
+        raise
+
+    for relative_path in finished:
+        flac_path = os.path.join(to_dir, relative_path)
+        if os.path.exists(flac_path):
+            print_if(f'Deleting {flac_path}...', options)
+            os.remove(flac_path)
+    rmtree(staged_dir)
+    print_if(f'Committed {len(copied)} files from {staged_dir} to {to_dir}.',
+             options)
+
+
 def alac_path_from_flac_path(flac_path: str) -> Text:
     directory, file_name = os.path.split(flac_path)
     base_name, extension = os.path.splitext(file_name)
@@ -188,65 +597,338 @@ def temp_path_from_path(path: str) -> Text:
     return new_path
 
 
-def walk_files(directory: str) -> List[str]:
-    # https://stackoverflow.com/questions/19309667/recursive-os-listdir
-    return [os.path.join(dp, f)
-            for dp, dn, fn in os.walk(os.path.expanduser(directory))
-            for f in fn]
-
-
-def find_flac_files(directory: str) -> List[str]:
-    print_if(f'Looking for flac files in directory: {directory}...')
-    files = walk_files(directory)
-
-    flac_pattern = re.compile(r'.flac$', re.IGNORECASE)
-    flac_files = []
-    for f in files:
-        if re.search(flac_pattern, f):
-            flac_files.append(f)
-
-    print_if(f'Found flac files: {flac_files}')
+def list_directory(path: str, extensions: Optional[tuple] = None,
+                   stat: bool = False) -> tuple:
+    """Returns (files, subdirectories) DirEntries of path, sorted by name.
+
+    Like os.walk, symlinks to directories aren't followed and directories
+    that can't be listed are skipped. With stat set, the files are stat'ed
+    here so DirEntry.stat() doesn't go to the filesystem later.
+    """
+    files, subdirectories = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirectories.append(entry)
+                        continue
+                    if (extensions and
+                            not entry.name.lower().endswith(extensions)):
+                        continue
+                    if stat:
+                        entry.stat()
+                except OSError:
+                    continue
+                files.append(entry)
+    except OSError:
+        return [], []
+    files.sort(key=lambda entry: entry.name)
+    subdirectories.sort(key=lambda entry: entry.name)
+    return files, subdirectories
+
+
+def scan_files(directory: str,
+               extensions: Optional[Iterable[str]] = None,
+               stat: bool = False,
+               options: Optional[Options] = None) -> List[os.DirEntry]:
+    """Returns DirEntries of the files under directory, recursively.
+
+    Directories are listed by options.discovery_threads threads at once,
+    which is what takes time on network filesystems where every listing
+    is a round trip. Files come back in the same order no matter which
+    listing finishes first: a directory's files by name, then each of its
+    subdirectories by name. extensions are lower case, e.g. ('.flac',).
+    """
+    options = options or DEFAULT_OPTIONS
+    root = os.path.expanduser(directory)
+    extensions = tuple(extensions) if extensions else None
+    # Directory path -> (files, subdirectories).
+    listings: Dict[str, tuple] = {}
+    with ThreadPoolExecutor(
+            max_workers=max(1, options.discovery_threads)) as pool:
+        pending = {pool.submit(list_directory, root, extensions, stat): root}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                listings[path] = future.result()
+                for subdirectory in listings[path][1]:
+                    pending[pool.submit(list_directory, subdirectory.path,
+                                        extensions, stat)] = subdirectory.path
+
+    files: List[os.DirEntry] = []
+    stack = [root]
+    while stack:
+        directory_files, subdirectories = listings[stack.pop()]
+        files.extend(directory_files)
+        stack.extend(reversed([entry.path for entry in subdirectories]))
+    return files
+
+
+def iter_directory_files(
+        directory: str,
+        extensions: Optional[Iterable[str]] = None,
+        stat: bool = False,
+        options: Optional[Options] = None
+) -> Iterator[List[os.DirEntry]]:
+    """Yields the files of each directory under directory, as it's listed.
+
+    Like scan_files, and in the same order, but the first files come back
+    before the rest of the tree is listed. Only the next
+    options.discovery_threads directories in that order are listed ahead,
+    so a slow consumer holds back the listing too.
+    """
+    options = options or DEFAULT_OPTIONS
+    extensions = tuple(extensions) if extensions else None
+    max_pending = max(1, options.discovery_threads)
+    # Directories still to yield, the next one on top.
+    stack = [os.path.expanduser(directory)]
+    # Directory path -> its listing, for the ones listed ahead.
+    pending: Dict[str, Any] = {}
+    with ThreadPoolExecutor(max_workers=max_pending) as pool:
+        while stack:
+            for path in reversed(stack[-max_pending:]):
+                if len(pending) >= max_pending:
+                    break
+                if path not in pending:
+                    pending[path] = pool.submit(list_directory, path,
+                                                extensions, stat)
+            path = stack.pop()
+            future = pending.pop(path, None) or pool.submit(
+                list_directory, path, extensions, stat)
+            files, subdirectories = future.result()
+            stack.extend(reversed([entry.path for entry in subdirectories]))
+            if files:
+                yield files
+
+
+def find_flac_files(directory: str,
+                    options: Optional[Options] = None) -> List[str]:
+    print_if(f'Looking for flac files in directory: {directory}...', options)
+    flac_files = [entry.path for entry in
+                  scan_files(directory, ('.flac',), options=options)]
+    print_if(f'Found flac files: {flac_files}', options)
     return flac_files
 
 
-def find_all_music_files(directory: str) -> List[str]:
-    print_if(f'Looking for music files in directory: {directory}...')
-    files = walk_files(directory=directory)
+def find_all_music_files(directory: str,
+                         options: Optional[Options] = None) -> List[str]:
+    print_if(f'Looking for music files in directory: {directory}...',
+             options)
+    music_files = [entry.path for entry in
+                   scan_files(directory, MUSIC_EXTENSIONS, options=options)]
+    print_if(f'Found music files: {music_files}', options)
+    return music_files
 
-    music_pattern = re.compile(r'(.flac$|.mp3$|.m4a$)', re.IGNORECASE)
-    music_files = []
-    for f in files:
-        if re.search(music_pattern, f):
-            music_files.append(f)
 
-    print_if(f'Found music files: {music_files}')
-    return music_files
+def only_in_directories(paths: List[str],
+                        root: str,
+                        directories: Iterable[str]) -> List[str]:
+    """Returns the paths in (or equal to) directories, relative to root."""
+    directory_paths = [os.path.join(true_path(root), directory)
+                       for directory in directories]
+    return [path for path in paths
+            if any(path == directory_path or
+                   path.startswith(directory_path + os.sep)
+                   for directory_path in directory_paths)]
 
 
-def delete_some_trash(directory: str) -> None:
-    """Delete extraneous trash files that may corrupt entire process."""
-    files = walk_files(directory)
+class TrashCleaner:
+    """Deletes AppleDouble (._*) and .DS_Store files macOS leaves behind.
+
+    Files are matched by name only. Directories are listed with os.scandir
+    and remembered by mtime, so later sweeps only list directories that
+    changed since (or were marked dirty, e.g. from watch events) and just
+    stat the rest.
+    """
 
     # E.g.
     # ._file.flac
     # /bebe/sync/music/._file.flac
     # .DS_Store
-    resilio_trash_pattern = re.compile(r'(\._|^\._|\.DS_Store)')
-    for f in files:
-        print(f)
-        if re.search(resilio_trash_pattern, f):
-            print_if(f'Deleting trash {f}...')
-            os.remove(f)
+    TRASH_PATTERN = re.compile(r'^\._|^\.DS_Store$')
+
+    def __init__(self,
+                 report_only: bool = False,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        # If set, trash is only reported, not deleted.
+        self.report_only = report_only
+        self.lock = threading.Lock()
+        # Directory -> (mtime_ns when it was clean, its subdirectories).
+        self.directories: Dict[str, tuple] = {}
+        self.dirty: Set[str] = set()
+
+    @staticmethod
+    def is_trash(file_name: str) -> bool:
+        return TrashCleaner.TRASH_PATTERN.search(file_name) is not None
+
+    def mark_dirty(self, path: Optional[str]) -> None:
+        """Has the next sweep list path (or the directory it's in)."""
+        if not path:
+            return
+        is_directory = os.path.isdir(path)
+        with self.lock:
+            if is_directory:
+                self.dirty.add(path)
+            self.dirty.add(os.path.dirname(path))
+
+    def scan(self, directory: str) -> tuple:
+        """Returns (trash, {directory: (mtime_ns, subdirectories)})."""
+        trash = []
+        scanned = {}
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                self.directories.pop(path, None)
+                continue
+
+            cached = self.directories.get(path)
+            if cached and cached[0] == mtime and path not in self.dirty:
+                stack.extend(cached[1])
+                continue
+
+            subdirectories = []
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.path)
+                        elif TrashCleaner.is_trash(entry.name):
+                            trash.append(entry.path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            self.dirty.discard(path)
+            scanned[path] = (mtime, subdirectories)
+            stack.extend(subdirectories)
+        return trash, scanned
+
+    def delete(self, trash: List[str]) -> List[str]:
+        """Deletes trash, returns what was deleted."""
+        deleted = []
+        for path in trash:
+            try:
+                os.remove(path)
+                deleted.append(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f'Couldn\'t delete trash {path}: {e}')
+        return deleted
+
+    def clean(self, directory: str) -> List[str]:
+        """Deletes (or reports) trash under directory and returns it."""
+        directory = true_path(directory)
+        with self.lock:
+            trash, scanned = self.scan(directory)
+            if self.report_only:
+                for path in trash:
+                    print(f'Trash: {path}')
+            else:
+                trash = self.delete(trash)
+
+            trash_directories = {os.path.dirname(path) for path in trash}
+            for path, (mtime, subdirectories) in scanned.items():
+                if path in trash_directories:
+                    if self.report_only:
+                        # Keep reporting it until it's gone.
+                        continue
+                    # Deleting changed the mtime, it's clean now.
+                    try:
+                        mtime = os.stat(path).st_mtime_ns
+                    except FileNotFoundError:
+                        continue
+                self.directories[path] = (mtime, subdirectories)
+
+        print_if(f'{"Found" if self.report_only else "Deleted"} '
+                 f'{len(trash)} trash files in {directory}, listed '
+                 f'{len(scanned)} directories.', self.options)
+        return trash
+
+
+def delete_some_trash(directory: str,
+                      options: Optional[Options] = None,
+                      report_only: bool = False) -> List[str]:
+    """Delete extraneous trash files that may corrupt entire process."""
+    return TrashCleaner(report_only=report_only,
+                        options=options).clean(directory)
 
 
-def delete_directory_if_exists(directory: str) -> None:
+def write_file_if_changed(path: str, content: bytes) -> bool:
+    """Atomically replaces path with content unless it already matches.
+
+    Returns whether the file was written.
+    """
+    try:
+        if os.path.getsize(path) == len(content):
+            with open(path, 'rb') as f:
+                existing_digest = hashlib.sha256(f.read()).digest()
+            if existing_digest == hashlib.sha256(content).digest():
+                return False
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+
+    # Write next to the target so the rename can't cross filesystems.
+    directory, file_name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{file_name}.',
+                                     suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return True
+
+
+def replace_file_region(path: str, start: int, end: int, data: bytes) -> None:
+    """Atomically replaces bytes [start, end) of path with data.
+
+    The rest of the file is streamed into a temp file next to path, so a
+    crash leaves either the old or the new file, never neither.
+    """
+    directory, file_name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory or '.',
+                                     prefix=f'.{file_name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out, open(path, 'rb') as f:
+            out.write(f.read(start))
+            out.write(data)
+            f.seek(end)
+            copyfileobj(f, out, 1024 * 1024)
+        copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def remove_files(paths: Iterable[str]) -> None:
+    """Removes the paths that exist."""
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def delete_directory_if_exists(directory: str,
+                               options: Optional[Options] = None) -> None:
     if os.path.exists(directory):
-        print_if(f'Deleting directory {directory}...')
+        print_if(f'Deleting directory {directory}...', options)
         rmtree(directory)
 
 
-def print_separator() -> None:
-    if VERBOSE:
+def print_separator(options: Optional[Options] = None) -> None:
+    if (options or DEFAULT_OPTIONS).verbose:
         print('--------------------------------------------------------------')
 
 
@@ -254,34 +936,45 @@ def print_json(obj) -> None:
     print(json.dumps(obj, indent=2))
 
 
-def print_process_output(process, prefix: str) -> None:
+def print_process_output(process,
+                         prefix: str,
+                         options: Optional[Options] = None) -> None:
     if not process:
         return
 
     if process.stdout and process.stdout.strip():
-        print_if(f'{prefix}: stdout: {process.stdout}')
+        print_if(f'{prefix}: stdout: {process.stdout}', options)
     if process.stderr and process.stderr.strip():
-        print_if(f'{prefix}: stderr: {process.stderr}')
+        print_if(f'{prefix}: stderr: {process.stderr}', options)
 
 
 class Playlist:
     """Class representing an m3u playlist."""
 
-    def __init__(self, file: str):
+    def __init__(self, file: str, options: Optional[Options] = None):
         self.file = file
         self.songs = None
+        self.options = options or DEFAULT_OPTIONS
 
     def read(self):
         if self.songs:
             return
         self.songs = []
-        print_if(f'Reading file: {self.file}')
+        print_if(f'Reading file: {self.file}', self.options)
         with open(self.file, 'r') as f:
             for line in f.readlines():
                 if line.strip():
                     self.songs.append(line.strip())
 
-    def write(self, output_dir=None, prefix: Optional[str] = None):
+    def write(self,
+              output_dir=None,
+              prefix: Optional[str] = None,
+              only_if_changed: bool = False) -> Path:
+        """Writes the playlist and returns the path written to.
+
+        If only_if_changed is set, an identical playlist on disk is left alone
+        and a changed one is replaced atomically.
+        """
         if not self.songs:
             self.read()
 
@@ -290,12 +983,158 @@ class Playlist:
                                                 prefix=prefix)
         playlist_path.parent.mkdir(exist_ok=True, parents=True)
 
-        if not DRY:
-            with open(playlist_path, 'w', encoding='utf8') as f:
-                for each in self.songs:
-                    f.write(each + '\n')
+        if self.options.dry:
+            print_if(f'Wrote {playlist_path}', self.options)
+            return playlist_path
+
+        if only_if_changed:
+            # Match what text mode writes below.
+            content = ''.join(each + os.linesep for each in self.songs)
+            if write_file_if_changed(str(playlist_path),
+                                     content.encode('utf8')):
+                print_if(f'Wrote {playlist_path}', self.options)
+            else:
+                print_if(f'Unchanged {playlist_path}', self.options)
+            return playlist_path
+
+        with open(playlist_path, 'w', encoding='utf8') as f:
+            for each in self.songs:
+                f.write(each + '\n')
+
+        print_if(f'Wrote {playlist_path}', self.options)
+        return playlist_path
+
 
-        print_if(f'Wrote {playlist_path}')
+class LibraryIndex:
+    """Set of the music files in a library, keyed by relative path.
+
+    Playlist entries are resolved against this with a hash lookup instead of
+    a filesystem stat per line. Like TrashCleaner, directories are
+    remembered by mtime, so refresh() only lists the ones that changed and
+    just stats the rest.
+    """
+
+    def __init__(self,
+                 music_dir: str,
+                 keys: Optional[Iterable[str]] = None,
+                 directories: Optional[Dict[str, tuple]] = None,
+                 options: Optional[Options] = None):
+        self.music_dir = true_path(music_dir)
+        self.keys: Set[str] = set(keys) if keys else set()
+        # Directory relative to music_dir -> (mtime_ns when it was listed,
+        # subdirectory names, keys of its music files).
+        self.directories: Dict[str, tuple] = directories or {}
+        self.options = options or DEFAULT_OPTIONS
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, relative_path: str) -> bool:
+        return LibraryIndex.key(relative_path) in self.keys
+
+    @staticmethod
+    def key(relative_path: str) -> str:
+        # Playlists are written on Windows, so compare case insensitively and
+        # with posix separators.
+        return relative_path.replace('\\', '/').strip('/').casefold()
+
+    @staticmethod
+    def relative_path(song: str, library_root: str) -> Optional[str]:
+        """Returns song relative to library_root or None if it's outside."""
+        song_key = LibraryIndex.key(song)
+        root_key = LibraryIndex.key(library_root)
+        if not song_key.startswith(root_key + '/'):
+            return None
+        return song_key[len(root_key) + 1:]
+
+    def build(self) -> 'LibraryIndex':
+        print_if(f'Indexing music library: {self.music_dir}...', self.options)
+        self.directories = {}
+        self.refresh()
+        return self
+
+    def refresh(self) -> bool:
+        """Lists the directories that changed, returns if any files did."""
+        directories: Dict[str, tuple] = {}
+        listed = 0
+        stack = [self.music_dir]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            relative_path = os.path.relpath(path, self.music_dir)
+            cached = self.directories.get(relative_path)
+            if not cached or cached[0] != mtime:
+                files, subdirectories = list_directory(path, MUSIC_EXTENSIONS)
+                listed += 1
+                cached = (mtime,
+                          [entry.name for entry in subdirectories],
+                          [LibraryIndex.key(os.path.relpath(entry.path,
+                                                            self.music_dir))
+                           for entry in files])
+            directories[relative_path] = cached
+            stack.extend(os.path.join(path, name) for name in cached[1])
+
+        # Directories that are gone take their files with them.
+        keys = {key for _, _, files in directories.values() for key in files}
+        changed = keys != self.keys
+        self.directories, self.keys = directories, keys
+        print_if(f'Listed {listed} of {len(directories)} directories, '
+                 f'indexed {len(keys)} music files.', self.options)
+        return changed
+
+    def save(self, index_file: str) -> None:
+        if self.options.dry:
+            return
+        with open(true_path(index_file), 'w', encoding='utf8') as f:
+            json.dump({'music_dir': self.music_dir,
+                       'keys': sorted(self.keys),
+                       'directories': self.directories}, f)
+        print_if(f'Wrote library index {index_file}', self.options)
+
+    @classmethod
+    def load(cls,
+             index_file: str,
+             options: Optional[Options] = None) -> 'LibraryIndex':
+        with open(true_path(index_file), 'r', encoding='utf8') as f:
+            index = json.load(f)
+        print_if(f'Loaded library index {index_file}', options)
+        # Indexes saved without directories are listed again in full by
+        # the first refresh().
+        directories = {path: tuple(directory) for path, directory in
+                       index.get('directories', {}).items()}
+        return cls(music_dir=index['music_dir'],
+                   keys=index['keys'],
+                   directories=directories,
+                   options=options)
+
+
+def load_library_index(
+        music_dir: Optional[str],
+        index_file: Optional[str],
+        options: Optional[Options] = None) -> Optional[LibraryIndex]:
+    """Loads and refreshes index_file if it exists, else indexes music_dir.
+
+    Either way the index is saved to index_file if it changed.
+    """
+    library_index = None
+    if index_file and os.path.exists(true_path(index_file)):
+        library_index = LibraryIndex.load(index_file, options=options)
+        if music_dir and library_index.music_dir != true_path(music_dir):
+            print(f'{index_file} indexes {library_index.music_dir}, '
+                  f'indexing {music_dir} instead.')
+            library_index = None
+        elif not library_index.refresh():
+            return library_index
+    if library_index is None:
+        if not music_dir:
+            return None
+        library_index = LibraryIndex(music_dir, options=options).build()
+    if index_file:
+        library_index.save(index_file)
+    return library_index
 
 
 class PlaylistManager:
@@ -318,11 +1157,22 @@ class PlaylistManager:
     def __init__(self,
                  input_dir: str,
                  output_dir: str,
-                 deny_list: List[str] = DEFAULT_DENY_LIST):
+                 deny_list: List[str] = DEFAULT_DENY_LIST,
+                 library_index: Optional[LibraryIndex] = None,
+                 library_root: Optional[str] = None,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
         self.input_dir = true_path(input_dir)
         self.output_dir = true_path(output_dir)
         self.playlists: List[Playlist] = []
         self.deny_list = deny_list
+        # If set, only rewrite entries to files that exist in the library.
+        self.library_index = library_index
+        # How the library directory is written in the playlist entries.
+        self.library_root = library_root or (
+            library_index.music_dir if library_index else None)
+        # Playlist file -> entries that couldn't be found in the library.
+        self.unresolved: Dict[str, List[str]] = {}
 
     def should_manage_playlist(self, playlist: Playlist):
         for deny in self.deny_list:
@@ -333,38 +1183,99 @@ class PlaylistManager:
 
     def read(self):
         playlist_glob = os.path.join(self.input_dir, '*.m3u8')
-        print_if(f'Globbing for: {playlist_glob}')
+        print_if(f'Globbing for: {playlist_glob}', self.options)
 
         # Reset in case we're reading again.
         self.playlists = []
 
         playlist_files = glob.glob(playlist_glob)
         for playlist_file in playlist_files:
-            playlist: Playlist = Playlist(playlist_file)
+            playlist: Playlist = Playlist(playlist_file, self.options)
             if self.should_manage_playlist(playlist):
                 playlist.read()
                 self.playlists.append(playlist)
             else:
-                print_if(f'Skipped reading playlist: {playlist.file}...')
-
-        print_if(f'Playlist Files: {playlist_files}')
-
-    def write(self, prefix: Optional[str] = None):
-        for playlist in self.playlists:
-            playlist.write(self.output_dir, prefix=prefix)
+                print_if(f'Skipped reading playlist: {playlist.file}...',
+                         self.options)
+
+        print_if(f'Playlist Files: {playlist_files}', self.options)
+
+    def write(self,
+              prefix: Optional[str] = None,
+              only_if_changed: bool = False) -> List[Path]:
+        return [playlist.write(self.output_dir,
+                               prefix=prefix,
+                               only_if_changed=only_if_changed)
+                for playlist in self.playlists]
+
+    def remove_stale_playlists(self, keep: List[Path]):
+        """Deletes playlists in output_dir that weren't just written."""
+        if not self.output_dir or not os.path.isdir(self.output_dir):
+            return
+        keep_paths = {os.path.normpath(path) for path in keep}
+        for playlist_file in glob.glob(os.path.join(self.output_dir,
+                                                    '*.m3u8')):
+            if os.path.normpath(playlist_file) in keep_paths:
+                continue
+            print_if(f'Deleting stale playlist {playlist_file}...',
+                     self.options)
+            if not self.options.dry:
+                os.remove(playlist_file)
 
     def convert_flac_to_alac(self):
-        print_if('Converting m3u playlist extensions from .flac to .alac.')
+        print_if('Converting m3u playlist extensions from .flac to .alac.',
+                 self.options)
+        if not self.library_index:
+            for playlist in self.playlists:
+                playlist.songs = list(map(flac_extension_to_alac,
+                                          playlist.songs))
+            return
+
+        self.unresolved = {}
         for playlist in self.playlists:
-            playlist.songs = list(map(flac_extension_to_alac, playlist.songs))
+            playlist.songs = [self.resolve_song(playlist, song)
+                              for song in playlist.songs]
+        self.report_unresolved()
+
+    def resolve_song(self, playlist: Playlist, song: str) -> str:
+        """Returns song pointing at the .m4a only if it's in the library."""
+        if song.startswith('#'):
+            # #EXTM3U, #EXTINF, etc.
+            return song
+
+        relative_path = LibraryIndex.relative_path(song, self.library_root)
+        if relative_path is not None:
+            alac_relative_path = flac_path_to_alac(relative_path)
+            if alac_relative_path in self.library_index:
+                return flac_path_to_alac(song)
+            if relative_path in self.library_index:
+                # Not converted yet, keep pointing at the flac.
+                return song
+
+        self.unresolved.setdefault(playlist.file, []).append(song)
+        return song
+
+    def report_unresolved(self):
+        total = sum(len(songs) for songs in self.unresolved.values())
+        if total == 0:
+            return
+        print(f'{total} playlist entries not found in library '
+              f'{self.library_index.music_dir}.')
+        for playlist_file, songs in self.unresolved.items():
+            print_if(f'{playlist_file}: {len(songs)} unresolved entries:',
+                     self.options)
+            for song in songs:
+                print_if(f'  {song}', self.options)
 
     def convert_windows_to_posix(self):
-        print_if('Converting m3u playlist from Windows to Posix.')
+        print_if('Converting m3u playlist from Windows to Posix.',
+                 self.options)
         for playlist in self.playlists:
             playlist.songs = list(map(windows_path_to_posix, playlist.songs))
 
     def convert_from_str_to_str(self, from_str: str, to_str: str):
-        print_if(f'Converting m3u playlist from {from_str} to {to_str}.')
+        print_if(f'Converting m3u playlist from {from_str} to {to_str}.',
+                 self.options)
 
         # Create partial function with from_str and to_str already set.
         from_str_to_str_fn = partial(from_str_to_str,
@@ -376,10 +1287,18 @@ class PlaylistManager:
         for playlist in self.playlists:
             playlist.songs.reverse()
 
+    def referenced_track_keys(self) -> Set[str]:
+        """Returns the track_key() of every song in the read playlists."""
+        return {track_key(song)
+                for playlist in self.playlists
+                for song in playlist.songs or []
+                if not song.startswith('#')}
+
 
 class Resilio:
-    def __init__(self, sync_dir: str):
+    def __init__(self, sync_dir: str, options: Optional[Options] = None):
         self.sync_dir = true_path(sync_dir)
+        self.options = options or DEFAULT_OPTIONS
 
     def get_temp_directory(self):
         """Returns the Resilio directory that contains temporary downloads."""
@@ -391,168 +1310,2940 @@ class Resilio:
 
         sync_pattern = re.compile(r'!.sync$')
         for file in files:
-            print_if(f'Looking for sync pattern in {file}...')
+            print_if(f'Looking for sync pattern in {file}...', self.options)
             if re.search(sync_pattern, file):
-                print_if(f'Found sync pattern {file}')
+                print_if(f'Found sync pattern {file}', self.options)
                 return True
             else:
-                print_if(f'Not a sync pattern {file}')
+                print_if(f'Not a sync pattern {file}', self.options)
 
         return False
 
 
+def track_key(path: str) -> str:
+    """Returns a key identifying a track by its album directory and name.
+
+    This matches a track across the sync directories, the library and the
+    Windows paths in playlists, regardless of .flac or .m4a extension.
+    """
+    parts = path.replace('\\', '/').rstrip('/').split('/')
+    parts[-1] = os.path.splitext(parts[-1])[0]
+    return '/'.join(parts[-2:]).casefold()
+
+
+class ConversionJob:
+    """A flac file queued for conversion."""
+
+    def __init__(self, flac_path: str, alac_path: str,
+                 stat: Optional[os.stat_result] = None):
+        self.flac_path = flac_path
+        self.alac_path = alac_path
+        self.album_dir = os.path.dirname(flac_path)
+        # Set once a worker took the job, possibly along with others of its
+        # album, so it's skipped when it comes out of the queue later.
+        self.claimed = False
+        # From discovery if it already stat'ed the flac.
+        self._stat = stat
+        # (OutputProfile, path)s encoded along with the ALAC.
+        self.profile_outputs: List[tuple] = []
+        # Seconds of audio, read when loudness is measured.
+        self.duration = 0.0
+        # Encodes tried, retries included.
+        self.attempts = 0
+
+    def stat(self) -> os.stat_result:
+        if self._stat is None:
+            self._stat = os.stat(self.flac_path)
+        return self._stat
+
+
+class PriorityPolicy:
+    """Orders conversion jobs, jobs with lower keys are converted first."""
+
+    def prepare(self, jobs: List[ConversionJob]) -> None:
+        """Called with every job before any key is asked for."""
+        pass
+
+    def key(self, job: ConversionJob) -> Any:
+        return 0
+
+
+class PlaylistReferencedPolicy(PriorityPolicy):
+    """Converts tracks that are in playlists first."""
+
+    def __init__(self, referenced: Set[str]):
+        # Set of track_key()s.
+        self.referenced = referenced
+
+    def key(self, job: ConversionJob) -> Any:
+        return 0 if track_key(job.flac_path) in self.referenced else 1
+
+
+class SmallestAlbumPolicy(PriorityPolicy):
+    """Converts small albums first, keeping each album's tracks together."""
+
+    def __init__(self):
+        self.album_sizes: Dict[str, int] = {}
+
+    def prepare(self, jobs: List[ConversionJob]) -> None:
+        self.album_sizes = {}
+        for job in jobs:
+            self.album_sizes[job.album_dir] = (
+                self.album_sizes.get(job.album_dir, 0) + job.stat().st_size)
+
+    def key(self, job: ConversionJob) -> Any:
+        return (self.album_sizes.get(job.album_dir, 0), job.album_dir)
+
+
+class OldestArrivalPolicy(PriorityPolicy):
+    """Converts files in the order they arrived in the directory."""
+
+    def key(self, job: ConversionJob) -> Any:
+        # Creation time is when the file landed, where the filesystem keeps
+        # it (macOS, BSD). Elsewhere ctime is the closest, sync tools keep
+        # the source's mtime, but a chmod or rename also changes ctime.
+        stat = job.stat()
+        return getattr(stat, 'st_birthtime', stat.st_ctime)
+
+
+PRIORITY_POLICIES = ['playlist', 'smallest_album', 'oldest']
+
+
+def prioritize_jobs(jobs: List[ConversionJob],
+                    policies: List[PriorityPolicy]) -> List[tuple]:
+    """Returns sorted (priority, sequence, job) tuples for a PriorityQueue.
+
+    Later policies break ties of earlier ones and the order of jobs breaks
+    the remaining ties.
+    """
+    for policy in policies:
+        policy.prepare(jobs)
+    return sorted((tuple(policy.key(job) for policy in policies),
+                   sequence, job)
+                  for sequence, job in enumerate(jobs))
+
+
+def create_priority_policies(
+        names: List[str],
+        playlist_manager: Optional['PlaylistManager'] = None
+) -> List[PriorityPolicy]:
+    policies: List[PriorityPolicy] = []
+    for name in names:
+        if name == 'playlist':
+            if not playlist_manager:
+                print('No playlists to prioritize conversions with.')
+                continue
+            policies.append(PlaylistReferencedPolicy(
+                playlist_manager.referenced_track_keys()))
+        elif name == 'smallest_album':
+            policies.append(SmallestAlbumPolicy())
+        elif name == 'oldest':
+            policies.append(OldestArrivalPolicy())
+        else:
+            raise ValueError(f'Unknown priority policy {name}, expected one '
+                             f'of {PRIORITY_POLICIES}.')
+    return policies
+
+
+class TokenBucket:
+    """Limits throughput to rate bytes per second across threads."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: float) -> float:
+        """Takes amount tokens, sleeping off any debt. Returns the sleep."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Going into debt lets amounts larger than the bucket through,
+            # later callers wait for it to be paid back.
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+def file_size(path: str) -> int:
+    """Returns the size of path, or -1 if it doesn't exist."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return -1
+
+
+def run_watching_outputs(command: List[str],
+                         watch_paths: Iterable[str],
+                         stall_timeout: float,
+                         poll_interval: float = 1.0,
+                         **kwargs) -> subprocess.CompletedProcess:
+    """Runs command like subprocess.run, unless it stops making progress.
+
+    Progress is any of watch_paths changing size. If none of them changed
+    for stall_timeout seconds, e.g. the encoder hangs on a corrupt file or
+    a stalled network read, the process is killed and TimeoutExpired is
+    raised like subprocess.run does when its timeout runs out.
+    """
+    watch_paths = list(watch_paths)
+    if kwargs.pop('capture_output', False):
+        kwargs['stdout'] = kwargs['stderr'] = subprocess.PIPE
+    with subprocess.Popen(command, **kwargs) as process:
+        sizes = None
+        last_progress = time.monotonic()
+        while True:
+            try:
+                stdout, stderr = process.communicate(
+                    timeout=min(poll_interval, stall_timeout))
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            current = [file_size(path) for path in watch_paths]
+            if current != sizes:
+                sizes = current
+                last_progress = time.monotonic()
+            elif time.monotonic() - last_progress >= stall_timeout:
+                process.kill()
+                stdout, stderr = process.communicate()
+                raise subprocess.TimeoutExpired(command, stall_timeout,
+                                                output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(command, process.returncode, stdout,
+                                       stderr)
+
+
+class ResourceGovernor:
+    """Keeps background conversion from starving file serving on the host.
+
+    Child processes run with lower CPU and I/O priority, conversions are
+    only started as fast as a bandwidth limit allows and the worker pool
+    shrinks while the system is overloaded. The defaults don't change
+    anything.
+    """
+
+    def __init__(self,
+                 niceness: int = 0,
+                 idle_io: bool = False,
+                 bandwidth: float = 0,
+                 max_load: float = 0,
+                 max_iowait: float = 0,
+                 min_workers: int = 1,
+                 poll_interval: float = 5,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.niceness = niceness
+        self.idle_io = idle_io
+        # Bytes per second of conversions admitted, 0 is unlimited.
+        self.bucket = TokenBucket(bandwidth) if bandwidth > 0 else None
+        # 1 minute load average per CPU.
+        self.max_load = max_load
+        # Percent of CPU time spent waiting on I/O, Linux only.
+        self.max_iowait = max_iowait
+        # Workers allowed to keep going while overloaded, 0 pauses all.
+        self.min_workers = min_workers
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.overloaded = False
+        self.last_check = 0.0
+        self.last_cpu_times: Optional[List[int]] = None
+
+    @classmethod
+    def from_args(cls,
+                  args: argparse.Namespace,
+                  options: Optional[Options] = None) -> 'ResourceGovernor':
+        return cls(niceness=args.governor_nice,
+                   idle_io=args.governor_idle_io,
+                   bandwidth=args.governor_bandwidth_mb * 1024 * 1024,
+                   max_load=args.governor_max_load,
+                   max_iowait=args.governor_max_iowait,
+                   min_workers=args.governor_min_workers,
+                   options=options)
+
+    def wrap(self, command: List[str]) -> List[str]:
+        """Returns command prefixed to run at a lower priority."""
+        prefix = []
+        if self.niceness and os.name == 'posix' and self.options.tool('nice'):
+            prefix += ['nice', '-n', str(self.niceness)]
+        if self.idle_io:
+            if platform.system() == 'Linux' and self.options.tool('ionice'):
+                prefix += ['ionice', '-c', '3']
+            elif (platform.system() == 'Darwin' and
+                    self.options.tool('taskpolicy')):
+                # Background policy throttles both CPU and disk.
+                prefix += ['taskpolicy', '-b']
+            # FreeBSD has no per process I/O priority.
+        return prefix + command
+
+    def popen_kwargs(self) -> Dict[str, Any]:
+        if os.name == 'nt' and (self.niceness or self.idle_io):
+            return {'creationflags': subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+        return {}
+
+    def run(self,
+            command: List[str],
+            watch_paths: Iterable[str] = (),
+            stall_timeout: float = 0,
+            **kwargs) -> subprocess.CompletedProcess:
+        """Runs command at a lower priority, like subprocess.run.
+
+        With stall_timeout set it's killed once watch_paths stop growing,
+        see run_watching_outputs.
+        """
+        watch_paths = list(watch_paths)
+        if stall_timeout > 0 and watch_paths:
+            return run_watching_outputs(self.wrap(command), watch_paths,
+                                        stall_timeout,
+                                        **self.popen_kwargs(), **kwargs)
+        return subprocess.run(self.wrap(command),
+                              **self.popen_kwargs(), **kwargs)
+
+    def admit_io(self, num_bytes: int) -> None:
+        """Waits until num_bytes more of I/O fit the bandwidth limit.
+
+        This is an admission limit: the whole estimate is charged before a
+        conversion starts and nothing slows it down once it's running, so
+        it caps the average rate over many conversions, not bursts.
+        """
+        if self.bucket and num_bytes > 0:
+            if (delay := self.bucket.consume(num_bytes)) > 0:
+                print_if(f'Bandwidth limit, waited {delay:.1f}s...',
+                         self.options)
+
+    def read_iowait(self) -> Optional[float]:
+        """Returns percent of CPU time in iowait since the last call."""
+        try:
+            with open('/proc/stat', 'r') as f:
+                cpu_times = [int(t) for t in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        last_cpu_times, self.last_cpu_times = self.last_cpu_times, cpu_times
+        if not last_cpu_times or len(cpu_times) < 5:
+            return None
+        deltas = [now - last for now, last in zip(cpu_times, last_cpu_times)]
+        total = sum(deltas)
+        # user nice system idle iowait ...
+        return 100.0 * deltas[4] / total if total else None
+
+    def is_overloaded(self) -> bool:
+        if not self.max_load and not self.max_iowait:
+            return False
+        with self.lock:
+            if time.monotonic() - self.last_check < self.poll_interval:
+                return self.overloaded
+            self.last_check = time.monotonic()
+
+            overloaded = False
+            if self.max_load and hasattr(os, 'getloadavg'):
+                load = os.getloadavg()[0] / (os.cpu_count() or 1)
+                overloaded = load > self.max_load
+            if self.max_iowait:
+                iowait = self.read_iowait()
+                overloaded = overloaded or (iowait is not None and
+                                            iowait > self.max_iowait)
+            if overloaded != self.overloaded:
+                print('System overloaded, shrinking conversion workers...'
+                      if overloaded else
+                      'System load back to normal, resuming workers...')
+            self.overloaded = overloaded
+            return overloaded
+
+    def wait_for_capacity(self,
+                          worker_index: int,
+                          kill_event: threading.Event) -> None:
+        """Blocks worker_index while the system is overloaded."""
+        while (worker_index >= self.min_workers and self.is_overloaded() and
+               not kill_event.is_set()):
+            kill_event.wait(self.poll_interval)
+
+
+# https://man7.org/linux/man-pages/man2/ioctl_ficlone.2.html
+FICLONE = 0x40049409
+
+
+def reflink(source: str, destination: str) -> bool:
+    """Copy on write clones source to destination, if the filesystem can."""
+    if platform.system() != 'Linux':
+        return False
+    import fcntl
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+
+
+def link_or_copy(source: str, destination: str,
+                 hardlink: bool = False) -> str:
+    """Makes destination a reflink, hardlink or copy of source.
+
+    Returns which one it made.
+    """
+    if reflink(source, destination):
+        return 'reflink'
+    if hardlink:
+        try:
+            os.link(source, destination)
+            return 'hardlink'
+        except OSError:
+            pass
+    copyfile(source, destination)
+    return 'copy'
+
+
+class ConversionCache:
+    """ALACs keyed by the FLAC's audio MD5, tags and encoder settings.
+
+    The same release synced from different places decodes to the same
+    STREAMINFO MD5, so its ALAC can be reused instead of encoded again.
+    Entries are evicted least recently used first once the cache is over
+    max_size bytes.
+
+    Hardlinks are off by default since tags are edited in place, editing a
+    hardlinked ALAC would also change the cached one.
+    """
+
+    # Bump to invalidate every entry, e.g. when the encode command changes.
+    VERSION = 1
+
+    def __init__(self,
+                 cache_dir: str,
+                 max_size: int = 20 * 1024 ** 3,
+                 hardlink: bool = False,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hardlink = hardlink
+        self.lock = threading.Lock()
+        # Total size of the entries, counted on first use.
+        self.size: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, flac_path: str, settings: Iterable[str]) -> Optional[str]:
+        """Returns the cache key for flac_path, None if it can't be cached."""
+        try:
+            metadata = FlacMetadata(flac_path, digest_tags=True)
+            if not metadata.read() or not metadata.has_md5():
+                return None
+        except OSError:
+            return None
+        digest = hashlib.sha256()
+        digest.update(metadata.md5)
+        digest.update(metadata.tags_digest)
+        digest.update(json.dumps([ConversionCache.VERSION,
+                                  *settings]).encode())
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + '.m4a')
+
+    def entries(self) -> List[os.DirEntry]:
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for shard in os.scandir(self.cache_dir):
+            if shard.is_dir():
+                entries.extend(entry for entry in os.scandir(shard.path)
+                               if entry.name.endswith('.m4a'))
+        return entries
+
+    def fetch(self, key: str, alac_path: str) -> bool:
+        """Puts the cached ALAC for key at alac_path, if there is one."""
+        entry_path = self.entry_path(key)
+        try:
+            how = link_or_copy(entry_path, alac_path, hardlink=self.hardlink)
+            # Mark it as recently used for eviction.
+            os.utime(entry_path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        print_if(f'Reused cached {entry_path} for {alac_path} ({how}).',
+                 self.options)
+        return True
+
+    def store(self, key: str, alac_path: str) -> None:
+        entry_path = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # Link next to the entry and rename it so readers never see a
+        # partial entry.
+        temp_path = f'{entry_path}.{threading.get_ident()}.tmp'
+        try:
+            link_or_copy(alac_path, temp_path, hardlink=self.hardlink)
+            os.replace(temp_path, entry_path)
+        except OSError:
+            print(f'Couldn\'t cache {alac_path}...')
+            traceback.print_exc()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(entry.stat().st_size
+                                for entry in self.entries())
+            else:
+                self.size += os.path.getsize(entry_path)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self) -> None:
+        """Removes least recently used entries until under max_size."""
+        entries = sorted(self.entries(), key=lambda e: e.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.size <= self.max_size:
+                break
+            print_if(f'Evicting {entry.path} from the ALAC cache.',
+                     self.options)
+            self.size -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+class Quarantine:
+    """Flacs that kept failing to convert, skipped until they change.
+
+    Saved as JSON so a broken flac isn't converted again on every run. One
+    synced again (a new size or mtime) gets another chance.
+    """
+
+    def __init__(self,
+                 quarantine_file: Optional[str] = None,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.quarantine_file = quarantine_file
+        # Flac path -> {'size', 'mtime_ns', 'failures', 'stalls'}.
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.changed = False
+
+    def load(self) -> 'Quarantine':
+        if self.quarantine_file and os.path.exists(self.quarantine_file):
+            try:
+                with open(self.quarantine_file, 'r', encoding='utf8') as f:
+                    self.entries = json.load(f)['entries']
+            except (OSError, ValueError, KeyError):
+                print(f'Ignoring unreadable quarantine '
+                      f'{self.quarantine_file}.')
+                self.entries = {}
+        return self
+
+    def save(self) -> None:
+        if not self.quarantine_file or self.options.dry:
+            return
+        # Converters of several albums can share one.
+        with self.lock:
+            if not self.changed:
+                return
+            write_file_if_changed(self.quarantine_file, json.dumps(
+                {'entries': self.entries}, ensure_ascii=False,
+                indent=1).encode('utf8'))
+            self.changed = False
+
+    def contains(self, flac_path: str, stat: os.stat_result) -> bool:
+        with self.lock:
+            entry = self.entries.get(flac_path)
+            if not entry:
+                return False
+            if (entry['size'] == stat.st_size and
+                    entry['mtime_ns'] == stat.st_mtime_ns):
+                return True
+            # Changed since it failed.
+            del self.entries[flac_path]
+            self.changed = True
+            return False
+
+    def add(self, flac_path: str, stat: os.stat_result, failures: int,
+            stalls: int = 0) -> None:
+        print(f'Quarantining {flac_path} after {failures} failed attempts '
+              f'({stalls} stalled).')
+        with self.lock:
+            self.entries[flac_path] = {'size': stat.st_size,
+                                       'mtime_ns': stat.st_mtime_ns,
+                                       'failures': failures,
+                                       'stalls': stalls}
+            self.changed = True
+
+
+class OutputProfile:
+    """An extra copy, e.g. AAC for phones, encoded alongside the ALAC.
+
+    Its files mirror the flac directory under directory.
+    """
+
+    # Codec -> (ffmpeg encoder, extension).
+    CODECS = {'aac': ('aac', '.m4a'),
+              'opus': ('libopus', '.opus'),
+              'mp3': ('libmp3lame', '.mp3')}
+    # Containers ffmpeg can keep the cover art in.
+    COVER_ART_EXTENSIONS = ('.m4a', '.mp3')
+
+    def __init__(self, codec: str, bitrate: str, directory: str):
+        if codec not in OutputProfile.CODECS:
+            raise ValueError(f'Unknown codec {codec}, expected one of '
+                             f'{list(OutputProfile.CODECS)}.')
+        self.codec = codec
+        self.bitrate = bitrate
+        self.directory = true_path(directory)
+        self.encoder, self.extension = OutputProfile.CODECS[codec]
+
+    @classmethod
+    def parse(cls, spec: str) -> 'OutputProfile':
+        """Returns the profile for codec:bitrate:directory."""
+        parts = spec.split(':', 2)
+        if len(parts) != 3 or not all(parts):
+            raise ValueError(f'Expected codec:bitrate:directory, got {spec}.')
+        return cls(*parts)
+
+    def output_path(self, flac_path: str, input_dir: str) -> str:
+        relative = os.path.relpath(flac_path, input_dir)
+        return os.path.join(self.directory,
+                            os.path.splitext(relative)[0] + self.extension)
+
+    def output_args(self, index: int,
+                    extra_args: Iterable[str] = ()) -> List[str]:
+        """Returns ffmpeg output options encoding input index."""
+        args = ['-map', f'{index}:a', '-map_metadata', str(index)]
+        if self.extension in OutputProfile.COVER_ART_EXTENSIONS:
+            args += ['-map', f'{index}:v?', '-vcodec', 'copy']
+        else:
+            args += ['-vn']
+        return args + ['-acodec', self.encoder, '-b:a', self.bitrate,
+                       *extra_args]
+
+
+def profile_output_args(index: int,
+                        profile_outputs: Iterable[tuple],
+                        extra_args: Iterable[str] = ()) -> List[str]:
+    """Returns ffmpeg outputs for (OutputProfile, path) of input index."""
+    args: List[str] = []
+    for profile, path in profile_outputs:
+        args += [*profile.output_args(index, extra_args), path]
+    return args
+
+
+# ReplayGain 2.0 reference loudness.
+REPLAYGAIN_REFERENCE_LUFS = -18.0
+
+
+class Loudness:
+    """EBU R128 measurement of a track or an album."""
+
+    def __init__(self,
+                 integrated: float,
+                 true_peak: Optional[float] = None,
+                 duration: float = 0.0):
+        # LUFS.
+        self.integrated = integrated
+        # dBTP, None if it wasn't measured.
+        self.true_peak = true_peak
+        # Seconds, weighs the track in album_loudness.
+        self.duration = duration
+
+    @property
+    def gain(self) -> float:
+        """ReplayGain in dB."""
+        return REPLAYGAIN_REFERENCE_LUFS - self.integrated
+
+    @property
+    def peak(self) -> Optional[float]:
+        """Linear sample peak ReplayGain tags use, 1.0 is full scale."""
+        if self.true_peak is None:
+            return None
+        return 10 ** (self.true_peak / 20)
+
+    def replaygain_tags(self, prefix: str) -> Dict[str, str]:
+        tags = {f'replaygain_{prefix}_gain': f'{self.gain:.2f} dB'}
+        if self.peak is not None:
+            tags[f'replaygain_{prefix}_peak'] = f'{self.peak:.6f}'
+        return tags
+
+
+def album_loudness(tracks: List[Loudness]) -> Loudness:
+    """Returns the loudness of tracks played one after the other.
+
+    Track loudness is averaged as energy weighted by duration, so tracks
+    don't have to be decoded again as one stream. That's close to, but
+    not exactly, what R128 gating over the whole album would measure.
+    """
+    total = sum(track.duration for track in tracks)
+    weights = ([track.duration / total for track in tracks] if total > 0
+               else [1 / len(tracks)] * len(tracks))
+    energy = sum(weight * 10 ** (track.integrated / 10)
+                 for weight, track in zip(weights, tracks))
+    peaks = [track.true_peak for track in tracks
+             if track.true_peak is not None]
+    return Loudness(10 * math.log10(energy) if energy > 0 else -70.0,
+                    max(peaks) if peaks else None, total)
+
+
+def loudness_args(index: int) -> List[str]:
+    """Returns an ffmpeg output measuring the loudness of input index.
+
+    The filter is named after the input, parse_ebur128 reads its summary
+    from the log.
+    """
+    return ['-map', f'{index}:a',
+            '-filter:a', f'ebur128@track{index}=peak=true:framelog=verbose',
+            '-f', 'null', '-']
+
+
+EBUR128_SUMMARY = re.compile(
+    r'^\[ebur128@track(\d+) @ [^\]]*\] Summary:(.*?)(?=^\[|\Z)',
+    re.MULTILINE | re.DOTALL)
+EBUR128_INTEGRATED = re.compile(r'\bI:\s+(-?[\d.]+|-inf) LUFS')
+EBUR128_PEAK = re.compile(r'\bPeak:\s+(-?[\d.]+|-inf) dBFS')
+
+
+def parse_ebur128(stderr: str) -> Dict[int, Loudness]:
+    """Returns input index -> Loudness from loudness_args summaries."""
+    measurements = {}
+    for match in EBUR128_SUMMARY.finditer(stderr or ''):
+        integrated = EBUR128_INTEGRATED.search(match.group(2))
+        if not integrated:
+            continue
+        peak = EBUR128_PEAK.search(match.group(2))
+        measurements[int(match.group(1))] = Loudness(
+            float(integrated.group(1)),
+            float(peak.group(1)) if peak else None)
+    return measurements
+
+
+def encode_extra_outputs_command(
+        flac_path: str,
+        profile_outputs: Iterable[tuple],
+        extra_args: Iterable[str] = (),
+        analyze_loudness: bool = False,
+        options: Optional[Options] = None) -> List[str]:
+    """Returns the ffmpeg command encoding only the non-ALAC outputs."""
+    options = options or DEFAULT_OPTIONS
+    return ['ffmpeg',
+            '-v', 'info' if options.verbose or analyze_loudness else 'warning',
+            '-i', flac_path,
+            *profile_output_args(0, profile_outputs, extra_args),
+            *(loudness_args(0) if analyze_loudness else [])]
+
+
+def encode_alac_command(flac_path: str,
+                        alac_path: str,
+                        extra_args: Iterable[str] = (),
+                        profile_outputs: Iterable[tuple] = (),
+                        analyze_loudness: bool = False,
+                        options: Optional[Options] = None) -> List[str]:
+    """Returns the xld or ffmpeg command converting flac_path to alac_path.
+
+    extra_args are ffmpeg output options, e.g. -metadata genre=K-Pop.
+    ffmpeg also encodes each (OutputProfile, path) of profile_outputs and
+    measures loudness from the same decode, xld only writes the ALAC.
+    """
+    options = options or DEFAULT_OPTIONS
+    if options.xld_available:
+        # https://tmkk.undo.jp/xld/index_e.html
+        # This seems to get all the metadata and the coverart but it's
+        # OSX only...
+        # brew install xld
+        return ['xld', flac_path, '-f', 'alac', '-o', alac_path]
+
+    # Some metadata is lost doing this but using -movflags seems to
+    # make the metadata unrecognizable by foobar2000, iTunes, etc.
+    # https://unix.stackexchange.com/questions/415477/lossless-audio-conversion-from-flac-to-alac-using-ffmpeg
+    return ['ffmpeg',
+            # https://superuser.com/questions/326629/how-can-i-make-ffmpeg-be-quieter-less-verbose
+            # The loudness summary is logged at info.
+            '-v', 'info' if options.verbose or analyze_loudness else 'warning',
+            '-i', flac_path,  # input file
+            '-acodec', 'alac',  # 'force audio codec' to alac
+            '-vcodec', 'copy',  # 'force video codec' to copy stream
+            *extra_args,
+            alac_path,  # 'output file'
+            *profile_output_args(0, profile_outputs, extra_args),
+            *(loudness_args(0) if analyze_loudness else [])]
+
+
+def encode_alac_batch_command(items: List[tuple],
+                              analyze_loudness: bool = False,
+                              options: Optional[Options] = None) -> List[str]:
+    """Returns one ffmpeg command converting each (flac, alac, extra_args).
+
+    Every flac is its own input mapped to its own output, streams, tags and
+    chapters included, so nothing of one track ends up in another. Items
+    can have (OutputProfile, path)s as a fourth element, see
+    encode_alac_command.
+    """
+    options = options or DEFAULT_OPTIONS
+    command = ['ffmpeg', '-v',
+               'info' if options.verbose or analyze_loudness else 'warning']
+    for flac_path, *_ in items:
+        command += ['-i', flac_path]
+    for index, (_, alac_path, extra_args, *rest) in enumerate(items):
+        command += ['-map', f'{index}:a',
+                    # Cover art, if there is any.
+                    '-map', f'{index}:v?',
+                    '-map_metadata', str(index),
+                    '-map_chapters', str(index),
+                    '-acodec', 'alac',
+                    '-vcodec', 'copy',
+                    *extra_args,
+                    alac_path]
+        if rest:
+            command += profile_output_args(index, rest[0], extra_args)
+        if analyze_loudness:
+            command += loudness_args(index)
+    return command
+
+
+def put_unless_killed(work_queue: queue.Queue,
+                      item: Any,
+                      kill_event: threading.Event) -> bool:
+    """Puts item once there's room, returns False if killed first."""
+    while not kill_event.is_set():
+        try:
+            work_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class Prefetcher:
+    """Warms the page cache with the flacs next in a converter's queue.
+
+    On spinning disks and network volumes a new ffmpeg otherwise starts by
+    waiting on the flac to be read. Up to count unclaimed jobs are warmed
+    ahead of the workers, as long as the flacs warmed but not yet taken
+    stay under budget bytes. With posix_fadvise the kernel reads them in
+    the background, elsewhere they are read through once.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self,
+                 job_queue: queue.PriorityQueue,
+                 count: int,
+                 budget: int,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.job_queue = job_queue
+        self.count = count
+        self.budget = budget
+        # Flac path -> size, of flacs warmed but not claimed yet.
+        self.warmed: Dict[str, int] = {}
+        self.files = 0
+        self.bytes = 0
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def upcoming(self) -> List[ConversionJob]:
+        """Returns the next count unclaimed jobs, in queue order."""
+        # Peeking doesn't take anything from the workers. The copy is a
+        # heap too, so popping it gives the queue's order.
+        with self.job_queue.mutex:
+            heap = list(self.job_queue.queue)
+        jobs = []
+        while heap and len(jobs) < self.count:
+            _, _, job = heapq.heappop(heap)
+            if not job.claimed:
+                jobs.append(job)
+        return jobs
+
+    def warm(self, flac_path: str) -> None:
+        with open(flac_path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                return
+            while (f.read(self.CHUNK_SIZE) and
+                   not self.stop_event.is_set()):
+                pass
+
+    def prefetch(self) -> None:
+        """Warms upcoming jobs that fit in the budget."""
+        jobs = self.upcoming()
+        upcoming = {job.flac_path for job in jobs}
+        # Taken by a worker or pushed back, either way not ours anymore.
+        self.warmed = {flac_path: size for flac_path, size
+                       in self.warmed.items() if flac_path in upcoming}
+        for job in jobs:
+            if job.flac_path in self.warmed:
+                continue
+            try:
+                size = job.stat().st_size
+                if sum(self.warmed.values()) + size > self.budget:
+                    break
+                self.warm(job.flac_path)
+            except OSError as e:
+                print_if(f'Failed prefetching {job.flac_path}: {e}',
+                         self.options)
+                continue
+            self.warmed[job.flac_path] = size
+            self.files += 1
+            self.bytes += size
+
+    def wake(self) -> None:
+        """Called when a worker took jobs, so more can be warmed."""
+        self.wake_event.set()
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            self.prefetch()
+            self.wake_event.wait(1)
+            self.wake_event.clear()
+
+    def start(self) -> 'Prefetcher':
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread:
+            self.thread.join()
+        print_if(f'Prefetched {self.files} flacs '
+                 f'({self.bytes / 1024 ** 2:.1f} MB).', self.options)
+
+
 class FlacToAlacConverter:
     def __init__(self,
                  input_dir: str,
                  overwrite_output: bool,
                  delete_original: bool,
-                 num_threads: int = 4):
+                 num_threads: int = 4,
+                 genre_rules: Optional['GenreRules'] = None,
+                 verify: bool = False,
+                 priority_policies: Optional[List[PriorityPolicy]] = None,
+                 governor: Optional[ResourceGovernor] = None,
+                 cache: Optional[ConversionCache] = None,
+                 trash_cleaner: Optional[TrashCleaner] = None,
+                 backend: Optional['Backend'] = None,
+                 batch_size: int = 1,
+                 profiles: Optional[List[OutputProfile]] = None,
+                 analyze_loudness: bool = False,
+                 output_dir: Optional[str] = None,
+                 prefetch: int = 0,
+                 prefetch_budget: int = 256 * 1024 ** 2,
+                 max_attempts: int = 1,
+                 retry_backoff: float = 5,
+                 quarantine: Optional[Quarantine] = None,
+                 profile_root: Optional[str] = None,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.governor = governor or ResourceGovernor(options=self.options)
+        self.backend = backend or CommandBackend(governor=self.governor,
+                                                 options=self.options)
+        # Up to this many flacs of an album are handed to the backend at
+        # once.
+        self.batch_size = max(1, batch_size)
+        # Extra copies encoded from the same decode as each ALAC, at the
+        # flac's path relative to profile_root (input_dir by default).
+        self.profiles = profiles or []
+        self.profile_root = true_path(profile_root)
+        # If set, loudness is measured while encoding and ReplayGain tags
+        # are written once every job of an album is done.
+        self.analyze_loudness = analyze_loudness
+        # Flac path -> Loudness of the converted ALAC.
+        self.measurements: Dict[str, Loudness] = {}
+        # Album directory -> jobs not done yet.
+        self.album_remaining: Dict[str, int] = {}
+        # Album directory -> its jobs, in queue order.
+        self.album_jobs: Dict[str, List[ConversionJob]] = {}
+        self.claim_lock = threading.Lock()
+        self.started = 0
+        # Pass one in to keep it between runs, so only directories that
+        # changed are listed again.
+        self.trash_cleaner = trash_cleaner or TrashCleaner(
+            options=self.options)
+        # If set, ALACs of flacs that were converted before are reused.
+        self.cache = cache
+        # A flac is encoded up to max_attempts times, waiting retry_backoff
+        # seconds before the second attempt and twice as long each time
+        # after that.
+        self.max_attempts = max(1, max_attempts)
+        self.retry_backoff = retry_backoff
+        # If set, flacs that failed every attempt are skipped from then on.
+        self.quarantine = quarantine
         self.input_dir = true_path(input_dir)
-        self.flacs = []
-        self.queue = queue.Queue()
+        # If set, ALACs are written here, mirroring input_dir, instead of
+        # next to their flacs.
+        self.output_dir = true_path(output_dir)
+        # Set by read(). If write() is called without it, flacs are queued
+        # as they're found instead.
+        self.flacs: Optional[List[str]] = None
+        # Flac path -> stat from discovery.
+        self.flac_stats: Dict[str, os.stat_result] = {}
+        self.queue = queue.PriorityQueue()
+        # If set, this many queued flacs (up to prefetch_budget bytes) are
+        # read ahead of the workers.
+        self.prefetch = prefetch
+        self.prefetch_budget = prefetch_budget
+        self.prefetcher: Optional[Prefetcher] = None
+        # Applied in order, later policies break ties of earlier ones and
+        # discovery order breaks the remaining ties.
+        self.priority_policies = priority_policies or []
         self.threads = []
         self.thread_kill_event = threading.Event()
+        # Set once every job is queued, workers exit when it's set and the
+        # queue is empty.
+        self.discovered = threading.Event()
         self.overwrite_output = overwrite_output
         self.delete_original = delete_original
         self.num_threads = num_threads
+        # If set, genres are normalized while encoding instead of afterwards.
+        self.genre_rules = genre_rules
+        # If set, the decoded ALAC has to match the FLAC's STREAMINFO MD5
+        # before the original is deleted.
+        self.verify = verify
+        # Flac files that failed to convert or verify.
+        self.failed: List[str] = []
+        # Flac files whose ALACs were converted (and verified if asked).
+        self.finished: List[str] = []
 
     def read(self):
-        print_if(f'Finding files recursive for: {self.input_dir}')
+        print_if(f'Finding files recursive for: {self.input_dir}',
+                 self.options)
 
         # Clean up trash first...
-        delete_some_trash(self.input_dir)
+        self.trash_cleaner.clean(self.input_dir)
 
-        flac_files = find_flac_files(self.input_dir)
+        # Stat'ed while listing, priority policies and the bandwidth limit
+        # need the sizes anyway.
+        entries = scan_files(self.input_dir, ('.flac',), stat=True,
+                             options=self.options)
+        self.flac_stats = {entry.path: entry.stat() for entry in entries}
+        flac_files = [entry.path for entry in entries]
 
-        print_separator()
-        print_if(f'# of Flac files to convert: {len(flac_files)}')
-        print_if(f'Flac files to convert: {flac_files}')
-        print_separator()
+        print_separator(self.options)
+        print_if(f'# of Flac files to convert: {len(flac_files)}',
+                 self.options)
+        print_if(f'Flac files to convert: {flac_files}', self.options)
+        print_separator(self.options)
 
         self.flacs = flac_files
 
-    def convert_worker(self):
+    def genre_metadata_args(self, flac_path: str) -> List[str]:
+        """Returns ffmpeg arguments setting the normalized genre, if any."""
+        if not self.genre_rules:
+            return []
+
+        try:
+            metadata = FlacMetadata(flac_path)
+            if not metadata.read():
+                return []
+        except OSError:
+            traceback.print_exc()
+            return []
+
+        genre = metadata.get_genre()
+        appropriate_genre = self.genre_rules.normalize(genre)
+        if not appropriate_genre or genre == appropriate_genre:
+            return []
+
+        print_if(f'{flac_path}: genre {genre} -> {appropriate_genre}',
+                 self.options)
+        return ['-metadata', f'genre={appropriate_genre}']
+
+    def verify_alac(self, flac_path: str,
+                    alac_path: str) -> Optional[bool]:
+        """Returns whether alac_path decodes to the same audio as flac_path.
+
+        Only the ALAC is decoded, it's compared against the MD5 the FLAC
+        encoder already stored in STREAMINFO. Returns None if there's
+        nothing to compare against, e.g. the encoder didn't store an MD5.
+        """
+        metadata = FlacMetadata(flac_path)
+        if not metadata.read():
+            print(f'{flac_path} isn\'t a flac, can\'t verify.')
+            return False
+        if not metadata.has_md5():
+            print(f'{flac_path} has no STREAMINFO MD5, can\'t verify.')
+            return None
+
+        # The FLAC MD5 is over interleaved, little endian, signed samples.
+        pcm_codecs = {8: 'pcm_s8', 16: 'pcm_s16le', 24: 'pcm_s24le',
+                      32: 'pcm_s32le'}
+        pcm_codec = pcm_codecs.get(metadata.bits_per_sample)
+        if not pcm_codec:
+            print(f'{flac_path}: can\'t verify '
+                  f'{metadata.bits_per_sample} bit audio.')
+            return None
+
+        md5 = self.backend.decode_md5(alac_path, pcm_codec)
+        if md5 is None:
+            return False
+
+        if md5 != metadata.md5.hex():
+            print(f'{alac_path} doesn\'t match {flac_path}: '
+                  f'{md5} != {metadata.md5.hex()}')
+            return False
+
+        print_if(f'Verified {alac_path} against {flac_path}.', self.options)
+        return True
+
+    def alac_path(self, flac_path: str) -> str:
+        if not self.output_dir:
+            return alac_path_from_flac_path(flac_path=flac_path)
+        return alac_path_from_flac_path(os.path.join(
+            self.output_dir, os.path.relpath(flac_path, self.input_dir)))
+
+    def prepare_output(self, job: ConversionJob) -> bool:
+        """Returns whether job should be converted, given its output."""
+        if self.output_dir:
+            os.makedirs(os.path.dirname(job.alac_path), exist_ok=True)
+        if os.path.exists(job.alac_path):
+            if self.overwrite_output:
+                print_if(f'{job.alac_path} exists... deleting first...',
+                         self.options)
+                os.remove(job.alac_path)
+            else:
+                print_if(f'{job.alac_path} already exists... skipping...',
+                         self.options)
+                return False
+        return True
+
+    def prepare_profile_outputs(self, job: ConversionJob) -> None:
+        """Sets the profile outputs job still has to encode."""
+        job.profile_outputs = []
+        for profile in self.profiles:
+            path = profile.output_path(job.flac_path,
+                                       self.profile_root or self.input_dir)
+            if os.path.exists(path):
+                if not self.overwrite_output:
+                    continue
+                os.remove(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            job.profile_outputs.append((profile, path))
+
+    def remove_profile_outputs(self, job: ConversionJob) -> None:
+        remove_files(path for _, path in job.profile_outputs)
+
+    def remove_outputs(self, job: ConversionJob) -> None:
+        remove_files([job.alac_path,
+                      *(path for _, path in job.profile_outputs)])
+
+    def finish_job(self, job: ConversionJob) -> bool:
+        """Verifies an encoded job and deletes its original if asked to."""
+        flac_path, alac_path = job.flac_path, job.alac_path
+        verified: Optional[bool] = True
+        if self.verify:
+            verified = self.verify_alac(flac_path, alac_path)
+        if verified is None:
+            # Nothing says the ALAC is bad, but nothing says it's good
+            # either, so keep both.
+            print(f'Keeping {flac_path} next to its unverified ALAC.')
+            return True
+        if not verified:
+            # Don't leave a bad ALAC around to be picked up by iTunes.
+            print(f'Removing unverified {alac_path}...')
+            os.remove(alac_path)
+            self.remove_profile_outputs(job)
+            self.failed.append(flac_path)
+            return False
+
+        self.finished.append(flac_path)
+        # Should we try deleting even if we potentially skip converting?
+        if self.delete_original:
+            print_if(f'Deleting {flac_path}...', self.options)
+            os.remove(flac_path)
+        return True
+
+    def convert_worker(self, worker_index: int = 0):
         while not self.thread_kill_event.is_set():
+            self.governor.wait_for_capacity(worker_index,
+                                            self.thread_kill_event)
             try:
-                flac_path, alac_path = self.queue.get_nowait()
-            except Exception:
+                _, _, job = self.queue.get(timeout=0.1)
+            except queue.Empty:
                 # Loop exits here when all threads exhaust self.queue.
-                print('Exiting worker thread...')
-                break
+                if self.discovered.is_set() and self.queue.empty():
+                    print('Exiting worker thread...')
+                    break
+                continue
 
-            print_separator()
-            if os.path.exists(alac_path):
-                if self.overwrite_output:
-                    print_if(f'{alac_path} exists... deleting first...')
-                    os.remove(alac_path)
-                else:
-                    print_if(f'{alac_path} already exists... skipping...')
-                    continue
+            jobs = self.claim_batch(job)
+            if jobs and self.prefetcher:
+                self.prefetcher.wake()
+            if jobs:
+                self.convert_jobs(jobs)
+
+    def claim_batch(self, job: ConversionJob) -> List[ConversionJob]:
+        """Claims job and up to batch_size - 1 other jobs of its album.
+
+        Returns [] if another worker already claimed job in its batch.
+        """
+        with self.claim_lock:
+            if job.claimed:
+                return []
+            job.claimed = True
+            jobs = [job]
+            for other in self.album_jobs.get(job.album_dir, []):
+                if len(jobs) >= self.batch_size:
+                    break
+                if not other.claimed:
+                    other.claimed = True
+                    jobs.append(other)
+            return jobs
+
+    def convert_jobs(self, jobs: List[ConversionJob]) -> None:
+        """Converts jobs, all of the same album, with one backend call."""
+        try:
+            self.encode_jobs(jobs)
+        finally:
+            for job in jobs:
+                self.job_done(job)
+
+    def encode_jobs(self, jobs: List[ConversionJob]) -> None:
+        # (job, extra_args, cache_key) still left to encode.
+        pending = []
+        for job in jobs:
+            flac_path, alac_path = job.flac_path, job.alac_path
+            print_separator(self.options)
+            if not self.prepare_output(job):
+                continue
 
-            print('Converting file {} of {}'.format(
-                self.total_queue_size - self.queue.qsize(),
-                self.total_queue_size), flush=True)
+            with self.claim_lock:
+                self.started += 1
+                started = self.started
+            print(f'Converting file {started} of {self.total_queue_size}',
+                  flush=True)
             print('From:', flac_path)
             print('To:', alac_path)
-            print_separator()
-
-            if XLD_AVAILABLE:
-                # https://tmkk.undo.jp/xld/index_e.html
-                # This seems to get all the metadata and the coverart but it's
-                # OSX only...
-                # brew install xld
-                process = subprocess.run(
-                    ['xld', flac_path, '-f', 'alac', '-o', alac_path],
-                    capture_output=True, text=True)
-            else:
-                # Some metadata is lost doing this but using -movflags seems to
-                # make the metadata unrecognizable by foobar2000, iTunes, etc.
-                process = subprocess.run(
-                    # https://unix.stackexchange.com/questions/415477/lossless-audio-conversion-from-flac-to-alac-using-ffmpeg
-                    ['ffmpeg',
-                     # https://superuser.com/questions/326629/how-can-i-make-ffmpeg-be-quieter-less-verbose
-                     '-v', 'info' if VERBOSE else 'warning',
-                     '-i', flac_path,  # input file
-                     '-acodec', 'alac',  # 'force audio codec' to alac
-                     '-vcodec', 'copy',  # 'force video codec' to copy stream
-                     alac_path],  # 'output file'
-                    # https://stackoverflow.com/questions/41171791/how-to-suppress-or-capture-the-output-of-subprocess-run
-                    capture_output=True, text=True)
-
-            prefix = 'xld' if XLD_AVAILABLE else 'ffmpeg'
-            print_process_output(process, prefix=prefix)
-            print_separator()
-
-            # Should we try deleting even if we potentially skip converting?
-            if self.delete_original:
-                print_if(f'Deleting {flac_path}...')
-                os.remove(flac_path)
+            print_separator(self.options)
+
+            extra_args = self.genre_metadata_args(flac_path)
+            self.prepare_profile_outputs(job)
+            cache_key = None
+            # Profile outputs and loudness need the decode anyway.
+            if (self.cache and not job.profile_outputs and
+                    not self.analyze_loudness):
+                cache_key = self.cache.key(flac_path,
+                                           self.encoder_settings(extra_args))
+                if cache_key and self.cache.fetch(cache_key, alac_path):
+                    print(f'Reused cached ALAC for {flac_path}.')
+                    self.finish_job(job)
+                    continue
+            pending.append((job, extra_args, cache_key))
+
+        if not pending:
+            return
+
+        # The flacs are read and about as much ALAC is written.
+        self.governor.admit_io(
+            2 * sum(job.stat().st_size for job, _, _ in pending))
+
+        measured: Optional[Dict[str, Loudness]] = None
+        if self.analyze_loudness:
+            measured = {}
+            for job, _, _ in pending:
+                # The flac may be deleted by the time the album is done.
+                job.duration = flac_duration(job.flac_path)
+
+        items = [(job.flac_path, job.alac_path, extra_args,
+                  job.profile_outputs)
+                 for job, extra_args, _ in pending]
+        # Flac path -> encodes it took, if a failed batch was retried.
+        attempts: Dict[str, int] = {}
+        if len(items) == 1:
+            results = [self.backend.encode(*items[0], loudness=measured)]
+        else:
+            results = self.backend.encode_batch(items, loudness=measured,
+                                                attempts=attempts)
+        for job, _, _ in pending:
+            job.attempts = attempts.get(job.flac_path, 1)
+
+        for (job, _, cache_key), item, encoded in zip(pending, items, results):
+            if not encoded:
+                encoded = self.retry_encode(job, item, measured)
+            if not encoded:
+                # A partial ALAC mustn't be taken for a converted one.
+                self.remove_outputs(job)
+                self.failed.append(job.flac_path)
+                self.quarantine_job(job)
+                continue
+            if not self.finish_job(job):
+                continue
+            if cache_key:
+                self.cache.store(cache_key, job.alac_path)
+            if measured and job.flac_path in measured:
+                measured[job.flac_path].duration = job.duration
+                with self.claim_lock:
+                    self.measurements[job.flac_path] = (
+                        measured[job.flac_path])
+
+    def retry_encode(self, job: ConversionJob, item: tuple,
+                     loudness: Optional[Dict[str, Loudness]]) -> bool:
+        """Encodes a failed job again until max_attempts, backing off."""
+        while job.attempts < self.max_attempts:
+            delay = self.retry_backoff * 2 ** (job.attempts - 1)
+            print(f'Retrying {job.flac_path} in {delay:g}s (attempt '
+                  f'{job.attempts + 1} of {self.max_attempts})...')
+            if self.thread_kill_event.wait(delay):
+                return False
+            self.remove_outputs(job)
+            job.attempts += 1
+            if self.backend.encode(*item, loudness=loudness):
+                return True
+        return False
+
+    def quarantine_job(self, job: ConversionJob) -> None:
+        """Quarantines job's flac if every attempt failed."""
+        if (not self.quarantine or self.thread_kill_event.is_set() or
+                job.attempts < self.max_attempts):
+            return
+        try:
+            stat = os.stat(job.flac_path)
+        except OSError:
+            return
+        self.quarantine.add(
+            job.flac_path, stat, job.attempts,
+            stalls=self.backend.stall_counts().get(job.flac_path, 0))
+
+    def quarantined(self, job: ConversionJob) -> bool:
+        if not self.quarantine:
+            return False
+        try:
+            if not self.quarantine.contains(job.flac_path, job.stat()):
+                return False
+        except OSError:
+            return False
+        print(f'Skipping quarantined {job.flac_path}.')
+        return True
+
+    def job_done(self, job: ConversionJob) -> None:
+        """Tags album gain once the last job of job's album is done."""
+        with self.claim_lock:
+            self.album_remaining[job.album_dir] -= 1
+            if self.album_remaining[job.album_dir] > 0:
+                return
+        if self.analyze_loudness:
+            self.write_replaygain(job.album_dir)
+        # Done albums are forgotten, so a streamed library doesn't pile up.
+        with self.claim_lock:
+            for album_job in self.album_jobs.pop(job.album_dir, []):
+                self.measurements.pop(album_job.flac_path, None)
+            del self.album_remaining[job.album_dir]
+
+    def write_replaygain(self, album_dir: str) -> None:
+        """Writes ReplayGain tags to the ALACs of album_dir."""
+        album_jobs = self.album_jobs.get(album_dir, [])
+        with self.claim_lock:
+            measured = [(job, self.measurements[job.flac_path])
+                        for job in album_jobs
+                        if job.flac_path in self.measurements]
+        if not measured:
+            return
+
+        tags: Dict[str, str] = {}
+        # Album gain of some of the tracks would be wrong for all of them.
+        if len(measured) == len(album_jobs):
+            tags = album_loudness(
+                [loudness for _, loudness in measured]).replaygain_tags(
+                    'album')
+        else:
+            print(f'{album_dir}: only {len(measured)} of {len(album_jobs)}'
+                  ' tracks were measured, skipping album gain.')
+
+        for job, loudness in measured:
+            try:
+                tagger = Mp4Tagger(job.alac_path, options=self.options).read()
+                for name, value in {**loudness.replaygain_tags('track'),
+                                    **tags}.items():
+                    tagger.set_freeform(name, value)
+                tagger.save()
+            except (OSError, ValueError):
+                print(f'Failed writing ReplayGain tags to {job.alac_path}.')
+                traceback.print_exc()
+                continue
+            print_if(f'{job.alac_path}: track gain {loudness.gain:.2f} dB',
+                     self.options)
+
+    def encoder_settings(self, extra_args: List[str]) -> List[str]:
+        """Returns what, besides the flac, decides the encoded ALAC."""
+        return [self.backend.name, *extra_args]
+
+    def enqueue_jobs(self) -> None:
+        """Queues a job per flac, ordered by the priority policies."""
+        jobs = [ConversionJob(flac_path, self.alac_path(flac_path),
+                              stat=self.flac_stats.get(flac_path))
+                for flac_path in self.flacs]
+        jobs = [job for job in jobs if not self.quarantined(job)]
+        self.album_jobs = {}
+        for item in prioritize_jobs(jobs, self.priority_policies):
+            self.album_jobs.setdefault(item[2].album_dir, []).append(item[2])
+            self.queue.put(item)
+        self.album_remaining = {album_dir: len(album_jobs) for album_dir,
+                                album_jobs in self.album_jobs.items()}
+        self.measurements = {}
+        self.total_queue_size = self.queue.qsize()
+        self.started = 0
+        self.discovered.set()
+
+    def discover_jobs(self) -> None:
+        """Queues a job per flac under input_dir as directories are listed.
+
+        The queue is bounded, so this waits for the workers whenever it's
+        discovery_queue_size jobs ahead of them. Jobs of a directory are
+        registered together, so batches and album gain see the whole album.
+        """
+        found = 0
+        directories = iter_directory_files(self.input_dir, ('.flac',),
+                                           stat=True, options=self.options)
+        try:
+            for entries in directories:
+                jobs = [ConversionJob(entry.path, self.alac_path(entry.path),
+                                      stat=entry.stat())
+                        for entry in entries]
+                jobs = [job for job in jobs if not self.quarantined(job)]
+                if not jobs:
+                    continue
+                with self.claim_lock:
+                    self.album_jobs[jobs[0].album_dir] = jobs
+                    self.album_remaining[jobs[0].album_dir] = len(jobs)
+                    self.total_queue_size += len(jobs)
+                print_if(f'Found {len(jobs)} flac files in '
+                         f'{jobs[0].album_dir}', self.options)
+                for job in jobs:
+                    if not put_unless_killed(self.queue, ((), found, job),
+                                             self.thread_kill_event):
+                        return
+                    found += 1
+        finally:
+            directories.close()
+            self.discovered.set()
+            print_if(f'# of Flac files found: {found}', self.options)
 
     def write(self):
-        if len(self.flacs) == 0:
-            print_if('No flacs to convert... skipping.')
+        """Converts the flacs found by read().
+
+        If read() wasn't called, the flacs are converted while input_dir is
+        still being searched, unless priority policies need all of them.
+        """
+        if self.flacs is None and self.priority_policies:
+            self.read()
+        if self.flacs is not None and len(self.flacs) == 0:
+            print_if('No flacs to convert... skipping.', self.options)
             return
-        for flac_path in self.flacs:
-            alac_path = alac_path_from_flac_path(flac_path=flac_path)
-            self.queue.put((flac_path, alac_path))
-            self.total_queue_size = self.queue.qsize()
-        for i in range(self.num_threads):
-            thread = threading.Thread(target=self.convert_worker)
-            thread.start()
-            self.threads.append(thread)
-        for thread in self.threads:
-            thread.join()
+        self.threads = []
+        self.failed = []
+        self.discovered.clear()
+        discovery = None
+        if self.flacs is None:
+            self.trash_cleaner.clean(self.input_dir)
+            self.queue = queue.PriorityQueue(
+                maxsize=max(1, self.options.discovery_queue_size))
+            self.album_jobs = {}
+            self.album_remaining = {}
+            self.measurements = {}
+            self.total_queue_size = 0
+            self.started = 0
+            discovery = threading.Thread(target=self.discover_jobs)
+            discovery.start()
+        else:
+            self.enqueue_jobs()
+        if self.prefetch > 0:
+            self.prefetcher = Prefetcher(self.queue, self.prefetch,
+                                         self.prefetch_budget,
+                                         options=self.options).start()
+        try:
+            for i in range(self.num_threads):
+                thread = threading.Thread(target=self.convert_worker,
+                                          args=(i,))
+                thread.start()
+                self.threads.append(thread)
+            for thread in self.threads:
+                thread.join()
+        except BaseException:
+            # E.g. ^C, discovery stops waiting for room in the queue.
+            self.thread_kill_event.set()
+            raise
+        finally:
+            if discovery:
+                discovery.join()
+            if self.prefetcher:
+                self.prefetcher.stop()
+                self.prefetcher = None
+
+        if self.failed:
+            print(f'{len(self.failed)} flac files failed to convert: '
+                  f'{self.failed}')
+        stalls = self.backend.stall_counts()
+        if stalls:
+            print(f'Killed {sum(stalls.values())} stalled encodes of '
+                  f'{len(stalls)} flac files: {stalls}')
+        stalled_batches = self.backend.stalled_batches()
+        if stalled_batches:
+            print(f'Killed {stalled_batches} stalled batches.')
+        if self.quarantine:
+            self.quarantine.save()
+        if self.cache:
+            print(f'ALAC cache: {self.cache.hits} hits, '
+                  f'{self.cache.misses} misses.')
+
+
+# Headers are small JSON, anything bigger isn't from a FarmWorker.
+FARM_MAX_HEADER_SIZE = 1024 * 1024
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1024 * 1024))
+        if not chunk:
+            raise ConnectionError('Connection closed mid message.')
+        data += chunk
+    return bytes(data)
+
+
+def message_mac(secret: str, header: Dict[str, Any], payload: bytes) -> str:
+    """Returns the HMAC of a message's header (minus its mac) and payload."""
+    signed = json.dumps({key: value for key, value in header.items()
+                         if key != 'mac'}, sort_keys=True).encode()
+    return hmac.new(secret.encode(), len(signed).to_bytes(4, 'big') +
+                    signed + payload, hashlib.sha256).hexdigest()
+
+
+def send_message(sock: socket.socket,
+                 header: Dict[str, Any],
+                 payload: bytes = b'',
+                 secret: str = '') -> None:
+    """Sends a 4 byte length, a JSON header and then payload.
+
+    The header carries an HMAC of the message keyed with secret, so only
+    someone knowing the secret can send messages recv_message accepts.
+    """
+    header = {**header, 'payload_size': len(payload)}
+    header['mac'] = message_mac(secret, header, payload)
+    encoded = json.dumps(header).encode()
+    sock.sendall(len(encoded).to_bytes(4, 'big') + encoded)
+    if payload:
+        sock.sendall(payload)
+
+
+def recv_message(sock: socket.socket, secret: str = '') -> tuple:
+    """Returns (header, payload) sent by send_message with secret.
+
+    Raises ValueError if the message wasn't signed with secret.
+    """
+    size = int.from_bytes(recv_exactly(sock, 4), 'big')
+    if size > FARM_MAX_HEADER_SIZE:
+        raise ValueError(f'Farm header of {size} bytes is too large.')
+    header = json.loads(recv_exactly(sock, size))
+    if not isinstance(header, dict):
+        raise ValueError('Farm header isn\'t a JSON object.')
+    payload = recv_exactly(sock, header.get('payload_size', 0))
+    if not hmac.compare_digest(str(header.get('mac', '')),
+                               message_mac(secret, header, payload)):
+        raise ValueError('Farm message isn\'t signed with the farm secret.')
+    return header, payload
+
+
+def parse_address(address: str) -> tuple:
+    """Returns (host, port) for host:port, the host defaults to localhost."""
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def farm_metadata_args(extra_args: Any) -> List[str]:
+    """Returns extra_args if they're only -metadata key=value pairs.
+
+    Workers pass them to the encoder, so anything else (another output,
+    a filter, ...) from a coordinator is refused with ValueError.
+    """
+    if not isinstance(extra_args, list) or len(extra_args) % 2:
+        raise ValueError(f'Unexpected encoder arguments {extra_args!r}.')
+    for option, value in zip(extra_args[::2], extra_args[1::2]):
+        if (option != '-metadata' or not isinstance(value, str) or
+                not re.fullmatch(r'[A-Za-z0-9_ -]+=[^\r\n]*', value)):
+            raise ValueError(f'Unexpected encoder arguments {extra_args!r}.')
+    return extra_args
+
+
+class FarmServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FarmLease:
+    def __init__(self, item: tuple, worker: str, deadline: float):
+        # (priority, sequence, job) as it was queued.
+        self.item = item
+        self.worker = worker
+        self.deadline = deadline
+
+
+class FarmCoordinator:
+    """Hands a FlacToAlacConverter's jobs out to FarmWorkers over TCP.
+
+    Workers pull a job at a time and hold a lease on it, a job whose lease
+    runs out (a dead or wedged worker) goes back on the queue. Failed jobs
+    are retried up to max_attempts. Finished ALACs go through the
+    converter's verification and original deletion as if encoded locally.
+
+    Every message is signed with the shared secret and unsigned ones are
+    dropped. Originals are only deleted once the ALAC a worker sent back
+    verifies against the flac.
+
+    Each request is one connection carrying one message each way:
+
+    - lease -> job (with the flac bytes unless shared_paths), wait or done
+    - renew -> ack, extends a lease while a long encode is running
+    - result -> ack, with the ALAC bytes unless shared_paths
+    """
+
+    def __init__(self,
+                 converter: FlacToAlacConverter,
+                 secret: str,
+                 address: str = '127.0.0.1:8765',
+                 lease_timeout: float = 600,
+                 max_attempts: int = 3,
+                 shared_paths: bool = False,
+                 options: Optional[Options] = None):
+        if not secret:
+            raise ValueError('A farm secret is required.')
+        self.options = options or DEFAULT_OPTIONS
+        self.converter = converter
+        # ALACs come from other machines, so they're never trusted enough
+        # to delete an original without decoding them.
+        self.converter.verify = True
+        self.secret = secret
+        self.address = parse_address(address)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        # If set, workers read and write the music directory themselves,
+        # e.g. over NFS/SMB mounted at the same path.
+        self.shared_paths = shared_paths
+        self.lock = threading.Lock()
+        self.done_event = threading.Event()
+        self.leases: Dict[int, FarmLease] = {}
+        self.attempts: Dict[int, int] = {}
+        # job id -> {'ok', 'worker', 'attempts', 'error'}.
+        self.results: Dict[int, Dict[str, Any]] = {}
+        self.server = None
+        self.server_thread = None
+
+    @property
+    def server_address(self) -> tuple:
+        return self.server.server_address
+
+    def start(self) -> None:
+        self.converter.failed = []
+        self.converter.enqueue_jobs()
+        self.jobs_left = self.converter.total_queue_size
+        if self.jobs_left == 0:
+            self.done_event.set()
+
+        coordinator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                coordinator.handle(self.request)
+
+        self.server = FarmServer(self.address, Handler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever,
+                                              daemon=True)
+        self.server_thread.start()
+        print(f'Farm coordinator listening on {self.server_address} with '
+              f'{self.jobs_left} jobs.')
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.done_event.wait(timeout)
+
+    def stop(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def run(self) -> None:
+        self.start()
+        try:
+            while not self.wait(timeout=self.lease_timeout):
+                with self.lock:
+                    self.expire_leases()
+        finally:
+            self.stop()
+        self.report()
+
+    def report(self) -> None:
+        done = sum(1 for r in self.results.values() if r['worker'] and
+                   r['ok'])
+        print(f'Farm converted {done} of {len(self.results)} flacs.')
+        if self.converter.failed:
+            print(f'{len(self.converter.failed)} flac files failed to '
+                  f'convert: {self.converter.failed}')
+
+    def handle(self, sock: socket.socket) -> None:
+        try:
+            header, payload = recv_message(sock, self.secret)
+            message_type = header.get('type')
+            if message_type == 'lease':
+                self.handle_lease(sock, header)
+            elif message_type == 'renew':
+                self.handle_renew(sock, header)
+            elif message_type == 'result':
+                self.handle_result(sock, header, payload)
+            else:
+                send_message(sock, {'type': 'error',
+                                    'error': f'Unknown type {message_type}'},
+                             secret=self.secret)
+        except (OSError, ValueError):
+            print('Exception handling farm worker...')
+            traceback.print_exc()
+
+    def expire_leases(self) -> None:
+        now = time.monotonic()
+        for job_id, lease in list(self.leases.items()):
+            if lease.deadline <= now:
+                print(f'Lease on {lease.item[2].flac_path} held by '
+                      f'{lease.worker} expired.')
+                del self.leases[job_id]
+                self.retry_or_fail(lease.item, 'lease expired')
+
+    def retry_or_fail(self, item: tuple, error: str) -> None:
+        job_id, job = item[1], item[2]
+        # With shared paths the failed attempt may have left a partial ALAC.
+        self.converter.remove_outputs(job)
+        if self.attempts.get(job_id, 0) < self.max_attempts:
+            self.converter.queue.put(item)
+            return
+        print(f'Giving up on {job.flac_path} after '
+              f'{self.attempts[job_id]} attempts: {error}')
+        self.converter.failed.append(job.flac_path)
+        self.complete(job_id, ok=False, worker=None, error=error)
+
+    def complete(self, job_id: int, ok: bool, worker: Optional[str],
+                 error: Optional[str] = None) -> None:
+        self.results[job_id] = {'ok': ok, 'worker': worker, 'error': error,
+                                'attempts': self.attempts.get(job_id, 0)}
+        self.jobs_left -= 1
+        if self.jobs_left <= 0:
+            self.done_event.set()
+
+    def next_item(self) -> Optional[tuple]:
+        """Returns the next job that needs converting, under self.lock."""
+        while True:
+            try:
+                item = self.converter.queue.get_nowait()
+            except queue.Empty:
+                return None
+            if item[1] in self.attempts:
+                # A retry, whatever is at the output is from an attempt
+                # that failed or expired, e.g. a late write.
+                self.converter.remove_outputs(item[2])
+            if self.converter.prepare_output(item[2]):
+                return item
+            self.complete(item[1], ok=True, worker=None,
+                          error='skipped, output exists')
+
+    def handle_lease(self, sock: socket.socket,
+                     header: Dict[str, Any]) -> None:
+        worker = header.get('worker', 'unknown')
+        with self.lock:
+            self.expire_leases()
+            item = self.next_item()
+            if item is None:
+                send_message(sock, {'type': 'done' if self.done_event.is_set()
+                                     else 'wait'}, secret=self.secret)
+                return
+            _, job_id, job = item
+            self.attempts[job_id] = self.attempts.get(job_id, 0) + 1
+            self.leases[job_id] = FarmLease(
+                item, worker, time.monotonic() + self.lease_timeout)
+            attempt = self.attempts[job_id]
+
+        print(f'Leasing {job.flac_path} to {worker} (attempt {attempt}).')
+        try:
+            payload = b''
+            if not self.shared_paths:
+                with open(job.flac_path, 'rb') as f:
+                    payload = f.read()
+            extra_args = self.converter.genre_metadata_args(job.flac_path)
+            send_message(sock, {'type': 'job',
+                                'job_id': job_id,
+                                'flac_path': job.flac_path,
+                                'alac_path': job.alac_path,
+                                'shared_paths': self.shared_paths,
+                                'extra_args': extra_args,
+                                'lease_timeout': self.lease_timeout},
+                         payload, secret=self.secret)
+        except OSError as e:
+            with self.lock:
+                if self.leases.pop(job_id, None):
+                    self.retry_or_fail(item, str(e))
+            raise
+
+    def handle_renew(self, sock: socket.socket,
+                     header: Dict[str, Any]) -> None:
+        with self.lock:
+            lease = self.leases.get(header.get('job_id'))
+            if lease:
+                lease.deadline = time.monotonic() + self.lease_timeout
+        send_message(sock, {'type': 'ack', 'leased': bool(lease)},
+                     secret=self.secret)
+
+    def handle_result(self, sock: socket.socket, header: Dict[str, Any],
+                      payload: bytes) -> None:
+        job_id = header.get('job_id')
+        worker = header.get('worker', 'unknown')
+        with self.lock:
+            lease = self.leases.pop(job_id, None)
+        if lease is None:
+            # Expired and handed to someone else, or already finished.
+            print_if(f'Ignoring late result for job {job_id} from {worker}.',
+                     self.options)
+            send_message(sock, {'type': 'ack'}, secret=self.secret)
+            return
+
+        job = lease.item[2]
+        ok = bool(header.get('ok'))
+        error = header.get('error')
+        if ok and not self.shared_paths:
+            try:
+                write_file_if_changed(job.alac_path, payload)
+            except OSError as e:
+                ok, error = False, str(e)
+        if ok and not os.path.exists(job.alac_path):
+            ok, error = False, f'{job.alac_path} is missing'
+
+        # Verifying can decode the whole file, so don't hold the lock.
+        if ok and not self.converter.finish_job(job):
+            with self.lock:
+                self.complete(job_id, ok=False, worker=worker,
+                              error='verification failed')
+        elif ok:
+            print(f'{worker} converted {job.flac_path}.')
+            with self.lock:
+                self.complete(job_id, ok=True, worker=worker)
+        else:
+            print(f'{worker} failed converting {job.flac_path}: {error}')
+            with self.lock:
+                self.retry_or_fail(lease.item, error or 'encode failed')
+        send_message(sock, {'type': 'ack'}, secret=self.secret)
+
+
+class FarmWorker:
+    """Pulls jobs from a FarmCoordinator and encodes them.
+
+    encode_fn(flac_path, alac_path, extra_args) returns whether it
+    succeeded, it defaults to the backend's encode. Jobs are only taken
+    from a coordinator signing with secret, and even then only with
+    -metadata encoder arguments and, with shared paths, paths inside
+    shared_dir.
+    """
+
+    def __init__(self,
+                 address: str,
+                 secret: str,
+                 name: Optional[str] = None,
+                 encode_fn: Optional[Callable[[str, str, List[str]],
+                                              bool]] = None,
+                 poll_interval: float = 5,
+                 max_connect_failures: int = 3,
+                 backend: Optional['Backend'] = None,
+                 shared_dir: Optional[str] = None,
+                 options: Optional[Options] = None):
+        if not secret:
+            raise ValueError('A farm secret is required.')
+        self.options = options or DEFAULT_OPTIONS
+        self.secret = secret
+        # Shared path jobs are refused unless they're in here.
+        self.shared_dir = true_path(shared_dir)
+        self.address = parse_address(address)
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.backend = backend or CommandBackend(options=self.options)
+        self.encode_fn = encode_fn or self.backend.encode
+        self.poll_interval = poll_interval
+        self.max_connect_failures = max_connect_failures
+        self.kill_event = threading.Event()
+        self.converted = 0
+
+    def request(self, header: Dict[str, Any], payload: bytes = b'') -> tuple:
+        with socket.create_connection(self.address) as sock:
+            send_message(sock, {**header, 'worker': self.name}, payload,
+                         secret=self.secret)
+            return recv_message(sock, self.secret)
+
+    def renew_until(self, job_id: int, lease_timeout: float,
+                    stop_event: threading.Event) -> None:
+        while not stop_event.wait(lease_timeout / 3):
+            try:
+                self.request({'type': 'renew', 'job_id': job_id})
+            except OSError:
+                print_if(f'{self.name}: couldn\'t renew job {job_id}.',
+                         self.options)
+
+    def shared_path(self, path: Any, extension: str) -> str:
+        """Returns path if it's an extension file inside shared_dir."""
+        if (not self.shared_dir or not isinstance(path, str) or
+                os.path.splitext(path)[1].lower() != extension):
+            raise ValueError(f'Refusing shared path {path!r}.')
+        real_path = true_path(path)
+        if os.path.commonpath([real_path, self.shared_dir]) != (
+                self.shared_dir):
+            raise ValueError(f'Refusing {path!r} outside {self.shared_dir}.')
+        return real_path
+
+    def convert(self, header: Dict[str, Any], payload: bytes) -> tuple:
+        """Returns (result header, ALAC bytes) for a leased job."""
+        result = {'type': 'result', 'job_id': header['job_id'], 'ok': False}
+        try:
+            extra_args = farm_metadata_args(header['extra_args'])
+        except ValueError as e:
+            print(f'{self.name}: {e}')
+            result['error'] = str(e)
+            return result, b''
+
+        if header['shared_paths']:
+            alac_path = None
+            try:
+                flac_path = self.shared_path(header['flac_path'], '.flac')
+                alac_path = self.shared_path(header['alac_path'], '.m4a')
+                result['ok'] = self.encode_fn(flac_path, alac_path,
+                                              extra_args)
+            except Exception as e:
+                result['error'] = repr(e)
+            if not result['ok'] and alac_path:
+                # The coordinator would take a partial ALAC for a result.
+                remove_files([alac_path])
+            return result, b''
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            flac_path = os.path.join(temp_dir, 'input.flac')
+            alac_path = os.path.join(temp_dir, 'output.m4a')
+            with open(flac_path, 'wb') as f:
+                f.write(payload)
+            try:
+                result['ok'] = self.encode_fn(flac_path, alac_path,
+                                              extra_args)
+                if result['ok']:
+                    with open(alac_path, 'rb') as f:
+                        return result, f.read()
+            except Exception as e:
+                result['error'] = repr(e)
+        return result, b''
+
+    def run(self) -> int:
+        """Converts jobs until the coordinator is done, returns the count."""
+        failures = 0
+        while not self.kill_event.is_set():
+            try:
+                header, payload = self.request({'type': 'lease'})
+            except OSError:
+                failures += 1
+                if failures >= self.max_connect_failures:
+                    print(f'{self.name}: can\'t reach coordinator at '
+                          f'{self.address}, exiting.')
+                    break
+                self.kill_event.wait(self.poll_interval)
+                continue
+            failures = 0
+
+            if header['type'] == 'done':
+                break
+            if header['type'] != 'job':
+                self.kill_event.wait(self.poll_interval)
+                continue
+
+            print(f'{self.name}: converting {header["flac_path"]}...')
+            stop_renewing = threading.Event()
+            renewer = threading.Thread(
+                target=self.renew_until,
+                args=(header['job_id'], header['lease_timeout'],
+                      stop_renewing),
+                daemon=True)
+            renewer.start()
+            try:
+                result, alac = self.convert(header, payload)
+            finally:
+                stop_renewing.set()
+                renewer.join()
+
+            try:
+                self.request(result, alac)
+            except OSError:
+                # The lease runs out and someone else gets the job.
+                print(f'{self.name}: couldn\'t send result for '
+                      f'{header["flac_path"]}.')
+                continue
+            if result['ok']:
+                self.converted += 1
+
+        print(f'{self.name}: converted {self.converted} flacs.')
+        return self.converted
+
+
+class FFProbe():
+    def __init__(self,
+                 input_file: str,
+                 backend: Optional['Backend'] = None,
+                 options: Optional[Options] = None):
+        self.input_file = true_path(input_file)
+        self.options = options or DEFAULT_OPTIONS
+        self.backend = backend or CommandBackend(options=self.options)
+        self.result = None
+
+    def get_genre(self) -> Optional[str]:
+        """Returns the metadata field Genre in this input file."""
+        tags = self.get_tags()
+        if not tags:
+            return None
+
+        genre_tag = self.get_genre_tag()
+        if not genre_tag:
+            return None
+
+        return tags[genre_tag]
+
+    def get_genre_tag(self) -> Optional[str]:
+        """Returns the tag name for Genre used in this input file."""
+        if (tags := self.get_tags()) is not None:
+            possible_genre_tags = ['Genre', 'GENRE', 'genre']
+            for genre_tag in possible_genre_tags:
+                if genre_tag in tags:
+                    return genre_tag
+
+        return None
+
+    def get_tags(self) -> Optional[Dict[str, Any]]:
+        """Get tags from ffprobe result."""
+        if not self.result:
+            return None
+
+        if 'format' not in self.result:
+            return None
+
+        format = self.result['format']
+
+        if 'tags' not in format:
+            return None
+
+        tags = format['tags']
+        return tags
+
+    def read(self):
+        self.result = self.backend.probe(self.input_file)
+        if (tags := self.get_tags()) is not None:
+            print_separator(self.options)
+            print_if(f'{self.input_file}:', self.options)
+            print_json(tags)
+            print_separator(self.options)
+
+
+class FlacMetadata():
+    """Reads FLAC metadata blocks directly, without decoding any audio."""
+
+    STREAMINFO = 0
+    VORBIS_COMMENT = 4
+    PICTURE = 6
+
+    def __init__(self, input_file: str, digest_tags: bool = False):
+        self.input_file = input_file
+        # If set, tags_digest is a hash of the tags and pictures, the
+        # metadata that's carried over into an ALAC.
+        self.digest_tags = digest_tags
+        self.tags_digest = b''
+        # Vorbis comment field names are case insensitive, keep them upper.
+        self.comments: Dict[str, List[str]] = {}
+        self.sample_rate = 0
+        self.channels = 0
+        self.bits_per_sample = 0
+        self.total_samples = 0
+        # MD5 of the unencoded audio, all zeros if the encoder didn't set it.
+        self.md5 = bytes(16)
+
+    def has_md5(self) -> bool:
+        return self.md5 != bytes(16)
+
+    def parse_streaminfo(self, block: bytes) -> None:
+        # https://xiph.org/flac/format.html#metadata_block_streaminfo
+        packed = int.from_bytes(block[10:18], 'big')
+        self.sample_rate = packed >> 44
+        self.channels = ((packed >> 41) & 0x7) + 1
+        self.bits_per_sample = ((packed >> 36) & 0x1f) + 1
+        self.total_samples = packed & 0xfffffffff
+        self.md5 = bytes(block[18:34])
+
+    def get_genre(self) -> Optional[str]:
+        genres = self.comments.get('GENRE')
+        return genres[0] if genres else None
+
+    def parse_vorbis_comment(self, block: bytes) -> None:
+        vendor_length = int.from_bytes(block[0:4], 'little')
+        offset = 4 + vendor_length
+        count = int.from_bytes(block[offset:offset + 4], 'little')
+        offset += 4
+        for _ in range(count):
+            length = int.from_bytes(block[offset:offset + 4], 'little')
+            offset += 4
+            comment = block[offset:offset + length].decode('utf8', 'replace')
+            offset += length
+            key, sep, value = comment.partition('=')
+            if sep:
+                self.comments.setdefault(key.upper(), []).append(value)
+
+    def read(self) -> bool:
+        """Returns whether the file looked like a FLAC file."""
+        with open(self.input_file, 'rb') as f:
+            marker = f.read(4)
+            if marker[0:3] == b'ID3':
+                # Some taggers put an ID3v2 tag in front of the stream.
+                header = marker + f.read(6)
+                size = 0
+                for b in header[6:10]:
+                    size = (size << 7) | (b & 0x7f)
+                f.seek(10 + size)
+                marker = f.read(4)
+            if marker != b'fLaC':
+                return False
+
+            digest = hashlib.sha256()
+            last = False
+            while not last:
+                header = f.read(4)
+                if len(header) < 4:
+                    return False
+                last = bool(header[0] & 0x80)
+                block_type = header[0] & 0x7f
+                length = int.from_bytes(header[1:4], 'big')
+                if block_type == FlacMetadata.STREAMINFO:
+                    self.parse_streaminfo(f.read(length))
+                elif block_type == FlacMetadata.VORBIS_COMMENT:
+                    self.parse_vorbis_comment(f.read(length))
+                elif (block_type == FlacMetadata.PICTURE and
+                        self.digest_tags):
+                    digest.update(f.read(length))
+                else:
+                    f.seek(length, os.SEEK_CUR)
+            if self.digest_tags:
+                # Not the raw block, the vendor string isn't carried over.
+                digest.update(json.dumps(self.comments,
+                                         sort_keys=True).encode())
+                self.tags_digest = digest.digest()
+        return True
+
+
+def flac_duration(flac_path: str) -> float:
+    """Returns seconds of audio in flac_path per STREAMINFO, 0 if unknown."""
+    metadata = FlacMetadata(flac_path)
+    try:
+        if not metadata.read() or not metadata.sample_rate:
+            return 0.0
+    except OSError:
+        return 0.0
+    return metadata.total_samples / metadata.sample_rate
+
+
+class GenreRules():
+    """Genre normalization rules compiled into a single regex.
+
+    Results are memoized per raw genre string, a library only has a few
+    hundred distinct genres so each one is only matched once.
+    """
+
+    DEFAULT_RULES: Dict[str, str] = {
+        '(alternrock)': 'Alternative Rock',
+        '(kpop|korean)': 'K-Pop',
+        '(cpop|chinese|cantonese|mandarin)': 'C-Pop',
+        '(jpop|japanese)': 'J-Pop',
+        '(rap)': 'Hip-Hop',
+        # '(rock)': 'Rock',  # Don't do, clashes with Alternative Rock.
+        '(soundtrack)': 'OST',
+        '(vpop|vietnamese)': 'V-Pop'
+    }
+
+    def __init__(self,
+                 rules: Optional[Dict[str, str]] = None,
+                 cache_size: int = 1024):
+        if rules is None:
+            rules = GenreRules.DEFAULT_RULES
+        for pattern in rules:
+            GenreRules.check_pattern(pattern)
+        self.rules = dict(rules)
+        self.genres = list(self.rules.values())
+        # Every branch is anchored with a lazy .*? so an earlier rule still
+        # wins over a later one that happens to match earlier in the string.
+        self.pattern = re.compile(
+            '|'.join(f'.*?(?P<rule{i}>{pattern})'
+                     for i, pattern in enumerate(self.rules)),
+            re.DOTALL) if self.rules else None
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    @staticmethod
+    def check_pattern(pattern: str) -> None:
+        """Raises ValueError if pattern can't be one branch of the regex.
+
+        Group numbers shift once the rules are joined and group names
+        would clash, so backreferences and named groups aren't allowed.
+        """
+        try:
+            compiled = re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f'Genre rule {pattern!r}: {e}') from e
+        # An unescaped backslash and a digit, \1 but not \\1.
+        if (compiled.groupindex or '(?P=' in pattern or
+                re.search(r'(?<!\\)(?:\\\\)*\\[1-9]', pattern)):
+            raise ValueError(f'Genre rule {pattern!r}: backreferences and '
+                             'named groups aren\'t supported.')
+
+    @classmethod
+    def from_file(cls, path: str, cache_size: int = 1024) -> 'GenreRules':
+        with open(true_path(path), 'r', encoding='utf8') as f:
+            rules = json.load(f)
+        if not isinstance(rules, dict):
+            raise ValueError(f'{path}: expected a JSON object of '
+                             'pattern -> genre.')
+        return cls(rules=rules, cache_size=cache_size)
+
+    def _normalize(self, genre: Optional[str]) -> Optional[str]:
+        if not genre:
+            return None
+
+        lowered = genre.lower()
+        if self.pattern and (match := self.pattern.match(lowered)):
+            for name, value in match.groupdict().items():
+                if value is not None:
+                    return self.genres[int(name[len('rule'):])]
+
+        # 'rock' -> 'Rock'
+        # 'alternative rock' -> 'Alternative Rock'
+        # 'Alternative rock' -> 'Alternative Rock'
+        # 'Hip-hop' -> 'Hip-Hop'
+        return lowered.title()
+
+
+DEFAULT_GENRE_RULES = GenreRules()
+
+
+def load_genre_rules(path: Optional[str]) -> GenreRules:
+    if not path:
+        return DEFAULT_GENRE_RULES
+    return GenreRules.from_file(path)
 
 
-class FFProbe():
-    def __init__(self, input_file: str):
-        self.input_file = true_path(input_file)
+class Mp4Atom():
+    """An MP4 atom (box), containers are parsed into children."""
 
-    def get_genre(self) -> Optional[str]:
-        """Returns the metadata field Genre in this input file."""
-        tags = self.get_tags()
-        if not tags:
-            return None
+    # Only the containers on the way to ilst and stco/co64 are parsed.
+    CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'udta',
+                  b'meta', b'ilst', b'edts'}
 
-        genre_tag = self.get_genre_tag()
-        if not genre_tag:
+    def __init__(self,
+                 type: bytes,
+                 data: bytes = b'',
+                 children: Optional[List['Mp4Atom']] = None,
+                 prefix: bytes = b''):
+        self.type = type
+        # Payload of leaf atoms.
+        self.data = data
+        self.children = children
+        # Bytes before the children, e.g. the version and flags of meta.
+        self.prefix = prefix
+
+    @classmethod
+    def parse(cls, type: bytes, payload: bytes) -> 'Mp4Atom':
+        if type not in Mp4Atom.CONTAINERS:
+            return cls(type, data=payload)
+        prefix = b''
+        # meta is a full box (version + flags) except in some QuickTime
+        # files where the hdlr child follows right away.
+        if type == b'meta' and payload[4:8] != b'hdlr':
+            prefix, payload = payload[:4], payload[4:]
+        return cls(type, children=Mp4Atom.parse_children(payload),
+                   prefix=prefix)
+
+    @staticmethod
+    def parse_children(data: bytes) -> List['Mp4Atom']:
+        children = []
+        offset = 0
+        while offset + 8 <= len(data):
+            size = int.from_bytes(data[offset:offset + 4], 'big')
+            type = data[offset + 4:offset + 8]
+            header_size = 8
+            if size == 1:
+                size = int.from_bytes(data[offset + 8:offset + 16], 'big')
+                header_size = 16
+            elif size == 0:
+                size = len(data) - offset
+            if size < header_size or offset + size > len(data):
+                raise ValueError(f'Corrupt {type} atom at {offset}.')
+            children.append(Mp4Atom.parse(
+                type, data[offset + header_size:offset + size]))
+            offset += size
+        return children
+
+    def find(self, type: bytes) -> Optional['Mp4Atom']:
+        for child in self.children or []:
+            if child.type == type:
+                return child
+        return None
+
+    def walk(self):
+        yield self
+        for child in self.children or []:
+            yield from child.walk()
+
+    def payload(self) -> bytes:
+        if self.children is None:
+            return self.data
+        return self.prefix + b''.join(c.to_bytes() for c in self.children)
+
+    def to_bytes(self) -> bytes:
+        payload = self.payload()
+        if len(payload) + 8 <= 0xffffffff:
+            return (len(payload) + 8).to_bytes(4, 'big') + self.type + payload
+        return (b'\x00\x00\x00\x01' + self.type +
+                (len(payload) + 16).to_bytes(8, 'big') + payload)
+
+    def __len__(self) -> int:
+        return len(self.to_bytes())
+
+
+def mp4_free_atom(size: int) -> Mp4Atom:
+    return Mp4Atom(b'free', data=bytes(size - 8))
+
+
+class Mp4Tagger():
+    """Edits iTunes metadata (moov/udta/meta/ilst) without remuxing.
+
+    Changes are written in place when the file has enough free padding next
+    to the tags, the chunk offsets in stco/co64 are only touched when moov
+    has to grow in front of the audio.
+    """
+
+    # Padding left after a rewrite so the next edit can be done in place.
+    PADDING = 2048
+
+    # Text atoms use a data atom with type 1 (UTF-8).
+    UTF8 = 1
+
+    def __init__(self, path: str, options: Optional[Options] = None):
+        self.path = path
+        self.options = options or DEFAULT_OPTIONS
+        self.moov: Optional[Mp4Atom] = None
+        self.moov_offset = 0
+        self.moov_size = 0
+        # Top level (type, offset, size) in file order.
+        self.atoms: List[tuple] = []
+        self.file_size = 0
+
+    def read(self) -> 'Mp4Tagger':
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            self.file_size = f.tell()
+            offset = 0
+            while offset + 8 <= self.file_size:
+                f.seek(offset)
+                header = f.read(8)
+                size = int.from_bytes(header[0:4], 'big')
+                type = header[4:8]
+                header_size = 8
+                if size == 1:
+                    size = int.from_bytes(f.read(8), 'big')
+                    header_size = 16
+                elif size == 0:
+                    size = self.file_size - offset
+                if size < header_size:
+                    raise ValueError(f'{self.path}: corrupt {type} atom.')
+                self.atoms.append((type, offset, size))
+                if type == b'moov':
+                    f.seek(offset + header_size)
+                    self.moov = Mp4Atom.parse(
+                        type, f.read(size - header_size))
+                    self.moov_offset = offset
+                    self.moov_size = size
+                offset += size
+
+        if self.moov is None:
+            raise ValueError(f'{self.path}: no moov atom.')
+        return self
+
+    def get_meta(self) -> Mp4Atom:
+        """Returns moov/udta/meta, creating it if needed."""
+        udta = self.moov.find(b'udta')
+        if udta is None:
+            udta = Mp4Atom(b'udta', children=[])
+            self.moov.children.append(udta)
+        meta = udta.find(b'meta')
+        if meta is None:
+            hdlr = Mp4Atom(b'hdlr', data=(bytes(8) + b'mdirappl' +
+                                          bytes(9)))
+            meta = Mp4Atom(b'meta', children=[hdlr], prefix=bytes(4))
+            udta.children.append(meta)
+        return meta
+
+    def get_ilst(self) -> Mp4Atom:
+        meta = self.get_meta()
+        ilst = meta.find(b'ilst')
+        if ilst is None:
+            ilst = Mp4Atom(b'ilst', children=[])
+            # Keep ilst in front of any padding.
+            meta.children.insert(
+                next((i for i, c in enumerate(meta.children)
+                      if c.type == b'free'), len(meta.children)),
+                ilst)
+        return ilst
+
+    def get_text(self, name: bytes) -> Optional[str]:
+        item = self.get_ilst().find(name)
+        if item is None:
             return None
+        for child in Mp4Atom.parse_children(item.data):
+            if child.type == b'data':
+                return child.data[8:].decode('utf8', 'replace')
+        return None
 
-        return tags[genre_tag]
+    def set_item(self, name: bytes, children: List[Mp4Atom]) -> None:
+        ilst = self.get_ilst()
+        item = Mp4Atom(name, data=b''.join(c.to_bytes() for c in children))
+        for i, child in enumerate(ilst.children):
+            if child.type == name:
+                ilst.children[i] = item
+                return
+        ilst.children.append(item)
+
+    def set_text(self, name: bytes, value: str) -> None:
+        data = (Mp4Tagger.UTF8.to_bytes(4, 'big') + bytes(4) +
+                value.encode('utf8'))
+        self.set_item(name, [Mp4Atom(b'data', data=data)])
+
+    def set_freeform(self,
+                     name: str,
+                     value: str,
+                     mean: str = 'com.apple.iTunes') -> None:
+        """Sets a ----:mean:name item, e.g. replaygain_track_gain."""
+        ilst = self.get_ilst()
+        ilst.children = [c for c in ilst.children
+                         if not (c.type == b'----' and
+                                 self.freeform_name(c) == (mean, name))]
+        data = (Mp4Tagger.UTF8.to_bytes(4, 'big') + bytes(4) +
+                value.encode('utf8'))
+        ilst.children.append(Mp4Atom(b'----', data=b''.join([
+            Mp4Atom(b'mean', data=bytes(4) + mean.encode('utf8')).to_bytes(),
+            Mp4Atom(b'name', data=bytes(4) + name.encode('utf8')).to_bytes(),
+            Mp4Atom(b'data', data=data).to_bytes()])))
+
+    @staticmethod
+    def freeform_name(item: Mp4Atom) -> tuple:
+        children = {c.type: c.data[4:].decode('utf8', 'replace')
+                    for c in Mp4Atom.parse_children(item.data)
+                    if c.type in (b'mean', b'name')}
+        return (children.get(b'mean'), children.get(b'name'))
+
+    def remove(self, name: bytes) -> None:
+        ilst = self.get_ilst()
+        ilst.children = [c for c in ilst.children if c.type != name]
+
+    def set_genre(self, genre: str) -> None:
+        # gnre is the numeric ID3v1 genre, iTunes prefers it over ©gen.
+        self.remove(b'gnre')
+        self.set_text(b'\xa9gen', genre)
+
+    def absorb(self, delta: int) -> bool:
+        """Resizes the padding in meta so moov grows by delta less bytes."""
+        meta = self.get_meta()
+        free = meta.find(b'free')
+        if free is None:
+            if delta < 0 and -delta >= 8:
+                meta.children.append(mp4_free_atom(-delta))
+                return True
+            return False
+        new_size = len(free) - delta
+        if new_size == 0:
+            meta.children.remove(free)
+            return True
+        if new_size >= 8:
+            free.data = bytes(new_size - 8)
+            return True
+        return False
 
-    def get_genre_tag(self) -> Optional[str]:
-        """Returns the tag name for Genre used in this input file."""
-        if (tags := self.get_tags()) is not None:
-            possible_genre_tags = ['Genre', 'GENRE', 'genre']
-            for genre_tag in possible_genre_tags:
-                if genre_tag in tags:
-                    return genre_tag
+    def add_padding(self) -> None:
+        meta = self.get_meta()
+        meta.children = [c for c in meta.children if c.type != b'free']
+        meta.children.append(mp4_free_atom(Mp4Tagger.PADDING))
 
+    def shift_chunk_offsets(self, after: int, delta: int) -> None:
+        for atom in self.moov.walk():
+            if atom.type not in (b'stco', b'co64'):
+                continue
+            width = 4 if atom.type == b'stco' else 8
+            count = int.from_bytes(atom.data[4:8], 'big')
+            data = bytearray(atom.data)
+            for i in range(count):
+                start = 8 + i * width
+                offset = int.from_bytes(data[start:start + width], 'big')
+                if offset >= after:
+                    offset += delta
+                    if offset >= 1 << (8 * width):
+                        raise ValueError(f'{self.path}: chunk offset too '
+                                         'large for stco.')
+                    data[start:start + width] = offset.to_bytes(width, 'big')
+            atom.data = bytes(data)
+
+    def write_at(self, offset: int, data: bytes,
+                 truncate: bool = False) -> None:
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+            if truncate:
+                f.truncate()
+
+    def save(self) -> str:
+        """Writes the changes and returns how: in place or rewrite."""
+        moov_end = self.moov_offset + self.moov_size
+        delta = len(self.moov) - self.moov_size
+
+        if delta == 0 or self.absorb(delta):
+            self.write_at(self.moov_offset, self.moov.to_bytes())
+            return 'in place'
+
+        next_atoms = [a for a in self.atoms if a[1] == moov_end]
+        if next_atoms and next_atoms[0][0] in (b'free', b'skip'):
+            # Grow (or shrink) into the padding after moov.
+            free_size = next_atoms[0][2] - delta
+            if free_size >= 8:
+                self.write_at(self.moov_offset,
+                              self.moov.to_bytes() +
+                              free_size.to_bytes(4, 'big') + b'free')
+                return 'in place'
+
+        self.add_padding()
+        if moov_end >= self.file_size:
+            # Nothing after moov, so no chunk offsets change.
+            self.write_at(self.moov_offset, self.moov.to_bytes(),
+                          truncate=True)
+            return 'in place'
+
+        # moov is in front of the audio, everything after it moves.
+        delta = len(self.moov) - self.moov_size
+        self.shift_chunk_offsets(after=moov_end, delta=delta)
+        replace_file_region(self.path, self.moov_offset, moov_end,
+                            self.moov.to_bytes())
+        return 'rewrite'
+
+
+def syncsafe_to_int(data: bytes) -> int:
+    result = 0
+    for byte in data:
+        result = (result << 7) | (byte & 0x7f)
+    return result
+
+
+def int_to_syncsafe(value: int, length: int = 4) -> bytes:
+    if value >= 1 << (7 * length):
+        raise ValueError(f'{value} is too large for a syncsafe integer.')
+    return bytes((value >> (7 * i)) & 0x7f
+                 for i in reversed(range(length)))
+
+
+class Id3Tagger():
+    """Edits text frames of an ID3v2.3/2.4 tag at the start of an MP3.
+
+    The tag is rewritten in place when it fits in the existing tag's
+    padding. Otherwise the audio has to move, so the whole file is copied
+    to a temp file behind the new tag, with generous padding so that's
+    only needed once. Tags this doesn't handle (v2.2, unsynchronisation,
+    extended headers, footers) raise ValueError so callers can fall back to
+    ffmpeg.
+    """
+
+    # Padding left after a rewrite so later edits, even ones growing the
+    # tag a little, can be done in place.
+    PADDING = 4096
+
+    HEADER_SIZE = 10
+
+    def __init__(self, path: str, options: Optional[Options] = None):
+        self.path = path
+        self.options = options or DEFAULT_OPTIONS
+        self.version = 4
+        # Size of the tag on disk including its header, 0 if there's none.
+        self.tag_size = 0
+        # (frame id, flags, data) in file order.
+        self.frames: List[tuple] = []
+
+    def read(self) -> 'Id3Tagger':
+        with open(self.path, 'rb') as f:
+            header = f.read(Id3Tagger.HEADER_SIZE)
+            if len(header) < Id3Tagger.HEADER_SIZE or header[0:3] != b'ID3':
+                # No tag, save() will add a v2.4 one.
+                return self
+
+            self.version = header[3]
+            flags = header[5]
+            if self.version not in (3, 4):
+                raise ValueError(f'{self.path}: ID3v2.{self.version} '
+                                 'isn\'t supported.')
+            if flags & 0x80:
+                raise ValueError(f'{self.path}: unsynchronised ID3 tags '
+                                 'aren\'t supported.')
+            if flags & 0x40 or flags & 0x10:
+                raise ValueError(f'{self.path}: ID3 extended headers and '
+                                 'footers aren\'t supported.')
+
+            size = syncsafe_to_int(header[6:10])
+            body = f.read(size)
+            if len(body) < size:
+                raise ValueError(f'{self.path}: truncated ID3 tag.')
+            self.tag_size = Id3Tagger.HEADER_SIZE + size
+
+        offset = 0
+        while offset + Id3Tagger.HEADER_SIZE <= len(body):
+            frame_id = body[offset:offset + 4]
+            # Padding (or garbage) ends the frames.
+            if not re.fullmatch(rb'[A-Z0-9]{4}', frame_id):
+                break
+            raw_size = body[offset + 4:offset + 8]
+            frame_size = (syncsafe_to_int(raw_size) if self.version == 4
+                          else int.from_bytes(raw_size, 'big'))
+            frame_flags = body[offset + 8:offset + 10]
+            start = offset + Id3Tagger.HEADER_SIZE
+            if start + frame_size > len(body):
+                raise ValueError(f'{self.path}: corrupt {frame_id} frame.')
+            self.frames.append((frame_id, frame_flags,
+                                body[start:start + frame_size]))
+            offset = start + frame_size
+        return self
+
+    @staticmethod
+    def decode_text(data: bytes) -> str:
+        encoding, text = data[0:1], data[1:]
+        if encoding == b'\x00':
+            value = text.decode('latin1')
+        elif encoding == b'\x01':
+            value = text.decode('utf16')
+        elif encoding == b'\x02':
+            value = text.decode('utf-16-be')
+        else:
+            value = text.decode('utf8', 'replace')
+        # Multiple values are NUL separated, keep the first.
+        return value.split('\x00')[0]
+
+    def encode_text(self, value: str) -> bytes:
+        if self.version == 4:
+            return b'\x03' + value.encode('utf8')
+        try:
+            return b'\x00' + value.encode('latin1')
+        except UnicodeEncodeError:
+            # v2.3 has no UTF-8, UTF-16 with a BOM is the portable choice.
+            return b'\x01' + value.encode('utf16')
+
+    def get_text(self, frame_id: bytes) -> Optional[str]:
+        for id, flags, data in self.frames:
+            if id == frame_id and data:
+                return Id3Tagger.decode_text(data)
         return None
 
-    def get_tags(self) -> Optional[Dict[str, Any]]:
-        """Get tags from ffprobe result."""
-        if not self.result:
-            return None
+    def set_text(self, frame_id: bytes, value: str) -> None:
+        frame = (frame_id, bytes(2), self.encode_text(value))
+        ids = [id for id, _, _ in self.frames]
+        index = ids.index(frame_id) if frame_id in ids else len(ids)
+        # Replace the first frame with this id and drop any duplicates.
+        self.frames = [f for f in self.frames if f[0] != frame_id]
+        self.frames.insert(index, frame)
+
+    def set_genre(self, genre: str) -> None:
+        self.set_text(b'TCON', genre)
+
+    def frames_to_bytes(self) -> bytes:
+        result = bytearray()
+        for id, flags, data in self.frames:
+            size = (int_to_syncsafe(len(data)) if self.version == 4
+                    else len(data).to_bytes(4, 'big'))
+            result += id + size + flags + data
+        return bytes(result)
+
+    def tag_bytes(self, size: int) -> bytes:
+        frames = self.frames_to_bytes()
+        return (b'ID3' + bytes([self.version, 0, 0]) +
+                int_to_syncsafe(size - Id3Tagger.HEADER_SIZE) +
+                frames + bytes(size - Id3Tagger.HEADER_SIZE - len(frames)))
+
+    def save(self) -> str:
+        """Writes the tag and returns how: in place or rewrite."""
+        needed = Id3Tagger.HEADER_SIZE + len(self.frames_to_bytes())
+        if self.tag_size and needed <= self.tag_size:
+            with open(self.path, 'r+b') as f:
+                f.write(self.tag_bytes(self.tag_size))
+            return 'in place'
+
+        new_size = needed + Id3Tagger.PADDING
+        replace_file_region(self.path, 0, self.tag_size,
+                            self.tag_bytes(new_size))
+        self.tag_size = new_size
+        return 'rewrite'
+
+
+class Backend(ABC):
+    """Runs the encoders and taggers for the converter and genre changer."""
+
+    # Goes into ConversionCache keys, outputs of different encoders differ.
+    name = 'backend'
+
+    @abstractmethod
+    def encode(self, flac_path: str, alac_path: str,
+               extra_args: List[str],
+               profile_outputs: Iterable[tuple] = (),
+               loudness: Optional[Dict[str, Loudness]] = None) -> bool:
+        """Encodes flac_path to alac_path, returns whether it worked.
+
+        Each (OutputProfile, path) of profile_outputs is encoded too. If
+        loudness is passed, the flac's Loudness is put in it by flac_path.
+        """
+
+    def encode_batch(self, items: List[tuple],
+                     loudness: Optional[Dict[str, Loudness]] = None,
+                     attempts: Optional[Dict[str, int]] = None
+                     ) -> List[bool]:
+        """Encodes each (flac_path, alac_path, extra_args[, outputs]).
+
+        Returns whether each one worked, in order. Backends that can convert
+        several files in one go override this. If attempts is passed, flacs
+        that were encoded more than once are put in it by flac_path with
+        how many times.
+        """
+        return [self.encode(*item, loudness=loudness) for item in items]
+
+    @abstractmethod
+    def decode_md5(self, alac_path: str, pcm_codec: str) -> Optional[str]:
+        """Returns the hex MD5 of alac_path decoded with pcm_codec."""
+
+    def stall_counts(self) -> Dict[str, int]:
+        """Returns flac path -> times encoding it stalled and was killed."""
+        return {}
+
+    def stalled_batches(self) -> int:
+        """Returns how many batches stalled and were killed."""
+        return 0
+
+    @abstractmethod
+    def probe(self, music_file: str) -> Optional[Dict[str, Any]]:
+        """Returns ffprobe style JSON (format/tags) for music_file."""
+
+    @abstractmethod
+    def set_genre(self, music_file: str, genre: str, genre_tag: str) -> bool:
+        """Replaces the genre tag of music_file, returns whether it worked."""
+
+
+class CommandBackend(Backend):
+    """Uses xld/ffmpeg/ffprobe/mp4tags/metaflac and the built in taggers."""
+
+    # Extensions that can be tagged without any external tools.
+    IN_PLACE_TAGGERS = {'.m4a': Mp4Tagger, '.mp3': Id3Tagger}
 
-        if 'format' not in self.result:
-            return None
+    def __init__(self,
+                 governor: Optional[ResourceGovernor] = None,
+                 stall_timeout: float = 0,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.governor = governor or ResourceGovernor(options=self.options)
+        # Encoders whose outputs didn't grow for this many seconds are
+        # killed, 0 waits forever.
+        self.stall_timeout = stall_timeout
+        # Flac path -> times encoding it by itself stalled.
+        self.stalls: Dict[str, int] = {}
+        # Batches can't be pinned on one flac, they're counted apart.
+        self.batch_stalls = 0
+        self.stalls_lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return 'xld' if self.options.xld_available else 'ffmpeg'
+
+    def stall_counts(self) -> Dict[str, int]:
+        with self.stalls_lock:
+            return dict(self.stalls)
+
+    def stalled_batches(self) -> int:
+        with self.stalls_lock:
+            return self.batch_stalls
+
+    def kill_stalled(self, description: str, outputs: List[str]) -> None:
+        """Reports a killed encoder and removes what it wrote."""
+        print(f'{self.name} stalled {description}, no progress for '
+              f'{self.stall_timeout:g}s... killed.')
+        remove_files(outputs)
+
+    def encode(self, flac_path: str, alac_path: str,
+               extra_args: List[str],
+               profile_outputs: Iterable[tuple] = (),
+               loudness: Optional[Dict[str, Loudness]] = None) -> bool:
+        profile_outputs = list(profile_outputs)
+        outputs = [alac_path, *(path for _, path in profile_outputs)]
+        try:
+            process = self.governor.run(
+                encode_alac_command(flac_path, alac_path, extra_args,
+                                    profile_outputs=profile_outputs,
+                                    analyze_loudness=loudness is not None,
+                                    options=self.options),
+                watch_paths=outputs, stall_timeout=self.stall_timeout,
+                # https://stackoverflow.com/questions/41171791/how-to-suppress-or-capture-the-output-of-subprocess-run
+                capture_output=True, text=True)
+        except subprocess.TimeoutExpired:
+            with self.stalls_lock:
+                self.stalls[flac_path] = self.stalls.get(flac_path, 0) + 1
+            self.kill_stalled(f'converting {flac_path}', outputs)
+            return False
+        print_process_output(process, prefix=self.name, options=self.options)
+        print_separator(self.options)
+
+        if process.returncode != 0 or not os.path.exists(alac_path):
+            print(f'{self.name} failed converting {flac_path} '
+                  f'(exit code {process.returncode}).')
+            # Whatever was written before it failed is unusable.
+            remove_files(outputs)
+            return False
+
+        if self.options.xld_available:
+            if profile_outputs or loudness is not None:
+                # xld can't write anything else, so this decodes again.
+                if not self.encode_extra_outputs(flac_path, extra_args,
+                                                 profile_outputs, loudness):
+                    remove_files(outputs)
+                    return False
+            return True
+
+        if loudness is not None:
+            self.store_loudness(process, {0: flac_path}, loudness)
+        return True
 
-        format = self.result['format']
+    def encode_extra_outputs(
+            self, flac_path: str, extra_args: List[str],
+            profile_outputs: Iterable[tuple],
+            loudness: Optional[Dict[str, Loudness]] = None) -> bool:
+        if not self.options.ffmpeg_available:
+            print(f'Install ffmpeg to encode profiles or measure loudness '
+                  f'of {flac_path}.')
+            return False
+        outputs = [path for _, path in profile_outputs]
+        try:
+            process = self.governor.run(
+                encode_extra_outputs_command(
+                    flac_path, profile_outputs, extra_args,
+                    analyze_loudness=loudness is not None,
+                    options=self.options),
+                # Measuring loudness alone writes nothing to watch.
+                watch_paths=outputs, stall_timeout=self.stall_timeout,
+                capture_output=True, text=True)
+        except subprocess.TimeoutExpired:
+            with self.stalls_lock:
+                self.stalls[flac_path] = self.stalls.get(flac_path, 0) + 1
+            self.kill_stalled(f'encoding profiles of {flac_path}', outputs)
+            return False
+        print_process_output(process, prefix='ffmpeg', options=self.options)
+        if process.returncode != 0:
+            print(f'ffmpeg failed encoding profiles of {flac_path} '
+                  f'(exit code {process.returncode}).')
+            return False
+        if loudness is not None:
+            self.store_loudness(process, {0: flac_path}, loudness)
+        return True
 
-        if 'tags' not in format:
+    def store_loudness(self, process: subprocess.CompletedProcess,
+                       flac_paths: Dict[int, str],
+                       loudness: Dict[str, Loudness]) -> None:
+        """Puts what process measured for input index into loudness."""
+        measurements = parse_ebur128(process.stderr)
+        for index, flac_path in flac_paths.items():
+            if index in measurements:
+                loudness[flac_path] = measurements[index]
+            else:
+                print(f'No loudness measured for {flac_path}.')
+
+    def encode_batch(self, items: List[tuple],
+                     loudness: Optional[Dict[str, Loudness]] = None,
+                     attempts: Optional[Dict[str, int]] = None
+                     ) -> List[bool]:
+        # xld converts a single file per run.
+        if self.options.xld_available or len(items) < 2:
+            return super().encode_batch(items, loudness=loudness)
+
+        outputs = [path for item in items
+                   for path in [item[1], *(path for _, path in
+                                           (item[3] if len(item) > 3
+                                            else ()))]]
+        process: Optional[subprocess.CompletedProcess] = None
+        try:
+            process = self.governor.run(
+                encode_alac_batch_command(
+                    items, analyze_loudness=loudness is not None,
+                    options=self.options),
+                watch_paths=outputs, stall_timeout=self.stall_timeout,
+                capture_output=True, text=True)
+        except subprocess.TimeoutExpired:
+            # Each flac is converted by itself below, which finds the one
+            # that hangs.
+            with self.stalls_lock:
+                self.batch_stalls += 1
+            self.kill_stalled(f'converting a batch of {len(items)}', outputs)
+        if process:
+            print_process_output(process, prefix=self.name,
+                                 options=self.options)
+        print_separator(self.options)
+        returncode = process.returncode if process else 'stalled'
+
+        # ffmpeg gives up on every output if any input is broken, so when
+        # the batch fails each flac is converted on its own to find out
+        # which one it was.
+        results = []
+        for index, item in enumerate(items):
+            flac_path, alac_path = item[:2]
+            if returncode == 0 and os.path.exists(alac_path):
+                if loudness is not None:
+                    self.store_loudness(process, {index: flac_path},
+                                        loudness)
+                results.append(True)
+                continue
+            if os.path.exists(alac_path):
+                os.remove(alac_path)
+            for _, path in (item[3] if len(item) > 3 else ()):
+                if os.path.exists(path):
+                    os.remove(path)
+            print_if(f'Batch failed (exit code {returncode}), '
+                     f'converting {flac_path} by itself...', self.options)
+            # The batch was this flac's first attempt.
+            if attempts is not None:
+                attempts[flac_path] = 2
+            results.append(self.encode(*item, loudness=loudness))
+        return results
+
+    def decode_md5(self, alac_path: str, pcm_codec: str) -> Optional[str]:
+        if not self.options.ffmpeg_available:
+            print('Install ffmpeg to verify converted files.')
             return None
 
-        tags = format['tags']
-        return tags
+        process = self.governor.run(
+            ['ffmpeg',
+             '-v', 'error',
+             '-i', alac_path,
+             '-map', '0:a:0',
+             '-c:a', pcm_codec,
+             # The md5 muxer hashes the raw pcm packets.
+             '-f', 'md5', '-'],
+            capture_output=True, text=True)
+        print_process_output(process, 'ffmpeg md5', options=self.options)
+        match = re.search(r'MD5=([0-9a-f]{32})', process.stdout)
+        if process.returncode != 0 or not match:
+            print(f'Failed to decode {alac_path} for verification.')
+            return None
+        return match.group(1)
 
-    def read(self):
+    def probe(self, music_file: str) -> Optional[Dict[str, Any]]:
         # https://ffmpeg.org/ffprobe.html
         # https://gist.github.com/nrk/2286511
         try:
             process = subprocess.run(
                 ['ffprobe',
-                 self.input_file,
+                 music_file,
                  '-v',
                  'quiet',
                  '-print_format',
@@ -562,182 +4253,527 @@ class FFProbe():
                  '-hide_banner'],
                 capture_output=True, text=True)
 
-            print_if(process.stderr)
-            json_string = process.stdout
-            ffprobe_result = json.loads(json_string)
-            # print_json(ffprobe_result)
-            self.result = ffprobe_result
-            if (tags := self.get_tags()) is not None:
-                print_separator()
-                print_if(f'{self.input_file}:')
-                print_json(tags)
-                print_separator()
+            print_if(process.stderr, self.options)
+            return json.loads(process.stdout)
         except Exception:
             print('Exception calling ffprobe...')
             traceback.print_exc()
+            return None
+
+    def tag_in_place(self, music_file: str, genre: str) -> bool:
+        """Sets genre with a built in tagger, False if it couldn't."""
+        extension = os.path.splitext(music_file)[1].lower()
+        tagger_class = CommandBackend.IN_PLACE_TAGGERS.get(extension)
+        if tagger_class is None:
+            return False
+        try:
+            tagger = tagger_class(music_file, options=self.options).read()
+            tagger.set_genre(genre)
+            how = tagger.save()
+        except (OSError, ValueError) as e:
+            print(f'Couldn\'t tag {music_file} ({e}), falling back...')
+            return False
+        print_if(f'Tagged {music_file} ({how}).', self.options)
+        return True
+
+    def set_genre(self, music_file: str, genre: str, genre_tag: str) -> bool:
+        extension = os.path.splitext(music_file)[1].lower()
+        if self.tag_in_place(music_file, genre):
+            return True
+
+        if extension == '.m4a' or extension == '.mp3':
+            if self.options.mp4tags_available and extension == '.m4a':
+                process = subprocess.run([
+                    'mp4tags',
+                    '-genre',
+                    genre,
+                    music_file  # mp4tags can edit in place!
+                ], capture_output=True, text=True)
+                print_process_output(process, 'mp4tags',
+                                     options=self.options)
+                return process.returncode == 0
+
+            # ffmpeg can't edit in place so convert to a temp location
+            # first.
+            temp_path = temp_path_from_path(music_file)
+            print_if(f'Tagging from {music_file} to temp file: '
+                     f'{temp_path}...', self.options)
+            command = [
+                'ffmpeg',
+                '-y',
+                '-v', 'warning',
+                '-i',
+                music_file,
+                '-metadata',
+                f'{genre_tag}={genre}',
+                '-c', 'copy',
+                temp_path
+            ]
+            print_if(command, self.options)
+            process = subprocess.run(command,
+                                     capture_output=True,
+                                     text=True)
+
+            # Then move the temp file...
+            print_if(f'Removing {music_file}... ', self.options)
+            os.remove(music_file)
+            print_if(f'Moving {temp_path} to {music_file}...',
+                     self.options)
+            move(temp_path, music_file)
+            print_process_output(process, 'ffmpeg tag',
+                                 options=self.options)
+            return process.returncode == 0
+
+        if extension == '.flac':
+            if not self.options.metaflac_available:
+                print('metaflac unavailable for tagging flac files.')
+                return False
+
+            print_if(f'Removing tag {genre_tag} from {music_file}...',
+                     self.options)
+            # metaflac doesn't seem to have 'replace' as functionality
+            # so remove the tag first.
+            process = subprocess.run([
+                'metaflac',
+                music_file,
+                f'--remove-tag={genre_tag}'
+            ], capture_output=True, text=True)
+            print_process_output(process, 'metaflac remove-tag',
+                                 options=self.options)
+
+            print_if(f'Setting tag {genre_tag}={genre} to '
+                     f'{music_file}...', self.options)
+            process = subprocess.run([
+                'metaflac',
+                music_file,
+                f'--set-tag={genre_tag}={genre}'
+            ])
+            print_process_output(process, 'metaflac set-tag',
+                                 options=self.options)
+            return process.returncode == 0
+
+        return False
+
+
+class SimulatedBackend(Backend):
+    """Pretends to encode and tag, for load testing without real audio.
+
+    Every call sleeps latency seconds (plus up to jitter more) and fails
+    with probability failure_rate. Encoding writes a tiny placeholder ALAC
+    so the rest of the pipeline runs as usual. Verifying a placeholder
+    gives back the STREAMINFO MD5 of the flac it was encoded from, so it
+    passes for flacs that have one.
+    """
+
+    name = 'simulated'
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 failure_rate: float = 0.0,
+                 genre: str = 'kpop',
+                 seed: Optional[int] = None,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        # Genre every probed file claims to have.
+        self.genre = genre
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Method name -> number of calls.
+        self.calls: Dict[str, int] = {}
+        # Placeholder ALAC path -> STREAMINFO MD5 of its flac.
+        self.md5s: Dict[str, str] = {}
+
+    def simulate(self, call: str) -> bool:
+        """Sleeps like a real call would, returns whether it succeeds."""
+        with self.lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.failure_rate
+        time.sleep(delay)
+        return not failed
+
+    # Loudness every encoded file measures as.
+    LOUDNESS_LUFS = -14.0
+
+    def encode(self, flac_path: str, alac_path: str,
+               extra_args: List[str],
+               profile_outputs: Iterable[tuple] = (),
+               loudness: Optional[Dict[str, Loudness]] = None) -> bool:
+        if not self.simulate('encode'):
+            print(f'Simulated failure converting {flac_path}.')
+            return False
+        self.write_outputs(flac_path, alac_path, profile_outputs, loudness)
+        return True
+
+    def write_outputs(self, flac_path: str, alac_path: str,
+                      profile_outputs: Iterable[tuple] = (),
+                      loudness: Optional[Dict[str, Loudness]] = None
+                      ) -> None:
+        for path in [alac_path, *(path for _, path in profile_outputs)]:
+            with open(path, 'wb') as f:
+                f.write(b'simulated alac')
+        metadata = FlacMetadata(flac_path)
+        if metadata.read() and metadata.has_md5():
+            with self.lock:
+                self.md5s[true_path(alac_path)] = metadata.md5.hex()
+        if loudness is not None:
+            loudness[flac_path] = Loudness(SimulatedBackend.LOUDNESS_LUFS,
+                                           -1.0)
+
+    def encode_batch(self, items: List[tuple],
+                     loudness: Optional[Dict[str, Loudness]] = None,
+                     attempts: Optional[Dict[str, int]] = None
+                     ) -> List[bool]:
+        # Startup latency is paid once, failures still hit single files.
+        self.simulate('encode_batch')
+        results = []
+        for flac_path, alac_path, _, *rest in items:
+            with self.lock:
+                failed = self.random.random() < self.failure_rate
+            if failed:
+                print(f'Simulated failure converting {flac_path}.')
+            else:
+                self.write_outputs(flac_path, alac_path,
+                                   rest[0] if rest else (), loudness)
+            results.append(not failed)
+        return results
+
+    def decode_md5(self, alac_path: str, pcm_codec: str) -> Optional[str]:
+        if not self.simulate('decode_md5'):
+            return None
+        with self.lock:
+            return self.md5s.get(true_path(alac_path))
+
+    def probe(self, music_file: str) -> Optional[Dict[str, Any]]:
+        if not self.simulate('probe'):
+            return None
+        return {'format': {'tags': {'genre': self.genre}}}
+
+    def set_genre(self, music_file: str, genre: str, genre_tag: str) -> bool:
+        return self.simulate('set_genre')
+
+
+def create_backend(name: str,
+                   args: argparse.Namespace,
+                   governor: Optional[ResourceGovernor] = None,
+                   options: Optional[Options] = None) -> Backend:
+    if name == 'simulate':
+        return SimulatedBackend(latency=args.simulate_latency,
+                                jitter=args.simulate_jitter,
+                                failure_rate=args.simulate_failure_rate,
+                                seed=args.simulate_seed,
+                                options=options)
+    if name == 'command':
+        return CommandBackend(governor=governor,
+                              stall_timeout=args.flac_stall_timeout,
+                              options=options)
+    raise ValueError(f'Unknown backend {name}, expected one of {BACKENDS}.')
+
+
+BACKENDS = ['command', 'simulate']
 
 
 class GenreChanger():
     def __init__(self,
                  input_dir: str,
-                 num_threads: int = 4):
+                 num_threads: int = 4,
+                 genre_rules: Optional[GenreRules] = None,
+                 backend: Optional[Backend] = None,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.backend = backend or CommandBackend(options=self.options)
         self.input_dir = true_path(input_dir)
+        # Set by read(). If write() is called without it, files are queued
+        # as they're found instead.
+        self.files: Optional[List[str]] = None
         self.queue = queue.Queue()
+        self.total_queue_size = 0
         self.threads = []
         self.thread_kill_event = threading.Event()
+        # Set once every file is queued.
+        self.discovered = threading.Event()
         self.num_threads = num_threads
+        self.genre_rules = genre_rules or DEFAULT_GENRE_RULES
 
     def read(self):
-        self.files = find_all_music_files(self.input_dir)
-
-    def find_appropriate_genre(self, genre: Optional[str]) -> Optional[str]:
-        if not genre:
-            return None
+        self.files = find_all_music_files(self.input_dir, options=self.options)
 
-        patterns: Dict = {
-            '(alternrock)': 'Alternative Rock',
-            '(kpop|korean)': 'K-Pop',
-            '(cpop|chinese|cantonese|mandarin)': 'C-Pop',
-            '(jpop|japanese)': 'J-Pop',
-            '(rap)': 'Hip-Hop',
-            # '(rock)': 'Rock',  # Don't do, clashes with Alternative Rock.
-            '(soundtrack)': 'OST',
-            '(vpop|vietnamese)': 'V-Pop'
-        }
-
-        for k, v in patterns.items():
-            pattern = re.compile(k)
-            if re.search(pattern, genre.lower()):
-                return v
+    def discover_files(self) -> None:
+        """Queues the music files under input_dir as they're found."""
+        directories = iter_directory_files(self.input_dir, MUSIC_EXTENSIONS,
+                                           options=self.options)
+        try:
+            for entries in directories:
+                for entry in entries:
+                    self.total_queue_size += 1
+                    if not put_unless_killed(self.queue, entry.path,
+                                             self.thread_kill_event):
+                        return
+        finally:
+            directories.close()
+            self.discovered.set()
 
-        # 'rock' -> 'Rock'
-        # 'alternative rock' -> 'Alternative Rock'
-        # 'Alternative rock' -> 'Alternative Rock'
-        # 'Hip-hop' -> 'Hip-Hop'
-        return genre.lower().title()
+    def find_appropriate_genre(self, genre: Optional[str]) -> Optional[str]:
+        return self.genre_rules.normalize(genre)
 
     def convert_worker(self):
         while not self.thread_kill_event.is_set():
             try:
-                music_file = self.queue.get_nowait()
-            except Exception:
+                music_file = self.queue.get(timeout=0.1)
+            except queue.Empty:
                 # Loop exits here when all threads exhaust self.queue.
-                print('Exiting worker thread...')
-                break
+                if self.discovered.is_set() and self.queue.empty():
+                    print('Exiting worker thread...')
+                    break
+                continue
 
-            ffprobe = FFProbe(input_file=music_file)
+            ffprobe = FFProbe(input_file=music_file, backend=self.backend,
+                              options=self.options)
             ffprobe.read()
 
             genre_tag = ffprobe.get_genre_tag()
             if not genre_tag:
-                print_if(f'{music_file}: no genre tag found... skipping.')
+                print_if(f'{music_file}: no genre tag found... skipping.',
+                         self.options)
                 continue
 
             genre = ffprobe.get_genre()
             if not genre:
-                print_if(f'{music_file}: no genre found... skipping.')
+                print_if(f'{music_file}: no genre found... skipping.',
+                         self.options)
                 continue
 
             appropriate_genre = self.find_appropriate_genre(genre)
             if genre == appropriate_genre:
                 print_if(f'{music_file}: genre {genre} is already correct...'
-                         ' skipping.')
+                         ' skipping.', self.options)
                 continue
 
-            print_separator()
+            print_separator(self.options)
             print('Tagging file {} of {}'.format(
                 self.total_queue_size - self.queue.qsize(),
                 self.total_queue_size), flush=True)
-            print_separator()
-
-            directory, file_name = os.path.split(music_file)
-            base_name, extension = os.path.splitext(file_name)
-            extension = extension.lower()
-            print_if(f'Tagging file: {file_name}')
-
-            if extension == '.m4a' or extension == '.mp3':
-                if MP4TAGS_AVAILABLE and extension == '.m4a':
-                    process = subprocess.run([
-                        'mp4tags',
-                        '-genre',
-                        appropriate_genre,
-                        music_file  # mp4tags can edit in place!
-                    ], capture_output=True, text=True)
-                    print_process_output(process, 'mp4tags')
-                else:
-                    # ffmpeg can't edit in place so convert to a temp location
-                    # first.
-                    temp_path = temp_path_from_path(music_file)
-                    print_if(f'Tagging from {music_file} to temp file: '
-                             f'{temp_path}...')
-                    command = [
-                        'ffmpeg',
-                        '-y',
-                        '-v', 'warning' if VERBOSE else 'warning',
-                        '-i',
-                        music_file,
-                        '-metadata',
-                        f'{genre_tag}={appropriate_genre}',
-                        '-c', 'copy',
-                        temp_path
-                    ]
-                    print_if(command)
-                    process = subprocess.run(command,
-                                             capture_output=True,
-                                             text=True)
-
-                    # Then move the temp file...
-                    print_if(f'Removing {music_file}... ')
-                    os.remove(music_file)
-                    print_if(f'Moving {temp_path} to {music_file}...')
-                    move(temp_path, music_file)
-                    print_process_output(process, 'ffmpeg tag')
-
-            if extension == '.flac':
-                if not METAFLAC_AVAILABLE:
-                    print('metaflac unavailable for tagging flac files.')
-                    continue
-
-                print_if(f'Removing tag {genre_tag} from {music_file}...')
-                # metaflac doesn't seem to have 'replace' as functionality
-                # so remove the tag first.
-                process = subprocess.run([
-                    'metaflac',
-                    music_file,
-                    f'--remove-tag={genre_tag}'
-                ], capture_output=True, text=True)
-                print_process_output(process, 'metaflac remove-tag')
+            print_separator(self.options)
 
-                print_if(f'Setting tag {genre_tag}={appropriate_genre} to '
-                         f'{music_file}...')
-                process = subprocess.run([
-                    'metaflac',
-                    music_file,
-                    f'--set-tag={genre_tag}={appropriate_genre}'
-                ])
-                print_process_output(process, 'metaflac set-tag')
+            print_if(f'Tagging file: {os.path.basename(music_file)}',
+                     self.options)
+            if not self.backend.set_genre(music_file, appropriate_genre,
+                                          genre_tag):
+                print(f'Failed tagging {music_file}.')
 
-            print_separator()
+            print_separator(self.options)
 
     def write(self):
-        if len(self.files) == 0:
-            print_if('No music files to tag... skipping.')
+        """Tags the files found by read(), or while finding them."""
+        if self.files is not None and len(self.files) == 0:
+            print_if('No music files to tag... skipping.', self.options)
             return
-        for f in self.files:
-            self.queue.put(f)
-            self.total_queue_size = self.queue.qsize()
-        for i in range(self.num_threads):
-            thread = threading.Thread(target=self.convert_worker)
-            thread.start()
-            self.threads.append(thread)
-        for thread in self.threads:
-            thread.join()
+        self.threads = []
+        self.discovered.clear()
+        discovery = None
+        if self.files is None:
+            self.queue = queue.Queue(
+                maxsize=max(1, self.options.discovery_queue_size))
+            self.total_queue_size = 0
+            discovery = threading.Thread(target=self.discover_files)
+            discovery.start()
+        else:
+            for f in self.files:
+                self.queue.put(f)
+                self.total_queue_size = self.queue.qsize()
+            self.discovered.set()
+        try:
+            for i in range(self.num_threads):
+                thread = threading.Thread(target=self.convert_worker)
+                thread.start()
+                self.threads.append(thread)
+            for thread in self.threads:
+                thread.join()
+        except BaseException:
+            self.thread_kill_event.set()
+            raise
+        finally:
+            if discovery:
+                discovery.join()
+
+
+MUSIC_EXTENSIONS = ('.flac', '.mp3', '.m4a')
+
+
+def read_genre(music_file: str,
+               backend: Optional[Backend] = None,
+               options: Optional[Options] = None) -> Optional[str]:
+    """Returns music_file's genre, read natively when the format allows."""
+    extension = os.path.splitext(music_file)[1].lower()
+    try:
+        if extension == '.flac':
+            metadata = FlacMetadata(music_file)
+            if metadata.read():
+                return metadata.get_genre()
+        elif extension == '.mp3':
+            return Id3Tagger(music_file, options=options).read().get_text(
+                b'TCON')
+        elif extension == '.m4a':
+            return Mp4Tagger(music_file, options=options).read().get_text(
+                b'\xa9gen')
+    except (OSError, ValueError):
+        pass
+
+    # Unusual files (ID3v2.2, damaged atoms, ...) go through ffprobe.
+    ffprobe = FFProbe(music_file, backend=backend, options=options)
+    ffprobe.read()
+    return ffprobe.get_genre()
+
+
+class TagCache:
+    """Genres of music files, kept until a file's size or mtime changes.
 
+    Saved as JSON so reports don't have to read every file each time.
+    """
 
-class WatchHandler(FileSystemEventHandler):
-    """File System Watch Handler for flac->alac changes."""
+    def __init__(self,
+                 cache_file: Optional[str] = None,
+                 backend: Optional[Backend] = None,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.cache_file = cache_file
+        self.backend = backend
+        # Path -> {'size', 'mtime_ns', 'genre'}.
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        # Paths looked up since loading, the rest are pruned on save.
+        self.seen: Set[str] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self) -> 'TagCache':
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r', encoding='utf8') as f:
+                    self.entries = json.load(f)['entries']
+            except (OSError, ValueError, KeyError):
+                print(f'Ignoring unreadable tag cache {self.cache_file}.')
+                self.entries = {}
+        return self
+
+    def save(self) -> None:
+        if not self.cache_file or self.options.dry:
+            return
+        if self.misses == 0 and len(self.seen) == len(self.entries):
+            # Nothing was read or removed.
+            return
+        self.entries = {path: entry for path, entry in self.entries.items()
+                        if path in self.seen}
+        write_file_if_changed(self.cache_file, json.dumps(
+            {'entries': self.entries}, ensure_ascii=False).encode('utf8'))
+
+    def get_genre(self, path: str, stat: os.stat_result) -> Optional[str]:
+        self.seen.add(path)
+        entry = self.entries.get(path)
+        if (entry and entry['size'] == stat.st_size and
+                entry['mtime_ns'] == stat.st_mtime_ns):
+            self.hits += 1
+            return entry['genre']
+
+        self.misses += 1
+        genre = read_genre(path, backend=self.backend, options=self.options)
+        self.entries[path] = {'size': stat.st_size,
+                              'mtime_ns': stat.st_mtime_ns,
+                              'genre': genre}
+        return genre
+
+
+class LibraryStats:
+    """Counts, sizes and pending genre changes of a music directory."""
 
-    def __init__(self, fn, ob_name: str, delay: int = 120,):
+    def __init__(self,
+                 music_dir: str,
+                 tag_cache: Optional[TagCache] = None,
+                 genre_rules: Optional[GenreRules] = None,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.music_dir = true_path(music_dir)
+        self.tag_cache = tag_cache or TagCache(options=self.options)
+        self.genre_rules = genre_rules or DEFAULT_GENRE_RULES
+        # Extension -> number of tracks / bytes.
+        self.counts: Dict[str, int] = {}
+        self.sizes: Dict[str, int] = {}
+        # Normalized genre -> number of tracks.
+        self.genres: Dict[str, int] = {}
+        # (genre, normalized genre) -> number of tracks that would change.
+        self.genre_changes: Dict[tuple, int] = {}
+        self.unconverted_flacs: List[str] = []
+
+    def collect(self) -> 'LibraryStats':
+        # This runs per track on big libraries, so it sticks to string
+        # slicing and the stat done while scanning.
+        music_files = {}
+        for entry in scan_files(self.music_dir, MUSIC_EXTENSIONS, stat=True,
+                                options=self.options):
+            extension = entry.name[entry.name.rfind('.'):].lower()
+            music_files[entry.path] = (extension, entry.stat())
+
+        genre_counts: Dict[Optional[str], int] = {}
+        for path, (extension, stat) in music_files.items():
+            self.counts[extension] = self.counts.get(extension, 0) + 1
+            self.sizes[extension] = (self.sizes.get(extension, 0) +
+                                     stat.st_size)
+            if (extension == '.flac' and
+                    path[:-len('.flac')] + '.m4a' not in music_files):
+                self.unconverted_flacs.append(path)
+            genre = self.tag_cache.get_genre(path, stat)
+            genre_counts[genre] = genre_counts.get(genre, 0) + 1
+        self.unconverted_flacs.sort()
+
+        # Normalize once per distinct genre rather than per track.
+        for genre, count in genre_counts.items():
+            appropriate_genre = self.genre_rules.normalize(genre) or '(none)'
+            self.genres[appropriate_genre] = (
+                self.genres.get(appropriate_genre, 0) + count)
+            if genre and genre != appropriate_genre:
+                self.genre_changes[(genre, appropriate_genre)] = count
+        return self
+
+    def report(self) -> str:
+        def size(num_bytes: int) -> str:
+            return f'{num_bytes / 1024 ** 3:.1f} GB'
+
+        lines = [f'Library: {self.music_dir}',
+                 f'Tracks: {sum(self.counts.values())} '
+                 f'({size(sum(self.sizes.values()))})']
+        for extension, count in sorted(self.counts.items()):
+            lines.append(f'  {extension}: {count} '
+                         f'({size(self.sizes[extension])})')
+        lines.append('Genres:')
+        for genre, count in sorted(self.genres.items(),
+                                   key=lambda item: (-item[1], item[0])):
+            lines.append(f'  {genre}: {count}')
+        lines.append(f'Genre changes: {sum(self.genre_changes.values())}')
+        for (genre, appropriate_genre), count in sorted(
+                self.genre_changes.items()):
+            lines.append(f'  {genre} -> {appropriate_genre}: {count}')
+        lines.append(f'Unconverted flacs: {len(self.unconverted_flacs)}')
+        for flac_path in self.unconverted_flacs:
+            lines.append(f'  {flac_path}')
+        return '\n'.join(lines)
+
+
+class WatchHandler:
+    """File System Watch Handler for flac->alac changes.
+
+    This is duck typed as a watchdog FileSystemEventHandler so watchdog is
+    only imported when something is actually watched.
+    """
+
+    def __init__(self,
+                 fn,
+                 ob_name: str,
+                 delay: int = 120,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
         self.fn = fn
         # Two minutes by default.
         # Recommend to use a higher delay for more stability and a lower delay
@@ -746,33 +4782,529 @@ class WatchHandler(FileSystemEventHandler):
         self.timer: threading.Timer = None
         self.ob_name = ob_name
 
+    # Resilio finishes files by renaming them, and files dropped into
+    # existing directories only modify them.
+    EVENT_TYPES = ('created', 'moved', 'modified')
+
     def on_any_event(self, event):
-        print_if(f'WatchHandler: on_any_event: {event}!!')
-        if event.event_type == 'created':
-            print_if(f'{self.ob_name}: scheduling timer...')
+        print_if(f'WatchHandler: on_any_event: {event}!!', self.options)
+        if event.event_type in WatchHandler.EVENT_TYPES:
+            print_if(f'{self.ob_name}: scheduling timer...', self.options)
 
             if self.timer:
-                print_if('Canceling current timer and creating a new one...')
+                print_if('Canceling current timer and creating a new one...',
+                         self.options)
                 self.timer.cancel()
                 self.timer = threading.Timer(self.delay, self.fn)
             else:
-                print_if('Creating a new timer...')
+                print_if('Creating a new timer...', self.options)
                 self.timer = threading.Timer(self.delay, self.fn)
 
             # Schedule timer to start.
-            print_if(f'Timer scheduled to start in {self.delay} seconds...')
+            print_if(f'Timer scheduled to start in {self.delay} seconds...',
+                     self.options)
             self.timer.start()
 
+    def dispatch(self, event):
+        self.on_any_event(event)
+
+
+def is_partial_download(file_name: str) -> bool:
+    """Returns whether file_name is a file Resilio is still downloading."""
+    return re.search(r'!\.?sync$', file_name) is not None
+
+
+def directory_snapshot(directory: str) -> Optional[tuple]:
+    """Returns (path, size, mtime) of every file under directory.
+
+    Returns None if directory is gone or still has partial downloads.
+    """
+    if not os.path.isdir(directory):
+        return None
+    snapshot = []
+    for dirpath, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            if is_partial_download(file_name):
+                return None
+            path = os.path.join(dirpath, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Renamed while walking, e.g. .!sync -> final name.
+                return None
+            snapshot.append((path, stat.st_size, stat.st_mtime_ns))
+    return tuple(sorted(snapshot))
+
+
+class AlbumWatchHandler:
+    """Watches a directory of albums and reports albums that finished syncing.
+
+    Each top level directory under root is an album. An album is ready once
+    it has had no events for settle_time seconds and its files haven't
+    changed size or mtime since the last check, with no partial downloads
+    left. fn is called with the names of the ready albums, and may return
+    the ones it couldn't handle yet to have them checked again later.
+
+    Like WatchHandler, this is duck typed as a watchdog event handler.
+    """
+
+    EVENT_TYPES = ('created', 'moved', 'modified', 'deleted')
+
+    def __init__(self,
+                 root: str,
+                 fn: Callable[[List[str]], Any],
+                 ob_name: str,
+                 settle_time: float = 10,
+                 on_path_changed: Optional[Callable[[str], Any]] = None,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.root = true_path(root)
+        self.fn = fn
+        # Called with every path an event is for, e.g.
+        # TrashCleaner.mark_dirty.
+        self.on_path_changed = on_path_changed
+        self.ob_name = ob_name
+        self.settle_time = settle_time
+        self.lock = threading.Lock()
+        # Album name -> time.monotonic() of its last event.
+        self.pending: Dict[str, float] = {}
+        # Album name -> snapshot from its last check.
+        self.snapshots: Dict[str, Optional[tuple]] = {}
+        self.kill_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def album_of(self, path: Optional[str]) -> Optional[str]:
+        """Returns the album (top level directory) path is in."""
+        if not path:
+            return None
+        relative = os.path.relpath(true_path(path), self.root)
+        album = Path(relative).parts[0] if relative != '.' else None
+        if not album or album == '..' or album.startswith('.'):
+            return None
+        return album
+
+    def dispatch(self, event):
+        if event.event_type not in AlbumWatchHandler.EVENT_TYPES:
+            return
+        paths = [event.src_path, getattr(event, 'dest_path', None)]
+        if self.on_path_changed:
+            for path in paths:
+                if path:
+                    self.on_path_changed(path)
+        albums = {self.album_of(path) for path in paths} - {None}
+        if not albums:
+            return
+        now = time.monotonic()
+        with self.lock:
+            for album in albums:
+                print_if(f'{self.ob_name}: {event.event_type} in {album}.',
+                         self.options)
+                self.pending[album] = now
+        self.start()
+
+    def mark(self, album: str) -> None:
+        """Checks album for readiness as if an event happened in it."""
+        with self.lock:
+            self.pending[album] = time.monotonic()
+
+    def check(self) -> List[str]:
+        """Calls fn with the albums that are ready and returns them."""
+        now = time.monotonic()
+        ready = []
+        with self.lock:
+            for album, last_event in list(self.pending.items()):
+                if now - last_event < self.settle_time:
+                    continue
+                snapshot = directory_snapshot(os.path.join(self.root, album))
+                if snapshot is None and not os.path.isdir(
+                        os.path.join(self.root, album)):
+                    # Moved away or deleted.
+                    del self.pending[album]
+                    self.snapshots.pop(album, None)
+                elif (snapshot is not None and
+                        snapshot == self.snapshots.get(album)):
+                    del self.pending[album]
+                    del self.snapshots[album]
+                    ready.append(album)
+                else:
+                    # Still changing, look again after another window.
+                    self.snapshots[album] = snapshot
+                    self.pending[album] = now
+
+        if ready:
+            print(f'{self.ob_name}: {sorted(ready)} ready.')
+            deferred = self.fn(sorted(ready))
+            for album in deferred or []:
+                print_if(f'{self.ob_name}: {album} deferred.', self.options)
+                self.mark(album)
+        return ready
+
+    def run(self):
+        while not self.kill_event.wait(min(self.settle_time, 1) or 0.1):
+            try:
+                self.check()
+            except Exception:
+                print(f'{self.ob_name}: exception while checking albums...')
+                traceback.print_exc()
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        self.kill_event.set()
+
+
+class FileEvent:
+    """The parts of a watchdog FileSystemEvent the handlers use."""
+
+    def __init__(self, event_type: str, src_path: str,
+                 is_directory: bool = False):
+        self.event_type = event_type
+        self.src_path = src_path
+        self.is_directory = is_directory
+
+    def __repr__(self) -> str:
+        return f'FileEvent({self.event_type}, {self.src_path})'
+
+
+class PollingObserver:
+    """Finds changes by polling, for mounts that never send events.
+
+    Duck typed as a watchdog Observer. Each directory's listing of
+    (name, is directory, size, mtime) is cached along with the directory's
+    own mtime. A poll stats every directory but only lists the ones whose
+    mtime changed again, so on SMB/NFS mounts it costs a round trip per
+    directory instead of one per file. Adding, removing or renaming a file
+    changes its directory's mtime. Writing to a file in place doesn't,
+    which is fine for Resilio since it renames finished files into place.
+    """
+
+    # Listings taken this soon after a directory's mtime may have missed
+    # a change within the same mtime tick, they're taken again next poll.
+    MTIME_SLACK_NS = 2 * 10 ** 9
+
+    def __init__(self,
+                 interval: float = 10,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.interval = interval
+        # (handler, root, recursive, directory -> (mtime_ns, listing)).
+        self.watches: List[tuple] = []
+        self.lock = threading.Lock()
+        self.kill_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def schedule(self, handler, path: str, recursive: bool = False) -> None:
+        root = true_path(path)
+        listings: Dict[str, tuple] = {}
+        # The first listing is the baseline, it doesn't send events.
+        self.poll_directory(listings, root, recursive, None)
+        with self.lock:
+            self.watches.append((handler, root, recursive, listings))
+
+    @staticmethod
+    def list_directory(directory: str) -> Optional[Dict[str, tuple]]:
+        """Returns name -> (is directory, size, mtime_ns) for directory."""
+        listing = {}
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            listing[entry.name] = (True, 0, 0)
+                        else:
+                            stat = entry.stat(follow_symlinks=False)
+                            listing[entry.name] = (False, stat.st_size,
+                                                   stat.st_mtime_ns)
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        return listing
+
+    def poll_directory(self,
+                       listings: Dict[str, tuple],
+                       directory: str,
+                       recursive: bool,
+                       events: Optional[List[FileEvent]]) -> None:
+        """Lists directory again if it changed, adding events for changes.
+
+        events is None for the baseline listing.
+        """
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            # Gone, the parent's listing reports it.
+            return
+        cached = listings.get(directory)
+        if cached and cached[0] == mtime_ns:
+            listing = cached[1]
+        else:
+            listing = self.list_directory(directory)
+            if listing is None:
+                return
+            if time.time_ns() - mtime_ns < PollingObserver.MTIME_SLACK_NS:
+                # Compare against nothing next time, i.e. list again.
+                mtime_ns = None
+            listings[directory] = (mtime_ns, listing)
+            if events is not None:
+                self.diff(listings, directory, cached[1] if cached else {},
+                          listing, events)
+
+        if recursive:
+            for name, (is_directory, _, _) in listing.items():
+                if is_directory:
+                    self.poll_directory(listings,
+                                        os.path.join(directory, name),
+                                        recursive, events)
+
+    @staticmethod
+    def diff(listings: Dict[str, tuple],
+             directory: str,
+             old: Dict[str, tuple],
+             new: Dict[str, tuple],
+             events: List[FileEvent]) -> None:
+        count = len(events)
+        for name, entry in new.items():
+            path = os.path.join(directory, name)
+            if name not in old:
+                events.append(FileEvent('created', path, entry[0]))
+            elif not entry[0] and entry != old[name]:
+                events.append(FileEvent('modified', path))
+        for name, entry in old.items():
+            if name in new:
+                continue
+            path = os.path.join(directory, name)
+            events.append(FileEvent('deleted', path, entry[0]))
+            if entry[0]:
+                # Forget everything that was under it.
+                for cached in [d for d in listings
+                               if d == path or d.startswith(path + os.sep)]:
+                    del listings[cached]
+        if len(events) > count:
+            events.append(FileEvent('modified', directory, True))
+
+    def poll(self) -> int:
+        """Dispatches what changed since the last poll, returns how many."""
+        with self.lock:
+            watches = list(self.watches)
+        count = 0
+        for handler, root, recursive, listings in watches:
+            events: List[FileEvent] = []
+            self.poll_directory(listings, root, recursive, events)
+            for event in events:
+                handler.dispatch(event)
+            count += len(events)
+        return count
+
+    def run(self):
+        while not self.kill_event.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                print('Exception while polling for changes...')
+                traceback.print_exc()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.kill_event.set()
+
+    def join(self, timeout: Optional[float] = None):
+        if self.thread:
+            self.thread.join(timeout)
+
+
+def create_observer(polling: bool = False,
+                    poll_interval: float = 10,
+                    options: Optional[Options] = None):
+    """Returns one observer to schedule every watch on."""
+    if polling:
+        return PollingObserver(poll_interval, options=options)
+    try:
+        # watchdog starts threads and is only needed when watching.
+        from watchdog.observers import Observer
+    except ImportError:
+        print('watchdog isn\'t installed, polling for changes instead.')
+        return PollingObserver(poll_interval, options=options)
+    return Observer()
+
+
+class PipelineStage:
+    """A step of AlbumPipeline, run for up to concurrency albums at once."""
+
+    def __init__(self,
+                 name: str,
+                 fn: Callable[[str], bool],
+                 concurrency: int = 1):
+        self.name = name
+        # Called with an album, returns whether it can go on to the next
+        # stage.
+        self.fn = fn
+        self.concurrency = max(1, concurrency)
+
+
+class AlbumPipeline:
+    """Moves albums through stages independently of each other.
+
+    Every stage has its own queue and worker threads, so an album goes on
+    as soon as its previous stage is done, e.g. the first album is tagged
+    and moved while later ones are still converting. An album stops at the
+    first stage that fails it (returns False or raises).
+    """
+
+    def __init__(self,
+                 stages: List[PipelineStage],
+                 on_failed: Optional[Callable[[str], Any]] = None,
+                 options: Optional[Options] = None):
+        self.options = options or DEFAULT_OPTIONS
+        self.stages = stages
+        # Called with each album that fails a stage, e.g. to clean up.
+        self.on_failed = on_failed
+        self.queues = [queue.Queue() for _ in stages]
+        self.kill_event = threading.Event()
+        self.lock = threading.Lock()
+        # Stage index -> its workers still running.
+        self.running: List[int] = []
+        # Albums that went through every stage, in the order they did.
+        self.finished: List[str] = []
+        # Album -> name of the stage it failed.
+        self.failed: Dict[str, str] = {}
+
+    def worker(self, index: int):
+        stage = self.stages[index]
+        while True:
+            album = self.queues[index].get()
+            # None is put once per worker after the last album.
+            if album is None:
+                break
+            if self.kill_event.is_set():
+                continue
+
+            print_if(f'Pipeline {stage.name}: {album}...', self.options)
+            try:
+                passed = stage.fn(album)
+            except Exception:
+                print(f'Exception in pipeline {stage.name} of {album}...')
+                traceback.print_exc()
+                passed = False
+
+            if not passed:
+                with self.lock:
+                    self.failed[album] = stage.name
+                if self.on_failed:
+                    try:
+                        self.on_failed(album)
+                    except Exception:
+                        traceback.print_exc()
+            elif index + 1 < len(self.stages):
+                self.queues[index + 1].put(album)
+            else:
+                with self.lock:
+                    self.finished.append(album)
+
+        with self.lock:
+            self.running[index] -= 1
+            last = self.running[index] == 0
+        # The next stage is done once it finishes what this one passed on.
+        if last and index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].concurrency):
+                self.queues[index + 1].put(None)
+
+    def run(self, albums: Iterable[str]) -> List[str]:
+        """Runs albums through every stage, returns the ones that finished."""
+        self.finished = []
+        self.failed = {}
+        self.running = [stage.concurrency for stage in self.stages]
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.concurrency):
+                thread = threading.Thread(target=self.worker, args=(index,))
+                thread.start()
+                threads.append(thread)
+
+        for album in albums:
+            self.queues[0].put(album)
+        for _ in range(self.stages[0].concurrency):
+            self.queues[0].put(None)
+        for thread in threads:
+            thread.join()
+
+        if self.failed:
+            print(f'{len(self.failed)} albums stopped in the pipeline: '
+                  f'{self.failed}')
+        return self.finished
+
+    def stop(self):
+        """Lets running stages finish and drops the albums still queued."""
+        self.kill_event.set()
+
+
+def create_conversion_cache(
+        args: argparse.Namespace,
+        options: Optional[Options] = None) -> Optional[ConversionCache]:
+    """Returns the --flac_cache_dir cache, None if it isn't set."""
+    if not args.flac_cache_dir:
+        return None
+    return ConversionCache(args.flac_cache_dir,
+                           max_size=int(args.flac_cache_size_gb * 1024 ** 3),
+                           hardlink=args.flac_cache_hardlink,
+                           options=options)
+
 
 class JojoMusicManager:
-    def __init__(self, args):
+    def __init__(self, args, options: Optional[Options] = None):
         self.args = args
-
-        self.resilio = Resilio(sync_dir=self.get_sync_directory())
+        self.options = options or Options.from_args(args)
+
+        self.resilio = Resilio(sync_dir=self.get_sync_directory(),
+                               options=self.options)
+        # Originals are deleted, so real encodes are always verified.
+        # Simulated ones only with --flac_verify, load tests usually run on
+        # empty placeholder flacs.
+        self.flac_verify = args.flac_verify or args.backend != 'simulate'
+        if (self.flac_verify and args.backend == 'command' and
+                not self.options.ffmpeg_available):
+            print('Install ffmpeg to verify converted flacs, converting '
+                  'without verifying...')
+            self.flac_verify = False
+        self.genre_rules = load_genre_rules(args.genre_rules)
+        self.governor = ResourceGovernor.from_args(args, options=self.options)
+        self.backend = create_backend(args.backend, args,
+                                      governor=self.governor,
+                                      options=self.options)
+        # Kept between conversions, watch events mark what to list again.
+        self.trash_cleaner = TrashCleaner(options=self.options)
+        # The same album often comes in from more than one of the flac
+        # directories. Off unless --flac_cache_dir is set.
+        self.cache = create_conversion_cache(args, options=self.options)
+        # Shared by every album's converter, saved after each album.
+        self.quarantine = (Quarantine(args.flac_quarantine_file,
+                                      options=self.options).load()
+                           if args.flac_quarantine_file else None)
+        # Converters of the albums in the pipeline, stopped on ^C.
+        self.converters: Set[FlacToAlacConverter] = set()
+        # Album dir -> flacs whose staged ALACs are finished, deleted once
+        # the album is committed.
+        self.staged_flacs: Dict[str, List[str]] = {}
+        self.converters_lock = threading.Lock()
+        # Loaded by the first convert_playlists(), refreshed after that.
+        self.library_index: Optional[LibraryIndex] = None
 
         self.playlist_manager = PlaylistManager(
             input_dir=self.get_windows_m3u_directory(),
-            output_dir=self.get_alac_m3u_directory())
+            output_dir=self.get_alac_m3u_directory(),
+            library_root=self.get_playlist_music_root(),
+            options=self.options)
 
     def get_playlist_directory(self):
         if platform.system() == 'Windows':
@@ -824,6 +5356,10 @@ class JojoMusicManager:
         if platform.system() == 'FreeBSD':
             return r'/bebe/music'
 
+    def get_playlist_music_root(self) -> str:
+        """Returns the music directory as written in Foobar2000 playlists."""
+        return r'X:\music'
+
     def get_workspace_process_directory(self) -> str:
         if platform.system() == 'Windows':
             return r'X:\workspace'
@@ -833,141 +5369,308 @@ class JojoMusicManager:
             return r'/bebe/workspace'
 
     def convert_playlists(self):
-        print_if('Starting to convert playlists...')
+        print_if('Starting to convert playlists...', self.options)
         start = time.process_time()
         # Modify Foobar2000 m3u playlists with .flac entries to .alac.
-        delete_directory_if_exists(self.get_alac_m3u_directory())
+        # Playlists are only rewritten when their contents change, so Apple
+        # Music and the FreeBSD consumers don't re-import all of them.
         self.playlist_manager.output_dir = self.get_alac_m3u_directory()
+        # Entries are only pointed at ALACs that actually exist. The index
+        # is loaded once, after that only directories that changed are
+        # listed again.
+        if self.library_index is None:
+            self.library_index = load_library_index(
+                self.get_music_directory(),
+                index_file=self.args.m3u_library_index,
+                options=self.options)
+        elif (self.library_index.refresh() and
+                self.args.m3u_library_index):
+            self.library_index.save(self.args.m3u_library_index)
+        self.playlist_manager.library_index = self.library_index
         self.playlist_manager.read()
         self.playlist_manager.reverse_playlist()
         self.playlist_manager.convert_flac_to_alac()
-        print_if(f'flac->alac, elapsed: {time.process_time() - start}')
-        self.playlist_manager.write()
+        print_if(f'flac->alac, elapsed: {time.process_time() - start}',
+                 self.options)
+        self.write_playlists()
 
         # Write the OSX version deriving from the current list of playlists.
-        delete_directory_if_exists(self.get_osx_m3u_directory())
         self.playlist_manager.output_dir = self.get_osx_m3u_directory()
         self.playlist_manager.convert_windows_to_posix()
-        print_if(f'windows->posix, elapsed: {time.process_time() - start}')
+        print_if(f'windows->posix, elapsed: {time.process_time() - start}',
+                 self.options)
 
         self.playlist_manager.convert_from_str_to_str(
             from_str=r'C:\Users\james\Music', to_str=r'/Users/james/Music')
         print_if(f'C:\\Users\\james\\Music->/Users/james/Music, elapsed: '
-                 f'{time.process_time() - start}')
+                 f'{time.process_time() - start}', self.options)
 
         # Apple Music has random playlists loaded from Music Library.
         # Prefix the playlist with _ to get it sorted to the top.
-        self.playlist_manager.write(prefix='_')
+        self.write_playlists(prefix='_')
 
         # Write the FreeBSD version deriving from the current set of playlists.
-        delete_directory_if_exists(self.get_bsd_m3u_directory())
         self.playlist_manager.output_dir = self.get_bsd_m3u_directory()
         self.playlist_manager.convert_from_str_to_str(
             from_str=r'/Users/james/Music', to_str=r'/bebe/music')
         print_if(f'/Users/james/Music->/bebe/music, elapsed: '
-                 f'{time.process_time() - start}')
+                 f'{time.process_time() - start}', self.options)
 
-        self.playlist_manager.write()
+        self.write_playlists()
 
-    def convert_and_move_flacs(self, flac_dir: str):
+    def write_playlists(self, prefix: Optional[str] = None):
+        written = self.playlist_manager.write(prefix=prefix,
+                                              only_if_changed=True)
+        # Playlists deleted or renamed in Foobar2000 go away here too.
+        self.playlist_manager.remove_stale_playlists(keep=written)
+
+    def convert_and_move_flacs(
+            self,
+            flac_dir: str,
+            music_dirs: Optional[List[str]] = None) -> Optional[List[str]]:
+        """Converts and moves the albums in flac_dir, or just music_dirs.
+
+        Returns music_dirs if Resilio is still syncing, so a watcher can
+        look at them again later.
+        """
         print(f'Starting convert process for {flac_dir}...')
         if not os.path.exists(flac_dir):
             print(f'{flac_dir} does not exist. Skipping convert and move...')
-            return
+            return None
 
+        # Resilio keeps partial downloads in .sync at the top of the sync
+        # dir, not in the album, so a settled album can still be missing
+        # files.
         if self.resilio.syncing():
             print('Resilio syncing... Skipping flac conversion...')
-            return
+            return music_dirs
 
         # Get list of directories to move that aren't hidden.
-        music_dirs = [f for f in os.listdir(flac_dir) if not f.startswith('.')]
+        music_dirs = [f for f in os.listdir(flac_dir)
+                      if not f.startswith('.') and
+                      (music_dirs is None or f in music_dirs)]
         if len(music_dirs) == 0:
             print('No music directories to convert or move. Skipping.')
-            return
+            return None
 
-        # Attempt to convert FLACs to ALACs.
-        print('Attempting flac conversion...')
+        # Move music to Music directory.
+        move_to = os.path.join(self.get_workspace_process_directory(),
+                               '_TO_PROCESS')
+        if not os.path.exists(move_to):
+            os.makedirs(move_to)
+
+        # Each album is converted, tagged and moved on its own, so the first
+        # albums land in _TO_PROCESS while later ones are still converting.
+        pipeline = AlbumPipeline([
+            PipelineStage('convert', partial(self.convert_album, flac_dir),
+                          self.args.pipeline_convert_albums),
+            PipelineStage('tag', partial(self.tag_album, flac_dir),
+                          self.args.pipeline_tag_albums),
+            PipelineStage('move', partial(self.move_album, flac_dir, move_to),
+                          self.args.pipeline_move_albums),
+        ], on_failed=partial(self.remove_scratch_album, flac_dir),
+            options=self.options)
         try:
-            converter = FlacToAlacConverter(
-                input_dir=flac_dir,
-                overwrite_output=True,
-                delete_original=True)
-            converter.read()
-            converter.write()
-            print('Finished converting...')
-            genre_changer = GenreChanger(flac_dir)
-            genre_changer.read()
-            genre_changer.write()
-            print('Finished tagging...')
+            music_dirs = self.order_albums(flac_dir, music_dirs)
+            print_if(f'Music directories to move {music_dirs}', self.options)
+            moved = pipeline.run(music_dirs)
+            print(f'Finished converting and moving {len(moved)} albums...')
         except KeyboardInterrupt:
-            if converter:
-                converter.thread_kill_event.set()
-
+            pipeline.stop()
+            with self.converters_lock:
+                for converter in self.converters:
+                    converter.thread_kill_event.set()
             print('Done...')
-        except Exception:
-            print('Exception while converting music...')
-            traceback.print_exc()
+        return None
+
+    def order_albums(self, flac_dir: str, music_dirs: List[str]) -> List[str]:
+        """Returns music_dirs, albums with the most urgent flacs first.
+
+        Tracks queued up in Foobar2000 first, then small albums. Albums
+        without flacs only need moving and go before all of them.
+        """
+        flacs = only_in_directories(
+            find_flac_files(flac_dir, options=self.options), flac_dir,
+            music_dirs)
+        jobs = [ConversionJob(flac_path,
+                              alac_path_from_flac_path(flac_path=flac_path))
+                for flac_path in flacs]
+        policies = create_priority_policies(['playlist', 'smallest_album'],
+                                            self.playlist_manager)
+        ranks: Dict[str, int] = {}
+        for _, _, job in prioritize_jobs(jobs, policies):
+            album = Path(os.path.relpath(job.flac_path,
+                                         true_path(flac_dir))).parts[0]
+            ranks.setdefault(album, len(ranks))
+        return sorted(music_dirs, key=lambda album: ranks.get(album, -1))
+
+    def scratch_album_dir(self, flac_dir: str, album: str) -> Optional[str]:
+        """Returns where album's ALACs are staged with --scratch_dir."""
+        if not self.args.scratch_dir:
+            return None
+        return os.path.join(true_path(self.args.scratch_dir),
+                            os.path.basename(true_path(flac_dir)), album)
+
+    def remove_scratch_album(self, flac_dir: str, album: str) -> None:
+        self.pop_staged_flacs(flac_dir, album)
+        scratch_album_dir = self.scratch_album_dir(flac_dir, album)
+        if scratch_album_dir and os.path.isdir(scratch_album_dir):
+            print(f'Removing staged {scratch_album_dir}...')
+            rmtree(scratch_album_dir)
+
+    def pop_staged_flacs(self, flac_dir: str, album: str) -> List[str]:
+        with self.converters_lock:
+            return self.staged_flacs.pop(
+                true_path(os.path.join(flac_dir, album)), [])
+
+    def convert_album(self, flac_dir: str, album: str) -> bool:
+        album_dir = os.path.join(flac_dir, album)
+        if not os.path.isdir(album_dir):
+            return True
+
+        # Left over from a run that was killed.
+        self.remove_scratch_album(flac_dir, album)
+        scratch_album_dir = self.scratch_album_dir(flac_dir, album)
+        if scratch_album_dir:
+            # ALACs are about as big as their flacs.
+            flac_size = sum(entry.stat().st_size for entry in scan_files(
+                album_dir, ('.flac',), stat=True, options=self.options))
+            os.makedirs(os.path.dirname(scratch_album_dir), exist_ok=True)
+            if not has_free_space(os.path.dirname(scratch_album_dir),
+                                  flac_size):
+                print(f'Not enough space in {self.args.scratch_dir} for '
+                      f'{album}, converting it in place.')
+                scratch_album_dir = None
 
+        converter = FlacToAlacConverter(
+            input_dir=album_dir,
+            overwrite_output=True,
+            # Staged flacs are deleted once their ALACs are committed.
+            delete_original=scratch_album_dir is None,
+            num_threads=self.args.flac_threads,
+            genre_rules=self.genre_rules,
+            verify=self.flac_verify,
+            # Tracks queued up in Foobar2000 first.
+            priority_policies=create_priority_policies(
+                ['playlist'], self.playlist_manager),
+            governor=self.governor,
+            cache=self.cache,
+            trash_cleaner=self.trash_cleaner,
+            backend=self.backend,
+            batch_size=self.args.flac_batch_size,
+            analyze_loudness=self.args.flac_loudness,
+            output_dir=scratch_album_dir,
+            prefetch=self.args.flac_prefetch,
+            prefetch_budget=self.args.flac_prefetch_mb * 1024 ** 2,
+            max_attempts=self.args.flac_max_attempts,
+            retry_backoff=self.args.flac_retry_backoff,
+            quarantine=self.quarantine,
+            profiles=[OutputProfile.parse(spec)
+                      for spec in self.args.flac_profile or []],
+            # Keeps the album folder in the profile's directory.
+            profile_root=flac_dir,
+            options=self.options)
+        with self.converters_lock:
+            self.converters.add(converter)
         try:
-            # Move music to Music directory.
-            move_to = os.path.join(self.get_workspace_process_directory(),
-                                   '_TO_PROCESS')
-            if not os.path.exists(move_to):
-                os.makedirs(move_to)
-
-            print_if(f'Music directories to move {music_dirs}')
-            ds_store_pattern = re.compile(r'.DS_Store')
-            for music_dir in music_dirs:
-                if re.search(ds_store_pattern, music_dir):
-                    continue
-                from_dir = os.path.join(flac_dir, music_dir)
-                to_dir = os.path.join(move_to, music_dir)
-                print_if(f'Attempting to move {from_dir} to {to_dir}')
-                move(from_dir, to_dir)
-                print_if(f'Moved {from_dir} to {to_dir}...')
-        except KeyboardInterrupt:
-            print('Done...')
-        except Exception:
-            print('Exception while moving music...')
-            traceback.print_exc()
+            converter.write()
+        finally:
+            with self.converters_lock:
+                self.converters.discard(converter)
+                if scratch_album_dir:
+                    self.staged_flacs[true_path(album_dir)] = list(
+                        converter.finished)
+        # Flacs that failed are moved along with the album, as before.
+        return not converter.thread_kill_event.is_set()
+
+    def tag_album(self, flac_dir: str, album: str) -> bool:
+        album_dir = true_path(os.path.join(flac_dir, album))
+        scratch_album_dir = self.scratch_album_dir(flac_dir, album)
+        if not scratch_album_dir or not os.path.isdir(scratch_album_dir):
+            self.change_genres(album_dir)
+            return True
+
+        # Finished flacs are deleted by commit_staged_album, so only what's
+        # left of the album gets tagged along with the ALACs.
+        with self.converters_lock:
+            finished = set(self.staged_flacs.get(album_dir, []))
+        kept = [path for path in find_all_music_files(album_dir,
+                                                      options=self.options)
+                if path not in finished]
+        self.change_genres(album_dir, kept)
+        self.change_genres(scratch_album_dir)
+        return True
+
+    def change_genres(self, directory: str,
+                      files: Optional[List[str]] = None) -> None:
+        """Tags files under directory, or all of its music files."""
+        genre_changer = GenreChanger(directory,
+                                     genre_rules=self.genre_rules,
+                                     backend=self.backend,
+                                     options=self.options)
+        genre_changer.files = files
+        genre_changer.write()
+
+    def move_album(self, flac_dir: str, move_to: str, album: str) -> bool:
+        from_dir = os.path.join(flac_dir, album)
+        to_dir = os.path.join(move_to, album)
+        scratch_album_dir = self.scratch_album_dir(flac_dir, album)
+        if scratch_album_dir and os.path.isdir(scratch_album_dir):
+            print_if(f'Committing {scratch_album_dir} and {from_dir} to '
+                     f'{to_dir}', self.options)
+            commit_staged_album(scratch_album_dir, from_dir, to_dir,
+                                self.pop_staged_flacs(flac_dir, album),
+                                options=self.options)
+            return True
+        print_if(f'Attempting to move {from_dir} to {to_dir}', self.options)
+        move(from_dir, to_dir)
+        print_if(f'Moved {from_dir} to {to_dir}...', self.options)
+        return True
 
     def setup_file_watchers(self):
-        self.observers: List[Observer] = []
+        # One observer (thread) for every watch.
+        self.observer = create_observer(
+            polling=self.args.watch_polling,
+            poll_interval=self.args.watch_poll_interval,
+            options=self.options)
 
-        self.playlist_observer = Observer()
-        self.playlist_observer.schedule(
+        self.observer.schedule(
             WatchHandler(fn=self.convert_playlists,
                          ob_name='Playlist Observer',
-                         delay=self.args.watch_playlist_delay),
+                         delay=self.args.watch_playlist_delay,
+                         options=self.options),
             self.get_windows_m3u_directory(),
             recursive=False)
-        print_if('Will start observer with name: Playlist Observer...')
-        self.observers.append(self.playlist_observer)
+        print_if('Will start observer with name: Playlist Observer...',
+                 self.options)
 
+        self.album_handlers: List[AlbumWatchHandler] = []
         for directory in self.get_flac_directories():
             Path(directory).mkdir(exist_ok=True, parents=True)
-            # Create partial function with flac_dir set.
-            convert_fn = partial(self.convert_and_move_flacs,
-                                 flac_dir=directory)
+            # Create partial function with flac_dir set, it's called with
+            # the albums that finished syncing.
+            convert_fn = partial(self.convert_and_move_flacs, directory)
             observer_name = f'FLAC Observer: {directory}'
-            converter_observer = Observer()
-            converter_observer.schedule(
-                WatchHandler(fn=convert_fn,
-                             ob_name=observer_name,
-                             delay=self.args.watch_convert_delay),
-                directory,
-                recursive=False)
-            print_if(f'Will start observer with name: {observer_name}...')
-            self.observers.append(converter_observer)
-
-        for observer in self.observers:
-            observer.start()
+            album_handler = AlbumWatchHandler(
+                root=directory,
+                fn=convert_fn,
+                ob_name=observer_name,
+                settle_time=self.args.watch_settle_time,
+                on_path_changed=self.trash_cleaner.mark_dirty,
+                options=self.options)
+            self.album_handlers.append(album_handler)
+            self.observer.schedule(album_handler, directory, recursive=True)
+            print_if(f'Will start observer with name: {observer_name}...',
+                     self.options)
+
+        self.observer.start()
 
         try:
             while True:
                 now = datetime.now()
                 current_time = now.strftime('%H:%M:%S')
-                print_if(f'Time: {current_time}.. Observing changes...')
+                print_if(f'Time: {current_time}.. Observing changes...',
+                         self.options)
                 time.sleep(self.args.watch_sleep_time)
         except KeyboardInterrupt:
             print('User triggered abort.')
@@ -975,9 +5678,10 @@ class JojoMusicManager:
             print('Exception while observing...')
             traceback.print_exc()
         finally:
-            for observer in self.observers:
-                observer.stop()
-                observer.join()
+            self.observer.stop()
+            self.observer.join()
+            for album_handler in self.album_handlers:
+                album_handler.stop()
 
     def run(self):
         self.convert_playlists()
@@ -987,8 +5691,10 @@ class JojoMusicManager:
 
 
 class MusicManager:
-    def __init__(self, args):
+    def __init__(self, args, options: Optional[Options] = None):
         self.args = args
+        self.options = options or Options.from_args(args)
+        self.genre_rules = load_genre_rules(args.genre_rules)
 
     def run(self):
         if (not self.args.m3u_flac_to_alac and
@@ -1013,30 +5719,41 @@ class MusicManager:
             if not m3u_input_dir:
                 print('Specify --m3u_input_dir...')
                 return
-            playlist_manager = PlaylistManager(input_dir=m3u_input_dir,
-                                               output_dir=m3u_output_dir)
+            library_index = None
+            if m3u_flac_to_alac:
+                library_index = load_library_index(
+                    music_dir=self.args.m3u_library_dir,
+                    index_file=self.args.m3u_library_index,
+                    options=self.options)
+            playlist_manager = PlaylistManager(
+                input_dir=m3u_input_dir,
+                output_dir=m3u_output_dir,
+                library_index=library_index,
+                library_root=self.args.m3u_library_root,
+                options=self.options)
             try:
                 start = time.process_time()
                 playlist_manager.read()
                 if m3u_flac_to_alac:
                     playlist_manager.convert_flac_to_alac()
-                    print_if(
-                        f'flac->alac, elapsed: {time.process_time() - start}')
+                    print_if('flac->alac, elapsed: '
+                             f'{time.process_time() - start}', self.options)
 
                 if m3u_windows_to_posix:
                     playlist_manager.convert_windows_to_posix()
                     print_if('windows->posix, elapsed: '
-                             f'{time.process_time() - start}')
+                             f'{time.process_time() - start}', self.options)
 
                 if m3u_from_str and m3u_to_str:
                     playlist_manager.convert_from_str_to_str(
                         from_str=m3u_from_str, to_str=m3u_to_str)
                     print_if(f'{m3u_from_str}->{m3u_to_str}, elapsed: '
-                             f'{time.process_time() - start}')
+                             f'{time.process_time() - start}', self.options)
 
-                playlist_manager.write()
+                playlist_manager.write(
+                    only_if_changed=self.args.m3u_only_if_changed)
                 print_if('Finished writing, elapsed: '
-                         f'{time.process_time() - start}')
+                         f'{time.process_time() - start}', self.options)
             except KeyboardInterrupt:
                 print('Done...')
             except Exception:
@@ -1052,23 +5769,70 @@ class MusicManager:
         flac_delete_original = self.args.flac_delete_original
         flac_threads = self.args.flac_threads
 
-        if not FFMPEG_AVAILABLE and not XLD_AVAILABLE:
+        if self.args.farm_coordinator and not self.args.farm_secret:
+            print('Set --farm_secret (or FOO_TUNES_FARM_SECRET) to use '
+                  '--farm_coordinator.')
+            return
+
+        if (not self.args.farm_coordinator and
+                self.args.backend == 'command' and
+                not self.options.ffmpeg_available and
+                not self.options.xld_available):
             print('Install ffmpeg or xld to use --flac_dir.')
             return
 
+        if (self.args.flac_verify and self.args.backend == 'command' and
+                not self.options.ffmpeg_available):
+            print('Install ffmpeg to use --flac_verify.')
+            return
+
+        governor = ResourceGovernor.from_args(self.args, options=self.options)
+        backend = create_backend(self.args.backend, self.args,
+                                 governor=governor, options=self.options)
+
         converter = FlacToAlacConverter(
             input_dir=flac_dir,
             overwrite_output=flac_overwrite_output,
             delete_original=flac_delete_original,
-            num_threads=int(flac_threads))
-
+            num_threads=int(flac_threads),
+            genre_rules=(self.genre_rules
+                         if self.args.flac_change_genres else None),
+            verify=self.args.flac_verify,
+            priority_policies=self.create_priority_policies(),
+            governor=governor,
+            cache=self.create_cache(),
+            backend=backend,
+            batch_size=self.args.flac_batch_size,
+            profiles=[OutputProfile.parse(spec)
+                      for spec in self.args.flac_profile or []],
+            analyze_loudness=self.args.flac_loudness,
+            prefetch=self.args.flac_prefetch,
+            prefetch_budget=self.args.flac_prefetch_mb * 1024 ** 2,
+            max_attempts=self.args.flac_max_attempts,
+            retry_backoff=self.args.flac_retry_backoff,
+            quarantine=self.create_quarantine(),
+            options=self.options)
+
+        genre_changer = None
         try:
-            converter.read()
-            converter.write()
+            if self.args.farm_coordinator:
+                converter.read()
+                FarmCoordinator(
+                    converter,
+                    secret=self.args.farm_secret,
+                    address=self.args.farm_coordinator,
+                    lease_timeout=self.args.farm_lease_timeout,
+                    max_attempts=self.args.farm_max_attempts,
+                    shared_paths=self.args.farm_shared_paths,
+                    options=self.options).run()
+            else:
+                converter.write()
 
             if self.args.flac_change_genres:
-                genre_changer = GenreChanger(self.args.flac_dir)
-                genre_changer.read()
+                genre_changer = GenreChanger(self.args.flac_dir,
+                                             genre_rules=self.genre_rules,
+                                             backend=backend,
+                                             options=self.options)
                 genre_changer.write()
 
         except KeyboardInterrupt:
@@ -1080,43 +5844,70 @@ class MusicManager:
 
             print('Done...')
 
+    def create_cache(self) -> Optional[ConversionCache]:
+        return create_conversion_cache(self.args, options=self.options)
+
+    def create_quarantine(self) -> Optional[Quarantine]:
+        if not self.args.flac_quarantine_file:
+            return None
+        return Quarantine(self.args.flac_quarantine_file,
+                          options=self.options).load()
+
+    def create_priority_policies(self) -> List[PriorityPolicy]:
+        names = [name.strip() for name in self.args.flac_priority.split(',')
+                 if name.strip()]
+        playlist_manager = None
+        if 'playlist' in names and self.args.m3u_input_dir:
+            playlist_manager = PlaylistManager(
+                input_dir=self.args.m3u_input_dir,
+                output_dir=self.args.m3u_output_dir,
+                options=self.options)
+            playlist_manager.read()
+        return create_priority_policies(names, playlist_manager)
+
     def watch(self):
-        self.observers: List[Observer] = []
+        if not self.args.m3u_watch and not self.args.flac_watch:
+            print_if('Not watching any directories, so finishing!',
+                     self.options)
+            return
+
+        # One observer (thread) for every watch.
+        self.observer = create_observer(
+            polling=self.args.watch_polling,
+            poll_interval=self.args.watch_poll_interval,
+            options=self.options)
 
         if self.args.m3u_watch:
-            self.playlist_observer = Observer()
-            self.playlist_observer.schedule(
+            self.observer.schedule(
                 WatchHandler(fn=self.convert_playlists,
                              ob_name='Playlist Observer',
-                             delay=self.args.watch_playlist_delay),
+                             delay=self.args.watch_playlist_delay,
+                             options=self.options),
                 true_path(self.args.m3u_input_dir),
                 recursive=False)
-            print_if('Will start observer with name: Playlist Observer...')
-            self.observers.append(self.playlist_observer)
+            print_if('Will start observer with name: Playlist Observer...',
+                     self.options)
 
         if self.args.flac_watch:
-            self.converter_observer = Observer()
-            self.converter_observer.schedule(
-                WatchHandler(fn=self.convert_flacs,
-                             ob_name='FLAC Observer',
-                             delay=self.args.watch_convert_delay),
+            self.observer.schedule(
+                AlbumWatchHandler(root=self.args.flac_dir,
+                                  fn=lambda albums: self.convert_flacs(),
+                                  ob_name='FLAC Observer',
+                                  settle_time=self.args.watch_settle_time,
+                                  options=self.options),
                 true_path(self.args.flac_dir),
-                recursive=False)
-            print_if('Will start observer with name: FLAC Observer...')
-            self.observers.append(self.converter_observer)
-
-        if len(self.observers) == 0:
-            print_if('Not watching any directories, so finishing!')
-            return
+                recursive=True)
+            print_if('Will start observer with name: FLAC Observer...',
+                     self.options)
 
-        for observer in self.observers:
-            observer.start()
+        self.observer.start()
 
         try:
             while True:
                 now = datetime.now()
                 current_time = now.strftime('%H:%M:%S')
-                print_if(f'Time: {current_time}.. Observing changes...')
+                print_if(f'Time: {current_time}.. Observing changes...',
+                         self.options)
                 time.sleep(self.args.watch_sleep_time)
         except KeyboardInterrupt:
             print('User triggered abort.')
@@ -1124,43 +5915,73 @@ class MusicManager:
             print('Exception while observing...')
             traceback.print_exc()
         finally:
-            for observer in self.observers:
-                observer.stop()
-                observer.join()
-
+            self.observer.stop()
+            self.observer.join()
 
-def main():
-    global DRY, FFMPEG_AVAILABLE, METAFLAC_AVAILABLE, MP4TAGS_AVAILABLE, \
-        VERBOSE, XLD_AVAILABLE
-    args = parser.parse_args()
-    VERBOSE = args.verbose or args.jojo
-    DRY = args.dry
 
-    XLD_AVAILABLE = which('xld')  # OSX Only
-    FFMPEG_AVAILABLE = which('ffmpeg')
-    MP4TAGS_AVAILABLE = which('mp4tags')
-    METAFLAC_AVAILABLE = which('metaflac')
+def main(argv: Optional[List[str]] = None):
+    args = build_parser().parse_args(argv)
+    options = Options.from_args(args)
 
-    print_separator()
-    print_if(args)
-    print_separator()
+    print_separator(options)
+    print_if(args, options)
+    print_separator(options)
 
     if args.change_genres:
-        g = GenreChanger(input_dir=args.flac_dir)
-        g.read()
+        g = GenreChanger(input_dir=args.flac_dir,
+                         genre_rules=load_genre_rules(args.genre_rules),
+                         backend=create_backend(args.backend, args,
+                                                options=options),
+                         options=options)
         g.write()
         return
 
+    if args.stats:
+        tag_cache = TagCache(
+            args.stats_cache or os.path.join(true_path(args.stats),
+                                             '.foo_tunes_tags.json'),
+            backend=create_backend(args.backend, args, options=options),
+            options=options).load()
+        start = time.perf_counter()
+        stats = LibraryStats(args.stats, tag_cache=tag_cache,
+                             genre_rules=load_genre_rules(args.genre_rules),
+                             options=options).collect()
+        tag_cache.save()
+        print(stats.report())
+        print_if(f'Read tags of {tag_cache.misses} files, '
+                 f'{tag_cache.hits} were cached, elapsed: '
+                 f'{time.perf_counter() - start:.2f}s', options)
+        return
+
+    if args.farm_worker:
+        if (args.backend == 'command' and not options.ffmpeg_available and
+                not options.xld_available):
+            print('Install ffmpeg or xld to use --farm_worker.')
+            return
+        governor = ResourceGovernor.from_args(args, options=options)
+        if not args.farm_secret:
+            print('Set --farm_secret (or FOO_TUNES_FARM_SECRET) to use '
+                  '--farm_worker.')
+            return
+        FarmWorker(args.farm_worker,
+                   secret=args.farm_secret,
+                   backend=create_backend(args.backend, args,
+                                          governor=governor, options=options),
+                   shared_dir=args.farm_worker_dir,
+                   options=options).run()
+        return
+
     if args.clean_up:
         print(f'Cleaning up {args.clean_up}')
-        delete_some_trash(args.clean_up)
+        delete_some_trash(args.clean_up, options=options,
+                          report_only=args.clean_up_report)
         return
 
     if args.jojo:
-        music_manager = JojoMusicManager(args)
+        music_manager = JojoMusicManager(args, options=options)
         music_manager.run()
     else:
-        music_manager = MusicManager(args)
+        music_manager = MusicManager(args, options=options)
         music_manager.run()
 
 
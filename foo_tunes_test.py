@@ -1,12 +1,47 @@
 import foo_tunes
 import json
 import os
+import queue
 import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-from foo_tunes import FFProbe, GenreChanger, Playlist, PlaylistManager, Resilio
+from foo_tunes import (AlbumPipeline, AlbumWatchHandler, ConversionCache,
+                       ConversionJob, FarmCoordinator, FarmWorker, FFProbe,
+                       FlacMetadata, FlacToAlacConverter, GenreChanger,
+                       GenreRules, Id3Tagger, LibraryIndex, LibraryStats,
+                       Mp4Tagger, Options, OutputProfile, PipelineStage,
+                       Playlist, PlaylistManager, Resilio, ResourceGovernor,
+                       SimulatedBackend, TagCache, TokenBucket, TrashCleaner)
+
+
+def make_flac_header(comments=(), md5=bytes(16), bits_per_sample=16,
+                     total_samples=0):
+    """Returns the metadata portion of a FLAC file, without any frames."""
+    streaminfo = bytearray(34)
+    # 44100 Hz, 2 channels, bits_per_sample, total_samples.
+    packed = ((44100 << 44) | (1 << 41) | ((bits_per_sample - 1) << 36) |
+              total_samples)
+    streaminfo[10:18] = packed.to_bytes(8, 'big')
+    streaminfo[18:34] = md5
+    vendor = b'reference libFLAC 1.3.2'
+    block = len(vendor).to_bytes(4, 'little') + vendor
+    block += len(comments).to_bytes(4, 'little')
+    for comment in comments:
+        encoded = comment.encode('utf8')
+        block += len(encoded).to_bytes(4, 'little') + encoded
+    return (b'fLaC' +
+            bytes([0]) + len(streaminfo).to_bytes(3, 'big') + streaminfo +
+            bytes([0x80 | 4]) + len(block).to_bytes(3, 'big') + block)
 
 
 class FooTunesTest(unittest.TestCase):
@@ -80,6 +115,14 @@ class FooTunesTest(unittest.TestCase):
             foo_tunes.temp_path_from_path('/a/b/c/abc.mp3'),
             '/a/b/c/abc_temp.mp3')
 
+    def test_only_in_directories(self):
+        self.assertEqual(
+            foo_tunes.only_in_directories(
+                ['/sync/A/01.flac', '/sync/AB/01.flac', '/sync/B/CD1/01.flac',
+                 '/sync/C.flac'],
+                '/sync', ['A', 'B', 'C.flac']),
+            ['/sync/A/01.flac', '/sync/B/CD1/01.flac', '/sync/C.flac'])
+
     def test_find_flac_files(self):
         temp_dir = os.path.join(os.path.dirname(__file__), 'testdata/temp_dir')
         os.mkdir(temp_dir)
@@ -122,6 +165,73 @@ class FooTunesTest(unittest.TestCase):
         # Clean up test directory.
         shutil.rmtree(temp_dir)
 
+    def test_scan_files(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for relative_path in ['b/02.flac', 'b/01.FLAC', 'a/CD2/01.flac',
+                              'a/CD1/01.flac', 'a/cover.jpg', 'top.mp3']:
+            path = os.path.join(root, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Path(path).touch()
+        os.symlink(os.path.join(root, 'b'), os.path.join(root, 'link'))
+
+        active, most_active = [0], [0]
+        lock = threading.Lock()
+        list_directory = foo_tunes.list_directory
+
+        def slow_list_directory(*args):
+            # Like a listing over the network.
+            with lock:
+                active[0] += 1
+                most_active[0] = max(most_active[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return list_directory(*args)
+
+        expected = ['top.mp3', 'a/CD1/01.flac', 'a/CD2/01.flac',
+                    'b/01.FLAC', 'b/02.flac']
+        for threads in (1, 8):
+            options = Options(discovery_threads=threads)
+            with mock.patch('foo_tunes.list_directory',
+                            side_effect=slow_list_directory):
+                entries = foo_tunes.scan_files(
+                    root, foo_tunes.MUSIC_EXTENSIONS, stat=True,
+                    options=options)
+            self.assertEqual([os.path.relpath(entry.path, root)
+                              for entry in entries], expected)
+        self.assertGreater(most_active[0], 1)
+        self.assertEqual(entries[0].stat().st_size, 0)
+        self.assertEqual(len(foo_tunes.find_flac_files(root)), 4)
+
+    def test_iter_directory_files(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for relative_path in ['b/02.flac', 'b/01.flac', 'a/CD1/01.flac',
+                              'a/cover.jpg', 'empty/cover.jpg']:
+            path = os.path.join(root, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Path(path).touch()
+
+        list_directory = foo_tunes.list_directory
+
+        def list_directory_b_first(path, *args):
+            # b is listed ahead of a/CD1 and finishes first.
+            if os.path.basename(path) != 'b':
+                time.sleep(0.05)
+            return list_directory(path, *args)
+
+        with mock.patch('foo_tunes.list_directory',
+                        side_effect=list_directory_b_first):
+            directories = foo_tunes.iter_directory_files(
+                root, ('.flac',), options=Options(discovery_threads=2))
+            found = [[os.path.relpath(entry.path, root) for entry in entries]
+                     for entries in directories]
+        # Same order as scan_files, directories without flacs aren't
+        # yielded.
+        self.assertEqual(found, [['a/CD1/01.flac'],
+                                 ['b/01.flac', 'b/02.flac']])
+
     def test_delete_some_trash(self):
         flac_dir = os.path.join(os.path.dirname(__file__), 'testdata/flac_dir')
 
@@ -156,6 +266,1247 @@ class FooTunesTest(unittest.TestCase):
         self.assertEqual(len(os.listdir(flac_dir)), 1)
 
 
+class TrashCleanerTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, relative_path):
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('Create a new text file!')
+        return path
+
+    def remaining(self):
+        return sorted(os.path.relpath(entry.path, self.root)
+                      for entry in foo_tunes.scan_files(self.root))
+
+    def test_matches_names_only(self):
+        self.write('Mr._Children/Album/01.flac')
+        self.write('Mr._Children/Album/._01.flac')
+        self.write('Album/.DS_Store')
+        self.write('Album/notes.DS_Store.txt')
+        trash = TrashCleaner().clean(self.root)
+        self.assertEqual(len(trash), 2)
+        self.assertEqual(self.remaining(),
+                         ['Album/notes.DS_Store.txt',
+                          'Mr._Children/Album/01.flac'])
+
+    def test_report_only(self):
+        self.write('Album/._01.flac')
+        cleaner = TrashCleaner(report_only=True)
+        for _ in range(2):
+            self.assertEqual(len(cleaner.clean(self.root)), 1)
+        self.assertEqual(self.remaining(), ['Album/._01.flac'])
+
+    def test_only_changed_directories_are_listed(self):
+        self.write('A/CD1/01.flac')
+        self.write('B/01.flac')
+        self.write('B/._01.flac')
+        cleaner = TrashCleaner()
+        self.assertEqual(len(cleaner.clean(self.root)), 1)
+
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(cleaner.clean(self.root), [])
+        self.assertEqual(scandir.call_count, 0)
+
+        trash = self.write('A/CD1/._01.flac')
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(cleaner.clean(self.root), [trash])
+        self.assertEqual(scandir.call_count, 1)
+
+        cleaner.mark_dirty(os.path.join(self.root, 'B', '01.flac'))
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(cleaner.clean(self.root), [])
+        self.assertEqual(scandir.call_count, 1)
+
+
+class OptionsTest(unittest.TestCase):
+    def test_tools_are_looked_up_lazily(self):
+        options = Options()
+        self.assertEqual(options.tools, {})
+        options = Options(tools={'xld': None, 'ffmpeg': '/usr/bin/ffmpeg'})
+        self.assertFalse(options.xld_available)
+        self.assertTrue(options.ffmpeg_available)
+
+    def test_from_args(self):
+        args = foo_tunes.build_parser().parse_args(['--jojo', '--dry'])
+        options = Options.from_args(args)
+        self.assertTrue(options.verbose)
+        self.assertTrue(options.dry)
+
+
+class FlacToAlacConverterTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.flac_path = os.path.join(self.temp_dir, 'a.flac')
+        self.alac_path = os.path.join(self.temp_dir, 'a.m4a')
+        self.converter = FlacToAlacConverter(
+            input_dir=self.temp_dir, overwrite_output=False,
+            delete_original=True, verify=True,
+            options=Options(tools={'ffmpeg': '/usr/bin/ffmpeg'}))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_flac(self, md5):
+        with open(self.flac_path, 'wb') as f:
+            f.write(make_flac_header(md5=md5))
+
+    def test_verify_alac(self):
+        self.write_flac(md5=bytes.fromhex('0123456789abcdef' * 2))
+        for stdout, verified in [('MD5=0123456789abcdef0123456789abcdef\n',
+                                  True),
+                                 ('MD5=00000000000000000000000000000001\n',
+                                  False)]:
+            process = subprocess.CompletedProcess([], 0, stdout, '')
+            with mock.patch('subprocess.run', return_value=process) as run:
+                self.assertEqual(
+                    self.converter.verify_alac(self.flac_path,
+                                               self.alac_path),
+                    verified)
+            command = run.call_args[0][0]
+            self.assertIn('pcm_s16le', command)
+            self.assertNotIn(self.flac_path, command)
+
+    def test_verify_alac_without_md5(self):
+        self.write_flac(md5=bytes(16))
+        with mock.patch('subprocess.run') as run:
+            self.assertIsNone(self.converter.verify_alac(self.flac_path,
+                                                         self.alac_path))
+        run.assert_not_called()
+
+        # Both are kept, the ALAC can't be told apart from a good one.
+        Path(self.alac_path).touch()
+        job = ConversionJob(self.flac_path, self.alac_path)
+        self.assertTrue(self.converter.finish_job(job))
+        self.assertTrue(os.path.exists(self.alac_path))
+        self.assertTrue(os.path.exists(self.flac_path))
+        self.assertEqual((self.converter.failed, self.converter.finished),
+                         ([], []))
+
+    def test_batch(self):
+        flacs = []
+        for i in range(3):
+            flacs.append(os.path.join(self.temp_dir, 'Album', f'{i:02d}.flac'))
+            os.makedirs(os.path.dirname(flacs[-1]), exist_ok=True)
+            Path(flacs[-1]).touch()
+        broken = flacs[1]
+
+        def encode(command, **kwargs):
+            outputs = [arg for arg in command if arg.endswith('.m4a')]
+            if command.count('-i') > 1 and broken_batch:
+                # ffmpeg got as far as starting the first output.
+                Path(outputs[0]).touch()
+                return subprocess.CompletedProcess(command, 1, '', '')
+            if command.count('-i') == 1 and broken in command:
+                return subprocess.CompletedProcess(command, 1, '', '')
+            for output in outputs:
+                with open(output, 'wb') as f:
+                    f.write(b'alac')
+            return subprocess.CompletedProcess(command, 0, '', '')
+
+        options = Options(tools={'ffmpeg': '/usr/bin/ffmpeg', 'xld': None})
+        for broken_batch, runs, failed in [(False, 1, []),
+                                           (True, 4, [broken])]:
+            converter = FlacToAlacConverter(
+                input_dir=self.temp_dir, overwrite_output=True,
+                delete_original=False, num_threads=2, batch_size=4,
+                options=options)
+            converter.flacs = flacs
+            with mock.patch('subprocess.run', side_effect=encode) as run:
+                converter.write()
+            self.assertEqual(run.call_count, runs)
+            self.assertEqual(converter.failed, failed)
+            for flac_path in flacs:
+                alac_path = foo_tunes.alac_path_from_flac_path(flac_path)
+                self.assertEqual(os.path.exists(alac_path),
+                                 flac_path not in failed)
+        command = run.call_args_list[0][0][0]
+        self.assertEqual(command.count('-i'), 3)
+        self.assertIn('-map_metadata', command)
+
+    def test_output_dir(self):
+        flac_path = os.path.join(self.temp_dir, 'Album', '01.flac')
+        os.makedirs(os.path.dirname(flac_path))
+        Path(flac_path).touch()
+        scratch_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, scratch_dir)
+        converter = FlacToAlacConverter(
+            input_dir=self.temp_dir, overwrite_output=True,
+            delete_original=False, output_dir=scratch_dir,
+            options=Options(tools={'ffmpeg': '/usr/bin/ffmpeg', 'xld': None}))
+        converter.flacs = [flac_path]
+
+        def encode(command, **kwargs):
+            Path(command[-1]).touch()
+            return subprocess.CompletedProcess(command, 0, '', '')
+
+        with mock.patch('subprocess.run', side_effect=encode):
+            converter.write()
+        self.assertEqual(converter.failed, [])
+        self.assertTrue(os.path.exists(
+            os.path.join(scratch_dir, 'Album', '01.m4a')))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_dir, 'Album', '01.m4a')))
+        self.assertTrue(os.path.exists(flac_path))
+        self.assertEqual(converter.finished, [flac_path])
+
+    def test_failed_encode_leaves_no_alac(self):
+        flac_path = os.path.join(self.temp_dir, 'Album', '01.flac')
+        os.makedirs(os.path.dirname(flac_path))
+        Path(flac_path).touch()
+        alac_path = foo_tunes.alac_path_from_flac_path(flac_path)
+
+        def encode(command, **kwargs):
+            # ffmpeg got as far as starting the output.
+            Path(command[-1]).touch()
+            return subprocess.CompletedProcess(command, 1, '', '')
+
+        def partial_encode(flac_path, alac_path, *args, **kwargs):
+            Path(alac_path).touch()
+            return False
+
+        simulated = SimulatedBackend()
+        simulated.encode = partial_encode
+        options = Options(tools={'ffmpeg': '/usr/bin/ffmpeg', 'xld': None})
+        for backend in (foo_tunes.CommandBackend(options=options),
+                        simulated):
+            converter = FlacToAlacConverter(
+                input_dir=self.temp_dir, overwrite_output=True,
+                delete_original=False, backend=backend, options=options)
+            converter.flacs = [flac_path]
+            with mock.patch('subprocess.run', side_effect=encode):
+                converter.write()
+            self.assertEqual(converter.failed, [flac_path])
+            self.assertEqual(converter.finished, [])
+            self.assertFalse(os.path.exists(alac_path))
+
+
+class PrefetcherTest(unittest.TestCase):
+    def test_prefetch(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        job_queue = queue.PriorityQueue()
+        jobs = []
+        for i, size in enumerate([100, 200, 300, 400]):
+            flac_path = os.path.join(temp_dir, f'{i:02d}.flac')
+            with open(flac_path, 'wb') as f:
+                f.write(bytes(size))
+            jobs.append(ConversionJob(flac_path, flac_path + '.m4a'))
+            job_queue.put(((0,), i, jobs[-1]))
+        jobs[0].claimed = True
+
+        prefetcher = foo_tunes.Prefetcher(job_queue, count=3, budget=750)
+        with mock.patch.object(prefetcher, 'warm') as warm:
+            prefetcher.prefetch()
+            # 01 and 02 fit, 03 would go over the budget.
+            self.assertEqual([call[0][0] for call in warm.call_args_list],
+                             [jobs[1].flac_path, jobs[2].flac_path])
+            self.assertEqual(job_queue.qsize(), 4)
+
+            warm.reset_mock()
+            jobs[1].claimed = True
+            prefetcher.prefetch()
+            warm.assert_called_once_with(jobs[3].flac_path)
+        self.assertEqual((prefetcher.files, prefetcher.bytes), (3, 900))
+
+
+class StallTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_run_watching_outputs(self):
+        output = os.path.join(self.temp_dir, 'out.m4a')
+        # Writes for longer than the stall timeout, then exits.
+        writer = ('import sys, time\n'
+                  'with open(sys.argv[1], "wb") as f:\n'
+                  '    for _ in range(8):\n'
+                  '        f.write(b"alac"); f.flush(); time.sleep(0.1)\n')
+        process = foo_tunes.run_watching_outputs(
+            [sys.executable, '-c', writer, output], [output],
+            stall_timeout=0.5, poll_interval=0.05, capture_output=True)
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(os.path.getsize(output), 32)
+
+        start = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            foo_tunes.run_watching_outputs(
+                [sys.executable, '-c', 'import time; time.sleep(30)'],
+                [output], stall_timeout=0.3, poll_interval=0.05)
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_backend_counts_stalls(self):
+        alac_path = os.path.join(self.temp_dir, '01.m4a')
+        Path(alac_path).touch()
+        backend = foo_tunes.CommandBackend(
+            stall_timeout=1,
+            options=Options(tools={'ffmpeg': '/usr/bin/ffmpeg', 'xld': None}))
+        with mock.patch.object(backend.governor, 'run',
+                               side_effect=subprocess.TimeoutExpired([], 1)):
+            self.assertFalse(backend.encode('01.flac', alac_path, []))
+        self.assertEqual(backend.stall_counts(), {'01.flac': 1})
+        # The partial ALAC is gone.
+        self.assertFalse(os.path.exists(alac_path))
+
+    def test_batch_fallback_counts_as_attempt(self):
+        flacs = []
+        for name in ('bad', 'good'):
+            flacs.append(os.path.join(self.temp_dir, 'Album', name + '.flac'))
+            os.makedirs(os.path.dirname(flacs[-1]), exist_ok=True)
+            Path(flacs[-1]).touch()
+        bad, good = flacs
+
+        def run(command, **kwargs):
+            if bad in command:
+                raise subprocess.TimeoutExpired(command, 1)
+            for arg in command:
+                if arg.endswith('.m4a'):
+                    Path(arg).touch()
+            return subprocess.CompletedProcess(command, 0, '', '')
+
+        backend = foo_tunes.CommandBackend(
+            stall_timeout=1,
+            options=Options(tools={'ffmpeg': '/usr/bin/ffmpeg', 'xld': None}))
+        converter = FlacToAlacConverter(
+            input_dir=self.temp_dir, overwrite_output=True,
+            delete_original=False, num_threads=1, backend=backend,
+            batch_size=2, max_attempts=3, retry_backoff=0.01,
+            options=backend.options)
+        converter.flacs = flacs
+        with mock.patch.object(backend.governor, 'run',
+                               side_effect=run) as governor_run:
+            converter.write()
+        # The batch, each flac by itself and one retry of the bad one.
+        self.assertEqual(governor_run.call_count, 4)
+        self.assertEqual(converter.failed, [bad])
+        self.assertEqual(backend.stalled_batches(), 1)
+        self.assertEqual(backend.stall_counts(), {bad: 2})
+
+    def test_retry_and_quarantine(self):
+        flacs = []
+        for name in ('bad', 'flaky', 'good'):
+            flacs.append(os.path.join(self.temp_dir, 'Album', name + '.flac'))
+            os.makedirs(os.path.dirname(flacs[-1]), exist_ok=True)
+            Path(flacs[-1]).touch()
+        bad, flaky, good = flacs
+        attempts = {}
+
+        def encode(flac_path, alac_path, *args, **kwargs):
+            attempts[flac_path] = attempts.get(flac_path, 0) + 1
+            if flac_path == bad or (flac_path == flaky and
+                                    attempts[flac_path] == 1):
+                return False
+            Path(alac_path).touch()
+            return True
+
+        quarantine_file = os.path.join(self.temp_dir, 'quarantine.json')
+
+        def convert():
+            backend = SimulatedBackend()
+            backend.encode = encode
+            converter = FlacToAlacConverter(
+                input_dir=self.temp_dir, overwrite_output=True,
+                delete_original=True, num_threads=2, backend=backend,
+                max_attempts=3, retry_backoff=0.01,
+                quarantine=foo_tunes.Quarantine(quarantine_file).load())
+            converter.write()
+            return converter
+
+        converter = convert()
+        self.assertEqual(attempts, {bad: 3, flaky: 2, good: 1})
+        self.assertEqual(converter.failed, [bad])
+        with open(quarantine_file) as f:
+            self.assertEqual(json.load(f)['entries'][bad]['failures'], 3)
+
+        # Quarantined until the flac changes.
+        attempts.clear()
+        convert()
+        self.assertEqual(attempts, {})
+        os.utime(bad, ns=(0, 0))
+        convert()
+        self.assertEqual(attempts, {bad: 3})
+
+
+class CommitStagedAlbumTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.staged_dir = os.path.join(self.root, 'scratch', 'Album')
+        self.album_dir = os.path.join(self.root, 'sync', 'Album')
+        self.to_dir = os.path.join(self.root, '_TO_PROCESS', 'Album')
+        os.makedirs(os.path.dirname(self.to_dir))
+        for directory, name in [(self.staged_dir, '01.m4a'),
+                                (self.staged_dir, '02.m4a'),
+                                (self.album_dir, '01.flac'),
+                                (self.album_dir, '02.flac'),
+                                (self.album_dir, 'cover.jpg')]:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(name.encode())
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def finished(self, *names):
+        return [os.path.join(self.album_dir, name) for name in names]
+
+    def test_commit(self):
+        foo_tunes.commit_staged_album(self.staged_dir, self.album_dir,
+                                      self.to_dir,
+                                      self.finished('01.flac', '02.flac'))
+        self.assertEqual(sorted(os.listdir(self.to_dir)),
+                         ['01.m4a', '02.m4a', 'cover.jpg'])
+        self.assertFalse(os.path.exists(self.album_dir))
+        self.assertFalse(os.path.exists(self.staged_dir))
+
+    def test_failed_copy_is_rolled_back(self):
+        copyfile = shutil.copyfile
+
+        def fail_second(src, dst):
+            if src.endswith('02.m4a'):
+                raise OSError('No space left on device')
+            return copyfile(src, dst)
+
+        with mock.patch('foo_tunes.copyfile', side_effect=fail_second):
+            with self.assertRaises(OSError):
+                foo_tunes.commit_staged_album(self.staged_dir,
+                                              self.album_dir, self.to_dir,
+                                              self.finished('01.flac'))
+        self.assertFalse(os.path.exists(self.to_dir))
+        self.assertEqual(sorted(os.listdir(self.album_dir)),
+                         ['01.flac', '02.flac', 'cover.jpg'])
+        self.assertEqual(len(os.listdir(self.staged_dir)), 2)
+
+    def test_only_finished_flacs_are_deleted(self):
+        foo_tunes.commit_staged_album(self.staged_dir, self.album_dir,
+                                      self.to_dir, self.finished('01.flac'))
+        self.assertEqual(sorted(os.listdir(self.to_dir)),
+                         ['01.m4a', '02.flac', '02.m4a', 'cover.jpg'])
+
+    def test_not_enough_space(self):
+        with mock.patch('foo_tunes.has_free_space', return_value=False):
+            with self.assertRaises(OSError):
+                foo_tunes.commit_staged_album(self.staged_dir,
+                                              self.album_dir, self.to_dir,
+                                              self.finished('01.flac'))
+        self.assertTrue(os.path.exists(self.album_dir))
+
+
+class OutputProfileTest(unittest.TestCase):
+    def test_parse(self):
+        profile = OutputProfile.parse('aac:256k:/music/mobile')
+        self.assertEqual((profile.encoder, profile.bitrate, profile.extension),
+                         ('aac', '256k', '.m4a'))
+        self.assertEqual(profile.output_path('/sync/A/01.flac', '/sync'),
+                         os.path.join(profile.directory, 'A', '01.m4a'))
+        with self.assertRaises(ValueError):
+            OutputProfile.parse('flac:0:/music')
+        with self.assertRaises(ValueError):
+            OutputProfile.parse('aac:256k')
+
+    def test_single_decode(self):
+        profile_outputs = [
+            (OutputProfile('aac', '256k', '/mobile'), '/mobile/01.m4a'),
+            (OutputProfile('opus', '128k', '/opus'), '/opus/01.opus')]
+        options = Options(tools={'ffmpeg': '/usr/bin/ffmpeg', 'xld': None})
+        command = foo_tunes.encode_alac_command(
+            '01.flac', '01.m4a', ['-metadata', 'genre=K-Pop'],
+            profile_outputs=profile_outputs, options=options)
+        self.assertEqual(command.count('-i'), 1)
+        self.assertEqual(command[-1], '/opus/01.opus')
+        self.assertEqual(command.count('genre=K-Pop'), 3)
+        aac = command[command.index('01.m4a') + 1:
+                      command.index('/mobile/01.m4a')]
+        self.assertEqual(aac[aac.index('-acodec') + 1], 'aac')
+        self.assertIn('0:v?', aac)
+        opus = command[command.index('/mobile/01.m4a') + 1:]
+        self.assertIn('-vn', opus)
+        self.assertEqual(opus[opus.index('-b:a') + 1], '128k')
+
+    def test_converter(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        flac_dir = os.path.join(temp_dir, 'flac')
+        for name in ('A/01.flac', 'A/02.flac', 'B/01.flac'):
+            os.makedirs(os.path.join(flac_dir, os.path.dirname(name)),
+                        exist_ok=True)
+            Path(os.path.join(flac_dir, name)).touch()
+        mobile = os.path.join(temp_dir, 'mobile')
+        backend = SimulatedBackend()
+        converter = FlacToAlacConverter(
+            input_dir=flac_dir, overwrite_output=False, delete_original=False,
+            backend=backend, batch_size=2,
+            profiles=[OutputProfile.parse(f'opus:96k:{mobile}')])
+        converter.read()
+        converter.write()
+        self.assertEqual([entry.path for entry in
+                          foo_tunes.scan_files(mobile)],
+                         [os.path.join(mobile, 'A', '01.opus'),
+                          os.path.join(mobile, 'A', '02.opus'),
+                          os.path.join(mobile, 'B', '01.opus')])
+        self.assertEqual(backend.calls, {'encode': 1, 'encode_batch': 1})
+
+    def test_profile_root(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        flac_path = os.path.join(temp_dir, 'flac', 'A', '01.flac')
+        os.makedirs(os.path.dirname(flac_path))
+        Path(flac_path).touch()
+        mobile = os.path.join(temp_dir, 'mobile')
+        # Converting a single album, like --jojo does.
+        converter = FlacToAlacConverter(
+            input_dir=os.path.dirname(flac_path), overwrite_output=False,
+            delete_original=False, backend=SimulatedBackend(),
+            profiles=[OutputProfile.parse(f'aac:256k:{mobile}')],
+            profile_root=os.path.join(temp_dir, 'flac'))
+        converter.write()
+        self.assertEqual([entry.path for entry in
+                          foo_tunes.scan_files(mobile)],
+                         [os.path.join(mobile, 'A', '01.m4a')])
+
+
+class ConversionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = ConversionCache(os.path.join(self.temp_dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.temp_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_key(self):
+        md5 = bytes(range(16))
+        a = self.write('a/01.flac', make_flac_header(['GENRE=kpop'], md5))
+        b = self.write('b/01.flac', make_flac_header(['GENRE=kpop'], md5))
+        c = self.write('c/01.flac', make_flac_header(['GENRE=jpop'], md5))
+        d = self.write('d/01.flac', make_flac_header(['GENRE=kpop']))
+        self.assertEqual(self.cache.key(a, ['ffmpeg']),
+                         self.cache.key(b, ['ffmpeg']))
+        self.assertNotEqual(self.cache.key(a, ['ffmpeg']),
+                            self.cache.key(c, ['ffmpeg']))
+        self.assertNotEqual(self.cache.key(a, ['ffmpeg']),
+                            self.cache.key(a, ['xld']))
+        # No STREAMINFO MD5, nothing to go by.
+        self.assertIsNone(self.cache.key(d, ['ffmpeg']))
+
+    def test_store_and_fetch(self):
+        alac_path = self.write('a/01.m4a', b'alac')
+        self.cache.store('ab' * 32, alac_path)
+        os.remove(alac_path)
+        self.assertTrue(self.cache.fetch('ab' * 32, alac_path))
+        self.assertFalse(self.cache.fetch('cd' * 32, alac_path + '2'))
+        with open(alac_path, 'rb') as f:
+            self.assertEqual(f.read(), b'alac')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_hardlink(self):
+        self.cache.hardlink = True
+        alac_path = self.write('a/01.m4a', b'alac')
+        self.cache.store('ab' * 32, alac_path)
+        entry_stat = os.stat(self.cache.entry_path('ab' * 32))
+        self.assertIn(entry_stat.st_nlink, (1, 2))
+        if entry_stat.st_nlink == 2:
+            self.assertEqual(entry_stat.st_ino, os.stat(alac_path).st_ino)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.max_size = 25
+        keys = [c * 64 for c in 'abc']
+        for i, key in enumerate(keys[:2]):
+            self.cache.store(key, self.write(f'{i}.m4a', bytes(10)))
+            os.utime(self.cache.entry_path(key), (i, i))
+        # Using the oldest entry keeps it around.
+        self.assertTrue(self.cache.fetch(keys[0], os.path.join(
+            self.temp_dir, 'fetched.m4a')))
+        self.cache.store(keys[2], self.write('2.m4a', bytes(10)))
+        self.assertTrue(os.path.exists(self.cache.entry_path(keys[0])))
+        self.assertFalse(os.path.exists(self.cache.entry_path(keys[1])))
+        self.assertTrue(os.path.exists(self.cache.entry_path(keys[2])))
+
+    def test_converter_reuses_cached_alac(self):
+        md5 = bytes(range(16))
+        flacs = [self.write(f'{d}/Album/01.flac',
+                            make_flac_header(['GENRE=K-Pop'], md5))
+                 for d in ('first', 'second')]
+
+        def encode(command, **kwargs):
+            with open(command[-1], 'wb') as f:
+                f.write(b'alac')
+            return subprocess.CompletedProcess(command, 0, '', '')
+
+        options = Options(tools={'ffmpeg': '/usr/bin/ffmpeg', 'xld': None})
+        for flac_path, encodes in zip(flacs, (1, 0)):
+            converter = FlacToAlacConverter(
+                input_dir=os.path.dirname(flac_path), overwrite_output=False,
+                delete_original=True, num_threads=1, cache=self.cache,
+                options=options)
+            converter.flacs = [flac_path]
+            with mock.patch('subprocess.run', side_effect=encode) as run:
+                converter.write()
+            self.assertEqual(run.call_count, encodes)
+            self.assertFalse(os.path.exists(flac_path))
+            alac_path = foo_tunes.alac_path_from_flac_path(flac_path)
+            with open(alac_path, 'rb') as f:
+                self.assertEqual(f.read(), b'alac')
+        self.assertEqual(self.cache.hits, 1)
+
+
+class FarmTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.flacs = []
+        for i in range(6):
+            flac_path = os.path.join(self.temp_dir, f'{i:02d}.flac')
+            with open(flac_path, 'wb') as f:
+                f.write(f'flac {i}'.encode())
+            self.flacs.append(flac_path)
+        self.converter = FlacToAlacConverter(
+            input_dir=self.temp_dir, overwrite_output=False,
+            delete_original=True)
+        self.converter.flacs = list(self.flacs)
+        # The fake flacs have no audio to verify.
+        verify = mock.patch.object(self.converter, 'verify_alac',
+                                   return_value=True)
+        verify.start()
+        self.addCleanup(verify.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def start_coordinator(self, **kwargs):
+        coordinator = FarmCoordinator(self.converter, secret='s3cret',
+                                      address='127.0.0.1:0', **kwargs)
+        coordinator.start()
+        self.addCleanup(coordinator.stop)
+        return coordinator
+
+    def run_workers(self, coordinator, encode_fn, count=3, **kwargs):
+        host, port = coordinator.server_address
+        workers = [FarmWorker(f'{host}:{port}', secret='s3cret',
+                              name=f'worker{i}', encode_fn=encode_fn,
+                              poll_interval=0.05, **kwargs)
+                   for i in range(count)]
+        threads = [threading.Thread(target=worker.run) for worker in workers]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(coordinator.wait(timeout=10))
+        for thread in threads:
+            thread.join(timeout=10)
+        return workers
+
+    @staticmethod
+    def fake_encode(flac_path, alac_path, extra_args):
+        with open(flac_path, 'rb') as f:
+            content = f.read()
+        with open(alac_path, 'wb') as f:
+            f.write(content.replace(b'flac', b'alac'))
+        return True
+
+    def assert_converted(self, flac_path):
+        alac_path = foo_tunes.alac_path_from_flac_path(flac_path)
+        with open(alac_path, 'rb') as f:
+            self.assertTrue(f.read().startswith(b'alac'))
+        self.assertFalse(os.path.exists(flac_path))
+
+    def test_inline(self):
+        coordinator = self.start_coordinator()
+        workers = self.run_workers(coordinator, self.fake_encode)
+        for flac_path in self.flacs:
+            self.assert_converted(flac_path)
+        self.assertEqual(sum(worker.converted for worker in workers), 6)
+        self.assertTrue(all(r['ok'] for r in coordinator.results.values()))
+
+    def test_shared_paths(self):
+        coordinator = self.start_coordinator(shared_paths=True)
+        self.run_workers(coordinator, self.fake_encode, count=2,
+                         shared_dir=self.temp_dir)
+        for flac_path in self.flacs:
+            self.assert_converted(flac_path)
+        self.assertTrue(self.converter.verify)
+
+    def test_shared_paths_outside_worker_dir(self):
+        self.converter.flacs = self.flacs[:1]
+        coordinator = self.start_coordinator(shared_paths=True,
+                                             max_attempts=1)
+        other_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_dir)
+        self.run_workers(coordinator, self.fake_encode, count=1,
+                         shared_dir=other_dir)
+        self.assertEqual(self.converter.failed, self.flacs[:1])
+        self.assertTrue(os.path.exists(self.flacs[0]))
+
+    def test_unsigned_messages_are_dropped(self):
+        coordinator = self.start_coordinator()
+        host, port = coordinator.server_address
+        for secret in ('', 'wrong'):
+            with socket.create_connection((host, port)) as sock:
+                foo_tunes.send_message(
+                    sock, {'type': 'result', 'job_id': 0, 'ok': True,
+                           'worker': 'evil'}, b'alac', secret=secret)
+                # The coordinator hangs up without answering.
+                self.assertEqual(sock.recv(1), b'')
+        self.assertEqual(coordinator.results, {})
+        self.assertTrue(all(os.path.exists(flac) for flac in self.flacs))
+
+    def test_worker_refuses_encoder_arguments(self):
+        worker = FarmWorker('127.0.0.1:1', secret='s3cret',
+                            encode_fn=self.fake_encode)
+        header = {'job_id': 0, 'shared_paths': False, 'flac_path': 'a.flac',
+                  'alac_path': 'a.m4a'}
+        for extra_args in (['-metadata', 'genre=K-Pop'], []):
+            result, _ = worker.convert({**header, 'extra_args': extra_args},
+                                       b'flac')
+            self.assertTrue(result['ok'])
+        for extra_args in (['-f', 'null'], ['-metadata'],
+                           ['-metadata', 'genre=a', '/tmp/other.m4a']):
+            result, _ = worker.convert({**header, 'extra_args': extra_args},
+                                       b'flac')
+            self.assertFalse(result['ok'])
+
+    def test_retries_and_failures(self):
+        attempts = {}
+        lock = threading.Lock()
+
+        def flaky_encode(flac_path, alac_path, extra_args):
+            with open(flac_path, 'rb') as f:
+                content = f.read()
+            with lock:
+                attempts[content] = attempts.get(content, 0) + 1
+                count = attempts[content]
+            if content == b'flac 0':
+                raise RuntimeError('always broken')
+            # Every other file fails the first time.
+            if count == 1 and content[-1] % 2:
+                return False
+            return self.fake_encode(flac_path, alac_path, extra_args)
+
+        coordinator = self.start_coordinator(max_attempts=2)
+        self.run_workers(coordinator, flaky_encode)
+        self.assertEqual(self.converter.failed, [self.flacs[0]])
+        self.assertTrue(os.path.exists(self.flacs[0]))
+        for flac_path in self.flacs[1:]:
+            self.assert_converted(flac_path)
+        self.assertEqual(coordinator.results[1]['attempts'], 2)
+        self.assertEqual(coordinator.results[2]['attempts'], 1)
+
+    def test_shared_paths_partial_outputs_are_retried(self):
+        self.converter.flacs = self.flacs[:2]
+        attempts = {}
+
+        def partial_encode(flac_path, alac_path, extra_args):
+            attempts[flac_path] = attempts.get(flac_path, 0) + 1
+            if flac_path == self.flacs[1] and attempts[flac_path] > 1:
+                return self.fake_encode(flac_path, alac_path, extra_args)
+            with open(alac_path, 'wb') as f:
+                f.write(b'partial')
+            return False
+
+        coordinator = self.start_coordinator(shared_paths=True,
+                                             max_attempts=3)
+        self.run_workers(coordinator, partial_encode, count=1,
+                         shared_dir=self.temp_dir)
+        self.assertEqual(self.converter.failed, self.flacs[:1])
+        self.assertEqual(coordinator.results[0]['attempts'], 3)
+        self.assertFalse(os.path.exists(
+            foo_tunes.alac_path_from_flac_path(self.flacs[0])))
+        self.assert_converted(self.flacs[1])
+
+    def test_expired_lease_is_requeued(self):
+        self.converter.flacs = self.flacs[:1]
+        coordinator = self.start_coordinator(lease_timeout=0.2)
+        host, port = coordinator.server_address
+
+        # A worker that takes a job and disappears.
+        with socket.create_connection((host, port)) as sock:
+            foo_tunes.send_message(sock, {'type': 'lease', 'worker': 'dead'},
+                                   secret='s3cret')
+            header, payload = foo_tunes.recv_message(sock, 's3cret')
+        self.assertEqual(header['type'], 'job')
+        self.assertEqual(payload, b'flac 0')
+
+        time.sleep(0.3)
+        self.run_workers(coordinator, self.fake_encode, count=1)
+        self.assert_converted(self.flacs[0])
+        self.assertEqual(coordinator.results[0]['worker'], 'worker0')
+        self.assertEqual(coordinator.results[0]['attempts'], 2)
+
+
+class PriorityPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        # Album name -> (track, size).
+        albums = {
+            'Box Set': [('01 A.flac', 300), ('02 B.flac', 300)],
+            'Single': [('01 Single.flac', 100)],
+            'EP': [('01 C.flac', 150), ('02 D.flac', 100)],
+        }
+        self.flacs = []
+        for album, tracks in albums.items():
+            os.mkdir(os.path.join(self.temp_dir, album))
+            for track, size in tracks:
+                flac_path = os.path.join(self.temp_dir, album, track)
+                with open(flac_path, 'wb') as f:
+                    f.write(bytes(size))
+                self.flacs.append(flac_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def queued_order(self, policies):
+        converter = FlacToAlacConverter(input_dir=self.temp_dir,
+                                        overwrite_output=False,
+                                        delete_original=False,
+                                        num_threads=0,
+                                        priority_policies=policies)
+        converter.flacs = self.flacs
+        converter.write()
+        order = []
+        while not converter.queue.empty():
+            _, _, job = converter.queue.get_nowait()
+            order.append(os.path.relpath(job.flac_path, self.temp_dir))
+        return order
+
+    def test_fifo_without_policies(self):
+        self.assertEqual(self.queued_order([]),
+                         [os.path.relpath(f, self.temp_dir)
+                          for f in self.flacs])
+
+    def test_oldest(self):
+        arrived = {flac_path: i
+                   for i, flac_path in enumerate(reversed(self.flacs))}
+        # Falls back to ctime where creation times aren't available, sync
+        # tools keep the source's mtime.
+        with mock.patch('os.stat', side_effect=lambda path: SimpleNamespace(
+                st_size=0, st_mtime=0, st_ctime=arrived[path])):
+            order = self.queued_order([foo_tunes.OldestArrivalPolicy()])
+        self.assertEqual(order, [os.path.relpath(f, self.temp_dir)
+                                 for f in reversed(self.flacs)])
+
+    def test_smallest_album_then_playlist(self):
+        p = PlaylistManager(input_dir='unused', output_dir='unused')
+        playlist = Playlist(file='Favorites.m3u8')
+        playlist.songs = [r'X:\music\Pop\Artist\Box Set\02 B.m4a',
+                          r'X:\music\Pop\Artist\EP\02 D.flac']
+        p.playlists = [playlist]
+
+        policies = foo_tunes.create_priority_policies(
+            ['playlist', 'smallest_album'], p)
+        self.assertEqual(self.queued_order(policies), [
+            'EP/02 D.flac',
+            'Box Set/02 B.flac',
+            'Single/01 Single.flac',
+            'EP/01 C.flac',
+            'Box Set/01 A.flac',
+        ])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            foo_tunes.create_priority_policies(['largest'])
+
+    def test_track_key(self):
+        self.assertEqual(
+            foo_tunes.track_key(r'X:\music\K-Pop\TWICE\#TWICE\08 TT.flac'),
+            foo_tunes.track_key('/bebe/sync/flacsfor.me/#TWICE/08 TT.m4a'))
+        self.assertEqual(
+            ConversionJob('/a/b/c.flac', '/a/b/c.m4a').album_dir, '/a/b')
+
+
+class ResourceGovernorTest(unittest.TestCase):
+    def test_defaults_change_nothing(self):
+        governor = ResourceGovernor()
+        self.assertEqual(governor.wrap(['ffmpeg']), ['ffmpeg'])
+        self.assertFalse(governor.is_overloaded())
+
+    @unittest.skipUnless(os.name == 'posix', 'nice is posix only')
+    def test_wrap(self):
+        governor = ResourceGovernor(
+            niceness=10, idle_io=True,
+            options=Options(tools={'nice': '/usr/bin/nice',
+                                   'ionice': '/usr/bin/ionice',
+                                   'taskpolicy': '/usr/sbin/taskpolicy'}))
+        command = governor.wrap(['ffmpeg', '-i', 'a.flac'])
+        self.assertEqual(command[:3], ['nice', '-n', '10'])
+        self.assertEqual(command[-3:], ['ffmpeg', '-i', 'a.flac'])
+
+    def test_overloaded_workers_wait(self):
+        governor = ResourceGovernor(max_load=1, min_workers=1,
+                                    poll_interval=0.01)
+        kill_event = foo_tunes.threading.Event()
+        with mock.patch.object(governor, 'is_overloaded', return_value=True):
+            # Worker 0 keeps going.
+            governor.wait_for_capacity(0, kill_event)
+            timer = foo_tunes.threading.Timer(0.05, kill_event.set)
+            timer.start()
+            governor.wait_for_capacity(1, kill_event)
+            self.assertTrue(kill_event.is_set())
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1000, burst=1000)
+        self.assertEqual(bucket.consume(1000), 0)
+        with mock.patch('time.sleep') as sleep:
+            # The bucket is empty so the debt has to be slept off.
+            self.assertAlmostEqual(bucket.consume(500), 0.5, places=1)
+            sleep.assert_called_once()
+
+
+class AlbumPipelineTest(unittest.TestCase):
+    def test_albums_move_on_independently(self):
+        events = []
+        lock = threading.Lock()
+
+        def stage(name, seconds=0.0, fails=()):
+            def fn(album):
+                time.sleep(seconds)
+                with lock:
+                    events.append((name, album))
+                return album not in fails
+            return fn
+
+        pipeline = AlbumPipeline([
+            PipelineStage('convert', stage('convert', 0.05, fails={'b'})),
+            PipelineStage('tag', stage('tag'), concurrency=2),
+            PipelineStage('move', stage('move')),
+        ])
+        albums = ['a', 'b', 'c', 'd']
+        self.assertEqual(pipeline.run(albums), ['a', 'c', 'd'])
+        self.assertEqual(pipeline.failed, {'b': 'convert'})
+        # The first album was moved before the last one was converted.
+        self.assertLess(events.index(('move', 'a')),
+                        events.index(('convert', 'd')))
+        self.assertNotIn(('tag', 'b'), events)
+
+    def test_exception_stops_album(self):
+        def convert(album):
+            if album == 'a':
+                raise OSError('disk full')
+            return True
+
+        failed = []
+        pipeline = AlbumPipeline([PipelineStage('convert', convert),
+                                  PipelineStage('move', lambda album: True)],
+                                 on_failed=failed.append)
+        self.assertEqual(pipeline.run(['a', 'b']), ['b'])
+        self.assertEqual(pipeline.failed, {'a': 'convert'})
+        self.assertEqual(failed, ['a'])
+
+
+class PollingObserverTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.events = []
+        self.observer = foo_tunes.PollingObserver()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def dispatch(self, event):
+        self.events.append((event.event_type,
+                            os.path.relpath(event.src_path, self.root)))
+
+    def write(self, relative_path, content=b'flac'):
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def age(self):
+        """Moves every mtime back, out of PollingObserver.MTIME_SLACK_NS."""
+        for dirpath, _, file_names in os.walk(self.root, topdown=False):
+            for name in file_names:
+                os.utime(os.path.join(dirpath, name), (1000, 1000))
+            os.utime(dirpath, (1000, 1000))
+
+    def poll(self):
+        self.events = []
+        self.observer.poll()
+        return sorted(self.events)
+
+    def test_events(self):
+        self.write('Old/01.flac')
+        self.age()
+        self.observer.schedule(SimpleNamespace(dispatch=self.dispatch),
+                               self.root, recursive=True)
+        self.assertEqual(self.poll(), [])
+
+        self.write('New/CD1/01.flac')
+        os.rename(self.write('Old/02.flac!sync'),
+                  os.path.join(self.root, 'Old', '02.flac'))
+        self.assertEqual(self.poll(), [
+            ('created', 'New'), ('created', 'New/CD1'),
+            ('created', 'New/CD1/01.flac'), ('created', 'Old/02.flac'),
+            ('modified', '.'), ('modified', 'New'), ('modified', 'New/CD1'),
+            ('modified', 'Old')])
+
+        self.age()
+        self.poll()
+        shutil.rmtree(os.path.join(self.root, 'New'))
+        self.assertEqual(self.poll(), [('deleted', 'New'), ('modified', '.')])
+
+    def test_only_changed_directories_are_listed(self):
+        for i in range(5):
+            self.write(f'Album {i}/01.flac')
+        self.age()
+        self.observer.schedule(SimpleNamespace(dispatch=self.dispatch),
+                               self.root, recursive=True)
+        self.write('Album 3/02.flac')
+        with mock.patch.object(foo_tunes.PollingObserver, 'list_directory',
+                               wraps=foo_tunes.PollingObserver.list_directory
+                               ) as list_directory:
+            self.assertEqual(self.poll(), [('created', 'Album 3/02.flac'),
+                                           ('modified', 'Album 3')])
+        list_directory.assert_called_once_with(
+            os.path.join(self.root, 'Album 3'))
+
+    def test_create_observer(self):
+        observer = foo_tunes.create_observer(polling=True, poll_interval=1)
+        self.assertIsInstance(observer, foo_tunes.PollingObserver)
+        self.assertEqual(observer.interval, 1)
+
+
+class AlbumWatchHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.ready = []
+        self.handler = AlbumWatchHandler(self.root, fn=self.ready.extend,
+                                         ob_name='test', settle_time=0)
+        # Drive check() by hand instead of from the background thread.
+        self.handler.start = lambda: None
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, relative_path, content=b'flac'):
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        self.dispatch('created', path)
+        return path
+
+    def dispatch(self, event_type, src_path, dest_path=None):
+        self.handler.dispatch(SimpleNamespace(event_type=event_type,
+                                              src_path=src_path,
+                                              dest_path=dest_path))
+
+    def test_ready_after_stable_check(self):
+        self.write('Album/CD1/01.flac')
+        self.assertEqual(self.handler.check(), [])
+        self.assertEqual(self.handler.check(), ['Album'])
+        self.assertEqual(self.ready, ['Album'])
+        self.assertEqual(self.handler.check(), [])
+
+    def test_changing_files_are_not_ready(self):
+        path = self.write('Album/01.flac')
+        self.handler.check()
+        with open(path, 'ab') as f:
+            f.write(b'more')
+        self.assertEqual(self.handler.check(), [])
+        self.assertEqual(self.handler.check(), ['Album'])
+
+    def test_partial_downloads_are_not_ready(self):
+        partial_path = self.write('Album/02.flac.!sync')
+        self.write('Other/01.flac')
+        self.handler.check()
+        self.assertEqual(self.handler.check(), ['Other'])
+        self.assertEqual(self.handler.check(), [])
+
+        final_path = partial_path.replace('.!sync', '')
+        os.rename(partial_path, final_path)
+        self.dispatch('moved', partial_path, final_path)
+        self.handler.check()
+        self.assertEqual(self.handler.check(), ['Album'])
+
+    def test_ignored_paths(self):
+        self.dispatch('modified', self.root)
+        self.write('.sync/01.flac')
+        self.dispatch('opened', os.path.join(self.root, 'Album/01.flac'))
+        self.assertEqual(self.handler.pending, {})
+
+    def test_removed_album(self):
+        path = self.write('Album/01.flac')
+        shutil.rmtree(os.path.dirname(path))
+        self.assertEqual(self.handler.check(), [])
+        self.assertEqual(self.handler.pending, {})
+
+    def test_deferred_albums_are_checked_again(self):
+        deferred = [['Album'], None]
+        self.handler.fn = lambda albums: deferred.pop(0)
+        self.write('Album/01.flac')
+        self.handler.check()
+        self.assertEqual(self.handler.check(), ['Album'])
+        self.assertIn('Album', self.handler.pending)
+        self.handler.check()
+        self.assertEqual(self.handler.check(), ['Album'])
+        self.assertEqual(self.handler.pending, {})
+
+
+class SimulatedBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def touch(self, count, extension):
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.temp_dir, f'Album {i % 10}',
+                                f'{i:03d}{extension}')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Path(path).touch()
+            paths.append(path)
+        return paths
+
+    def test_converter(self):
+        flacs = self.touch(200, '.flac')
+        backend = SimulatedBackend(failure_rate=0.25, seed=1)
+        converter = FlacToAlacConverter(
+            input_dir=self.temp_dir, overwrite_output=False,
+            delete_original=True, num_threads=8, backend=backend)
+        converter.read()
+        self.assertEqual(len(converter.flacs), 200)
+        converter.write()
+
+        self.assertEqual(backend.calls, {'encode': 200})
+        self.assertTrue(10 < len(converter.failed) < 100)
+        for flac_path in flacs:
+            alac_path = foo_tunes.alac_path_from_flac_path(flac_path)
+            converted = flac_path not in converter.failed
+            self.assertEqual(os.path.exists(alac_path), converted)
+            self.assertEqual(os.path.exists(flac_path), not converted)
+
+    def jojo(self, *flags):
+        args = foo_tunes.build_parser().parse_args(
+            ['--jojo', '--backend=simulate', *flags])
+        # Jojo's directories are only defined for its own machines.
+        with mock.patch('platform.system', return_value='FreeBSD'):
+            return foo_tunes.JojoMusicManager(args)
+
+    def test_backends_implement_everything(self):
+        with self.assertRaises(TypeError):
+            foo_tunes.Backend()
+        foo_tunes.CommandBackend()
+        SimulatedBackend()
+
+    def test_jojo_verifies_only_with_ffmpeg(self):
+        args = foo_tunes.build_parser().parse_args(['--jojo'])
+        for ffmpeg, verify in [('/usr/bin/ffmpeg', True), (None, False)]:
+            options = Options(tools={'ffmpeg': ffmpeg, 'xld': '/bin/xld'})
+            with mock.patch('platform.system', return_value='FreeBSD'):
+                manager = foo_tunes.JojoMusicManager(args, options=options)
+            self.assertEqual(manager.flac_verify, verify)
+
+    def test_jojo_convert_album(self):
+        album_dir = os.path.join(self.temp_dir, 'Album')
+        os.makedirs(album_dir)
+        for flags, verified in [((), False), (('--flac_verify',), True)]:
+            real = os.path.join(album_dir, '01.flac')
+            with open(real, 'wb') as f:
+                f.write(make_flac_header(md5=bytes(range(16))))
+            placeholder = os.path.join(album_dir, '02.flac')
+            Path(placeholder).touch()
+
+            manager = self.jojo(*flags)
+            self.assertTrue(manager.convert_album(self.temp_dir, 'Album'))
+            self.assertEqual(manager.backend.calls.get('decode_md5', 0),
+                             1 if verified else 0)
+            self.assertTrue(os.path.exists(os.path.join(album_dir,
+                                                        '01.m4a')))
+            self.assertFalse(os.path.exists(real))
+            # Placeholders have nothing to verify against.
+            self.assertEqual(os.path.exists(placeholder), verified)
+            self.assertEqual(os.path.exists(os.path.join(album_dir,
+                                                         '02.m4a')),
+                             not verified)
+            for name in os.listdir(album_dir):
+                os.remove(os.path.join(album_dir, name))
+
+    def test_jojo_tag_staged_album(self):
+        scratch_dir = os.path.join(self.temp_dir, 'scratch')
+        album_dir = os.path.join(self.temp_dir, 'Music', 'Album')
+        staged_dir = os.path.join(scratch_dir, 'Music', 'Album')
+        os.makedirs(album_dir)
+        os.makedirs(staged_dir)
+        for name in ('01.flac', '02.flac', '03.mp3'):
+            Path(os.path.join(album_dir, name)).touch()
+        Path(os.path.join(staged_dir, '01.m4a')).touch()
+
+        manager = self.jojo(f'--scratch_dir={scratch_dir}')
+        manager.staged_flacs[foo_tunes.true_path(album_dir)] = [
+            foo_tunes.true_path(os.path.join(album_dir, '01.flac'))]
+        self.assertTrue(manager.tag_album(
+            os.path.join(self.temp_dir, 'Music'), 'Album'))
+        # 01.flac is replaced by its finished ALAC and isn't tagged.
+        self.assertEqual(manager.backend.calls['probe'], 3)
+
+    def test_converter_batches_albums(self):
+        self.touch(100, '.flac')
+        backend = SimulatedBackend(seed=1)
+        converter = FlacToAlacConverter(
+            input_dir=self.temp_dir, overwrite_output=False,
+            delete_original=True, num_threads=4, backend=backend,
+            batch_size=4)
+        converter.read()
+        converter.write()
+        # 10 albums of 10 tracks, in batches of 4, 4 and 2.
+        self.assertEqual(backend.calls, {'encode_batch': 30})
+        self.assertEqual(converter.failed, [])
+        self.assertEqual(converter.started, 100)
+
+    def test_converter_streams_discovery(self):
+        self.touch(100, '.flac')
+        backend = SimulatedBackend(seed=1)
+        converter = FlacToAlacConverter(
+            input_dir=self.temp_dir, overwrite_output=False,
+            delete_original=True, num_threads=4, backend=backend,
+            batch_size=4, options=Options(discovery_queue_size=3))
+        # Without read() flacs are queued while they're found.
+        converter.write()
+        self.assertIsNone(converter.flacs)
+        self.assertEqual(backend.calls, {'encode_batch': 30})
+        self.assertEqual((converter.started, converter.total_queue_size),
+                         (100, 100))
+        self.assertEqual(converter.failed, [])
+        # Finished albums were forgotten.
+        self.assertEqual(converter.album_jobs, {})
+
+    def test_genre_changer(self):
+        self.touch(50, '.m4a')
+        for read in (True, False):
+            backend = SimulatedBackend(genre='kpop')
+            genre_changer = GenreChanger(
+                self.temp_dir, backend=backend,
+                options=Options(discovery_queue_size=2))
+            if read:
+                genre_changer.read()
+            genre_changer.write()
+            self.assertEqual(backend.calls, {'probe': 50, 'set_genre': 50})
+
+    def test_create_backend(self):
+        args = foo_tunes.build_parser().parse_args(
+            ['--backend=simulate', '--simulate_latency=0.1',
+             '--simulate_failure_rate=0.5'])
+        backend = foo_tunes.create_backend(args.backend, args)
+        self.assertIsInstance(backend, SimulatedBackend)
+        self.assertEqual(backend.latency, 0.1)
+        self.assertEqual(backend.failure_rate, 0.5)
+        args = foo_tunes.build_parser().parse_args([])
+        self.assertIsInstance(foo_tunes.create_backend(args.backend, args),
+                              foo_tunes.CommandBackend)
+
+
 class FFProbeTest(unittest.TestCase):
 
     # Generated with:
@@ -266,6 +1617,422 @@ class GenreChangerTest(unittest.TestCase):
         self.assertEqual(g.find_appropriate_genre('k-pop'),
                          'K-Pop')
 
+    def test_find_appropriate_genre_custom_rules(self):
+        g = GenreChanger(input_dir='unused',
+                         genre_rules=GenreRules({'(idol)': 'K-Pop'}))
+        self.assertEqual(g.find_appropriate_genre('Idol'), 'K-Pop')
+        self.assertEqual(g.find_appropriate_genre('soundtrack'), 'Soundtrack')
+
+
+class GenreRulesTest(unittest.TestCase):
+    def test_earlier_rule_wins(self):
+        rules = GenreRules()
+        # 'rap' appears first in the string but K-Pop is the earlier rule.
+        self.assertEqual(rules.normalize('rap korean'), 'K-Pop')
+        self.assertEqual(rules.normalize('Japanese Rap'), 'J-Pop')
+        self.assertIsNone(rules.normalize(''))
+        self.assertIsNone(rules.normalize(None))
+
+    def test_rules_must_join_into_one_regex(self):
+        for pattern in (r'(a)\1', '(?P<x>a)', '(?P<x>a)(?P=x)', '(a'):
+            with self.assertRaises(ValueError, msg=pattern):
+                GenreRules({pattern: 'Genre'})
+        rules = GenreRules({r'(a\\1)': 'Escaped'})
+        self.assertEqual(rules.normalize(r'a\1'), 'Escaped')
+
+    def test_normalize_is_memoized(self):
+        rules = GenreRules()
+        for _ in range(10):
+            rules.normalize('kpop')
+        self.assertEqual(rules.normalize.cache_info().misses, 1)
+        self.assertEqual(rules.normalize.cache_info().hits, 9)
+
+    def test_from_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rules_file = os.path.join(temp_dir, 'rules.json')
+            with open(rules_file, 'w') as f:
+                json.dump({'(city ?pop)': 'City Pop', '(pop)': 'Pop'}, f)
+            rules = GenreRules.from_file(rules_file)
+        self.assertEqual(rules.normalize('citypop'), 'City Pop')
+        self.assertEqual(rules.normalize('J-Pop'), 'Pop')
+        self.assertEqual(rules.normalize('kpop'), 'Pop')
+        self.assertEqual(rules.normalize('jazz'), 'Jazz')
+
+
+class FlacMetadataTest(unittest.TestCase):
+    def test_read_genre(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            flac_file = os.path.join(temp_dir, 'a.flac')
+            with open(flac_file, 'wb') as f:
+                f.write(make_flac_header(['TITLE=Next Level',
+                                          'genre=kpop']))
+            metadata = FlacMetadata(flac_file)
+            self.assertTrue(metadata.read())
+        self.assertEqual(metadata.get_genre(), 'kpop')
+        self.assertEqual(metadata.comments['TITLE'], ['Next Level'])
+
+    def test_read_streaminfo(self):
+        md5 = bytes(range(16))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            flac_file = os.path.join(temp_dir, 'a.flac')
+            with open(flac_file, 'wb') as f:
+                f.write(make_flac_header(md5=md5, bits_per_sample=24))
+            metadata = FlacMetadata(flac_file)
+            self.assertTrue(metadata.read())
+        self.assertEqual(metadata.sample_rate, 44100)
+        self.assertEqual(metadata.channels, 2)
+        self.assertEqual(metadata.bits_per_sample, 24)
+        self.assertEqual(metadata.md5, md5)
+        self.assertTrue(metadata.has_md5())
+
+    def test_read_not_flac(self):
+        music_file = os.path.join(os.path.dirname(__file__),
+                                  'testdata/music/sample-3s.mp3')
+        self.assertFalse(FlacMetadata(music_file).read())
+
+
+def make_atom(type, payload):
+    return (len(payload) + 8).to_bytes(4, 'big') + type + payload
+
+
+def make_mp4(moov_first=True, meta_padding=0, genre='kpop'):
+    """Returns a minimal MP4 with one stco chunk pointing at mdat."""
+    ftyp = make_atom(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42')
+    mdat = make_atom(b'mdat', b'audio' * 10)
+    gen = make_atom(b'\xa9gen', make_atom(
+        b'data', b'\x00\x00\x00\x01' + bytes(4) + genre.encode('utf8')))
+    meta = make_atom(b'meta', bytes(4) + make_atom(
+        b'hdlr', bytes(8) + b'mdirappl' + bytes(9)) + make_atom(
+            b'ilst', gen) + (make_atom(b'free', bytes(meta_padding - 8))
+                             if meta_padding else b''))
+
+    def moov(chunk_offset):
+        stco = make_atom(b'stco', bytes(4) + (1).to_bytes(4, 'big') +
+                         chunk_offset.to_bytes(4, 'big'))
+        stbl = make_atom(b'stbl', stco)
+        trak = make_atom(b'trak', make_atom(b'mdia', make_atom(
+            b'minf', stbl)))
+        return make_atom(b'moov', trak + make_atom(b'udta', meta))
+
+    if moov_first:
+        moov_size = len(moov(0))
+        chunk_offset = len(ftyp) + moov_size + 8
+        return ftyp + moov(chunk_offset) + mdat
+    return ftyp + mdat + moov(len(ftyp) + 8)
+
+
+class Mp4TaggerTest(unittest.TestCase):
+    def tag(self, content, genre):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'a.m4a')
+        with open(path, 'wb') as f:
+            f.write(content)
+        tagger = Mp4Tagger(path).read()
+        self.assertEqual(tagger.get_text(b'\xa9gen'), 'kpop')
+        tagger.set_genre(genre)
+        how = tagger.save()
+        return path, how, Mp4Tagger(path).read()
+
+    def chunk_offset(self, tagger):
+        stco = next(a for a in tagger.moov.walk() if a.type == b'stco')
+        return int.from_bytes(stco.data[8:12], 'big')
+
+    def assert_audio_intact(self, path, tagger):
+        with open(path, 'rb') as f:
+            f.seek(self.chunk_offset(tagger))
+            self.assertEqual(f.read(10), b'audioaudio')
+
+    def test_in_place_with_padding(self):
+        content = make_mp4(meta_padding=64)
+        path, how, tagger = self.tag(content, 'Electronic')
+        self.assertEqual(how, 'in place')
+        self.assertEqual(tagger.get_text(b'\xa9gen'), 'Electronic')
+        self.assertEqual(os.path.getsize(path), len(content))
+        self.assert_audio_intact(path, tagger)
+
+    def test_rewrite_shifts_chunk_offsets(self):
+        content = make_mp4()
+        path, how, tagger = self.tag(content, 'Electronic')
+        self.assertEqual(how, 'rewrite')
+        self.assertEqual(tagger.get_text(b'\xa9gen'), 'Electronic')
+        self.assert_audio_intact(path, tagger)
+
+        # The padding left behind makes the next edit in place.
+        tagger.set_genre('K-Pop')
+        self.assertEqual(tagger.save(), 'in place')
+        self.assert_audio_intact(path, Mp4Tagger(path).read())
+
+    def test_moov_at_end(self):
+        content = make_mp4(moov_first=False)
+        path, how, tagger = self.tag(content, 'Electronic')
+        self.assertEqual(how, 'in place')
+        self.assertEqual(tagger.get_text(b'\xa9gen'), 'Electronic')
+        self.assert_audio_intact(path, tagger)
+
+    def test_freeform(self):
+        path, _, tagger = self.tag(make_mp4(), 'kpop')
+        tagger.set_freeform('replaygain_track_gain', '-6.50 dB')
+        tagger.save()
+        items = Mp4Tagger(path).read().get_ilst().children
+        freeform = [Mp4Tagger.freeform_name(c) for c in items
+                    if c.type == b'----']
+        self.assertEqual(freeform,
+                         [('com.apple.iTunes', 'replaygain_track_gain')])
+
+
+EBUR128_STDERR = '''\
+[ebur128@track{index} @ 0x5581c8e0c2c0] Summary:
+
+  Integrated loudness:
+    I:         {integrated} LUFS
+    Threshold: -24.1 LUFS
+
+  Loudness range:
+    LRA:         5.2 LU
+    Threshold:  -34.1 LUFS
+    LRA low:    -18.9 LUFS
+    LRA high:   -13.7 LUFS
+
+  True peak:
+    Peak:        {peak} dBFS
+'''
+
+
+class LoudnessTest(unittest.TestCase):
+    def test_parse_ebur128(self):
+        stderr = ('[out#0/ipod @ 0x55] video:0kB audio:29kB\n' +
+                  EBUR128_STDERR.format(index=1, integrated=-14.2,
+                                        peak=-0.3) +
+                  EBUR128_STDERR.format(index=0, integrated=-9.0,
+                                        peak='-inf'))
+        measurements = foo_tunes.parse_ebur128(stderr)
+        self.assertEqual(sorted(measurements), [0, 1])
+        self.assertEqual(measurements[1].integrated, -14.2)
+        self.assertEqual(measurements[1].true_peak, -0.3)
+        self.assertAlmostEqual(measurements[1].gain, -3.8)
+        self.assertEqual(measurements[0].integrated, -9.0)
+        self.assertEqual(foo_tunes.parse_ebur128(''), {})
+
+    def test_album_loudness(self):
+        Loudness = foo_tunes.Loudness
+        album = foo_tunes.album_loudness([Loudness(-10.0, -1.0, 60),
+                                          Loudness(-20.0, -3.0, 60)])
+        self.assertAlmostEqual(album.integrated, -12.596, places=3)
+        self.assertEqual(album.true_peak, -1.0)
+        # Longer tracks count for more.
+        album = foo_tunes.album_loudness([Loudness(-10.0, None, 10),
+                                          Loudness(-20.0, None, 990)])
+        self.assertLess(album.integrated, -19.5)
+        self.assertIsNone(album.true_peak)
+        self.assertEqual(album.replaygain_tags('album'),
+                         {'replaygain_album_gain':
+                          f'{-18.0 - album.integrated:.2f} dB'})
+
+    def test_converter_tags_replaygain(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        flacs = []
+        for i, seconds in enumerate((100, 300)):
+            flacs.append(os.path.join(temp_dir, 'Album', f'{i:02d}.flac'))
+            os.makedirs(os.path.dirname(flacs[-1]), exist_ok=True)
+            with open(flacs[-1], 'wb') as f:
+                f.write(make_flac_header(total_samples=44100 * seconds))
+
+        def encode(command, **kwargs):
+            self.assertIn('ebur128@track0=peak=true:framelog=verbose',
+                          command)
+            alac_path = next(arg for arg in command if arg.endswith('.m4a'))
+            with open(alac_path, 'wb') as f:
+                f.write(make_mp4())
+            integrated = -10.0 if flacs[0] in command else -20.0
+            return subprocess.CompletedProcess(
+                command, 0, '', EBUR128_STDERR.format(
+                    index=0, integrated=integrated, peak=-1.0))
+
+        converter = FlacToAlacConverter(
+            input_dir=temp_dir, overwrite_output=False,
+            delete_original=True, num_threads=2, analyze_loudness=True,
+            options=Options(tools={'ffmpeg': '/usr/bin/ffmpeg',
+                                   'xld': None}))
+        converter.flacs = flacs
+        with mock.patch('subprocess.run', side_effect=encode):
+            converter.write()
+
+        album = foo_tunes.album_loudness(
+            [foo_tunes.Loudness(-10.0, -1.0, 100),
+             foo_tunes.Loudness(-20.0, -1.0, 300)])
+        for flac_path, track_gain in zip(flacs, ('-8.00 dB', '2.00 dB')):
+            tagger = Mp4Tagger(
+                foo_tunes.alac_path_from_flac_path(flac_path)).read()
+            tags = {}
+            for item in tagger.get_ilst().children:
+                if item.type == b'----':
+                    _, name = Mp4Tagger.freeform_name(item)
+                    data = foo_tunes.Mp4Atom.parse_children(item.data)[-1]
+                    tags[name] = data.data[8:].decode()
+            self.assertEqual(tags, {
+                'replaygain_track_gain': track_gain,
+                'replaygain_track_peak': '0.891251',
+                'replaygain_album_gain': f'{album.gain:.2f} dB',
+                'replaygain_album_peak': '0.891251'})
+
+
+def make_id3(frames, version=4, padding=0):
+    """Returns an ID3v2 tag with frames ((id, data), ...) and padding."""
+    body = b''
+    for frame_id, data in frames:
+        size = (foo_tunes.int_to_syncsafe(len(data)) if version == 4
+                else len(data).to_bytes(4, 'big'))
+        body += frame_id + size + bytes(2) + data
+    body += bytes(padding)
+    return (b'ID3' + bytes([version, 0, 0]) +
+            foo_tunes.int_to_syncsafe(len(body)) + body)
+
+
+class Id3TaggerTest(unittest.TestCase):
+    AUDIO = b'\xff\xfb\x90\x00' + bytes(100)
+
+    def write(self, content):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'a.mp3')
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def assert_audio_intact(self, path, tagger):
+        with open(path, 'rb') as f:
+            f.seek(tagger.tag_size)
+            self.assertEqual(f.read(), self.AUDIO)
+
+    def test_in_place_sample(self):
+        music_file = os.path.join(os.path.dirname(__file__),
+                                  'testdata/music/sample-3s.mp3')
+        with open(music_file, 'rb') as f:
+            content = f.read()
+        path = self.write(content)
+        tagger = Id3Tagger(path).read()
+        self.assertEqual(tagger.get_text(b'TCON'), 'Test')
+        tagger.set_genre('K-Pop')
+        self.assertEqual(tagger.save(), 'in place')
+        self.assertEqual(os.path.getsize(path), len(content))
+        tagger = Id3Tagger(path).read()
+        self.assertEqual(tagger.get_text(b'TCON'), 'K-Pop')
+        self.assertEqual(tagger.get_text(b'TSSE'), 'Lavf59.16.100')
+
+    def test_rewrite_without_padding(self):
+        path = self.write(make_id3([(b'TCON', b'\x00rock')], version=3) +
+                          self.AUDIO)
+        tagger = Id3Tagger(path).read()
+        tagger.set_genre('Alternative Rock')
+        self.assertEqual(tagger.save(), 'rewrite')
+        tagger = Id3Tagger(path).read()
+        self.assertEqual(tagger.version, 3)
+        self.assertEqual(tagger.get_text(b'TCON'), 'Alternative Rock')
+        self.assert_audio_intact(path, tagger)
+
+        # v2.3 has no UTF-8 so non latin-1 genres use UTF-16.
+        tagger.set_genre('케이팝')
+        self.assertEqual(tagger.save(), 'in place')
+        tagger = Id3Tagger(path).read()
+        self.assertEqual(tagger.get_text(b'TCON'), '케이팝')
+        self.assert_audio_intact(path, tagger)
+
+    def test_no_tag(self):
+        path = self.write(self.AUDIO)
+        tagger = Id3Tagger(path).read()
+        tagger.set_genre('Rock')
+        self.assertEqual(tagger.save(), 'rewrite')
+        tagger = Id3Tagger(path).read()
+        self.assertEqual(tagger.get_text(b'TCON'), 'Rock')
+        self.assert_audio_intact(path, tagger)
+
+    def test_unsupported(self):
+        v22 = b'ID3\x02\x00\x00' + foo_tunes.int_to_syncsafe(0)
+        unsynchronised = b'ID3\x04\x00\x80' + foo_tunes.int_to_syncsafe(0)
+        for header in (v22, unsynchronised):
+            path = self.write(header + self.AUDIO)
+            with self.assertRaises(ValueError):
+                Id3Tagger(path).read()
+
+
+class LibraryStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.music_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.music_dir, '.tags.json')
+        self.write('K-Pop/Album/01.flac', make_flac_header(['GENRE=kpop']))
+        self.write('K-Pop/Album/01.m4a', make_mp4(genre='kpop'))
+        self.write('Rock/Album/01.flac', make_flac_header(['GENRE=Rock']))
+        sample = os.path.join(os.path.dirname(__file__),
+                              'testdata/music/sample-3s.mp3')
+        shutil.copy(sample, os.path.join(self.music_dir, 'sample.mp3'))
+
+    def tearDown(self):
+        shutil.rmtree(self.music_dir)
+
+    def write(self, relative_path, content):
+        path = os.path.join(self.music_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def collect(self):
+        tag_cache = TagCache(self.cache_file).load()
+        stats = LibraryStats(self.music_dir, tag_cache=tag_cache).collect()
+        tag_cache.save()
+        return stats, tag_cache
+
+    def test_collect(self):
+        stats, _ = self.collect()
+        self.assertEqual(stats.counts, {'.flac': 2, '.m4a': 1, '.mp3': 1})
+        self.assertEqual(stats.genres, {'K-Pop': 2, 'Rock': 1, 'Test': 1})
+        self.assertEqual(stats.genre_changes, {('kpop', 'K-Pop'): 2})
+        self.assertEqual(stats.unconverted_flacs,
+                         [os.path.join(self.music_dir, 'Rock/Album/01.flac')])
+        report = stats.report()
+        self.assertIn('kpop -> K-Pop: 2', report)
+        self.assertIn('Unconverted flacs: 1', report)
+
+    def test_only_stale_files_are_read(self):
+        self.collect()
+        with mock.patch('foo_tunes.read_genre') as read_genre:
+            stats, tag_cache = self.collect()
+        read_genre.assert_not_called()
+        self.assertEqual(tag_cache.hits, 4)
+        self.assertEqual(stats.genres['Rock'], 1)
+
+        self.write('Rock/Album/01.flac', make_flac_header(['GENRE=Metal']))
+        os.remove(os.path.join(self.music_dir, 'sample.mp3'))
+        stats, tag_cache = self.collect()
+        self.assertEqual((tag_cache.hits, tag_cache.misses), (2, 1))
+        self.assertEqual(stats.genres, {'K-Pop': 2, 'Metal': 1})
+        self.assertEqual(len(TagCache(self.cache_file).load().entries), 3)
+
+
+class PlaylistTest(unittest.TestCase):
+    def test_write_only_if_changed(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            playlist = Playlist(file=os.path.join(temp_dir, 'in', 'a.m3u8'))
+            playlist.songs = ['/music/a.m4a', '/music/b.m4a']
+            playlist_path = playlist.write(output_dir=temp_dir,
+                                           only_if_changed=True)
+            with open(playlist_path) as f:
+                self.assertEqual(f.read(), '/music/a.m4a\n/music/b.m4a\n')
+
+            os.utime(playlist_path, ns=(0, 0))
+            playlist.write(output_dir=temp_dir, only_if_changed=True)
+            self.assertEqual(os.stat(playlist_path).st_mtime_ns, 0)
+
+            playlist.songs.append('/music/c.m4a')
+            playlist.write(output_dir=temp_dir, only_if_changed=True)
+            self.assertNotEqual(os.stat(playlist_path).st_mtime_ns, 0)
+            with open(playlist_path) as f:
+                self.assertEqual(f.read().splitlines(), playlist.songs)
+            # No temp files left behind.
+            self.assertEqual(os.listdir(temp_dir), ['a.m3u8'])
+
 
 class PlaylistManagerTest(unittest.TestCase):
     def test_should_manage_playlist(self):
@@ -353,6 +2120,101 @@ class PlaylistManagerTest(unittest.TestCase):
             self.assertTrue(p.should_manage_playlist(playlist),
                             msg=playlist.file)
 
+    def test_convert_flac_to_alac_with_library_index(self):
+        library_index = LibraryIndex(
+            music_dir='/bebe/music',
+            keys=[LibraryIndex.key('K-Pop/TWICE/#TWICE/08 TT.m4a'),
+                  LibraryIndex.key('K-Pop/TWICE/#TWICE/10 SIGNAL.flac'),
+                  LibraryIndex.key('Rock/Band/Album/01 Song.mp3')])
+        p = PlaylistManager(input_dir='unused',
+                            output_dir='unused',
+                            library_index=library_index,
+                            library_root=r'X:\music')
+        playlist = Playlist(file='K-Pop.m3u8')
+        playlist.songs = [
+            '#EXTM3U',
+            r'X:\music\K-Pop\TWICE\#TWICE\08 TT.flac',
+            r'X:\music\K-Pop\TWICE\#TWICE\10 SIGNAL.flac',
+            r'X:\Music\rock\Band\Album\01 Song.mp3',
+            r'X:\music\K-Pop\TWICE\#TWICE\11 Missing.flac',
+            r'C:\Users\james\Music\01 Elsewhere.flac',
+        ]
+        p.playlists = [playlist]
+        p.convert_flac_to_alac()
+
+        self.assertEqual(playlist.songs, [
+            '#EXTM3U',
+            # Only rewritten because the ALAC exists.
+            r'X:\music\K-Pop\TWICE\#TWICE\08 TT.m4a',
+            # Not converted yet.
+            r'X:\music\K-Pop\TWICE\#TWICE\10 SIGNAL.flac',
+            r'X:\Music\rock\Band\Album\01 Song.mp3',
+            r'X:\music\K-Pop\TWICE\#TWICE\11 Missing.flac',
+            r'C:\Users\james\Music\01 Elsewhere.flac',
+        ])
+        self.assertEqual(p.unresolved, {'K-Pop.m3u8': [
+            r'X:\music\K-Pop\TWICE\#TWICE\11 Missing.flac',
+            r'C:\Users\james\Music\01 Elsewhere.flac',
+        ]})
+
+
+class LibraryIndexTest(unittest.TestCase):
+    def test_build_save_load(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            album_dir = os.path.join(temp_dir, 'music', 'Artist', 'Album')
+            os.makedirs(album_dir)
+            for name in ['01 A.m4a', '02 B.flac', 'cover.jpg']:
+                with open(os.path.join(album_dir, name), 'w') as f:
+                    f.write('Create a new text file!')
+
+            library_index = LibraryIndex(os.path.join(temp_dir, 'music'))
+            library_index.build()
+            self.assertEqual(len(library_index), 2)
+            self.assertIn('Artist/Album/01 A.m4a', library_index)
+            self.assertIn(r'artist\album\02 b.flac', library_index)
+            self.assertNotIn('Artist/Album/cover.jpg', library_index)
+
+            index_file = os.path.join(temp_dir, 'index.json')
+            library_index.save(index_file)
+            loaded = foo_tunes.load_library_index(music_dir=None,
+                                                  index_file=index_file)
+            self.assertEqual(loaded.keys, library_index.keys)
+
+    def test_refresh(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            music_dir = os.path.join(temp_dir, 'music')
+            for album in ('A', 'B'):
+                os.makedirs(os.path.join(music_dir, album))
+                Path(os.path.join(music_dir, album, '01.flac')).touch()
+            index_file = os.path.join(temp_dir, 'index.json')
+            library_index = foo_tunes.load_library_index(music_dir,
+                                                         index_file)
+
+            # Only A changed, so only A is listed again.
+            Path(os.path.join(music_dir, 'A', '01.m4a')).touch()
+            shutil.rmtree(os.path.join(music_dir, 'B'))
+            list_directory = foo_tunes.list_directory
+            with mock.patch('foo_tunes.list_directory',
+                            side_effect=list_directory) as listed:
+                loaded = foo_tunes.load_library_index(music_dir, index_file)
+            self.assertEqual(sorted(call[0][0] for call in
+                                    listed.call_args_list),
+                             [foo_tunes.true_path(music_dir),
+                              os.path.join(foo_tunes.true_path(music_dir),
+                                           'A')])
+            self.assertEqual(sorted(loaded.keys), ['a/01.flac', 'a/01.m4a'])
+            self.assertFalse(loaded.refresh())
+            self.assertEqual(
+                foo_tunes.LibraryIndex.load(index_file).keys, loaded.keys)
+            self.assertNotEqual(library_index.keys, loaded.keys)
+
+    def test_relative_path(self):
+        self.assertEqual(
+            LibraryIndex.relative_path(r'X:\music\Pop\a.flac', r'X:\music'),
+            'pop/a.flac')
+        self.assertIsNone(
+            LibraryIndex.relative_path(r'X:\musicals\a.flac', r'X:\music'))
+
 
 class ResilioTest(unittest.TestCase):
     def test_get_temp_directory(self):
@@ -387,6 +2249,6 @@ class ResilioTest(unittest.TestCase):
 
 
 if __name__ == '__main__':
-    foo_tunes.VERBOSE = True
-    foo_tunes.DRY = False
+    foo_tunes.DEFAULT_OPTIONS.verbose = True
+    foo_tunes.DEFAULT_OPTIONS.dry = False
     unittest.main()